@@ -1,17 +1,30 @@
 """Imports"""
 import os
 import json
+import io
+import math
+import uuid
 import base64
-import shutil
+import hashlib
+from contextlib import nullcontext
 #from vertexai.preview.generative_models import Image
 from datetime import datetime
 from PIL import Image
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_core.runnables import RunnableConfig
 from langchain_community.callbacks.streamlit import StreamlitCallbackHandler
 from langsmith import Client
 import nl2iac_agent
+import nl2iac_cache
+import nl2iac_examples
+import nl2iac_jobs
+import nl2iac_metrics
+import nl2iac_pipeline
+import nl2iac_runner
+import nl2iac_sessions
+import nl2iac_workspace
 
 ##################
 # variables
@@ -24,7 +37,22 @@ st.session_state['OPENAI_MODEL_ID'] = st.secrets['OPENAI_MODEL_ID']
 PROVIDERS = ['Google']
 TEMPERATURE = 0.0
 # generals
-MAX_RETRIES = 3
+MAX_RETRIES = nl2iac_pipeline.MAX_RETRIES
+# candidate templates generated and validated concurrently on every retry (1 disables it)
+SPECULATIVE_CANDIDATES = int(st.secrets.get('SPECULATIVE_CANDIDATES', nl2iac_pipeline.SPECULATIVE_CANDIDATES))
+# templates generated by component groups concurrently (large architectures)
+SHARDED_GENERATION = str(st.secrets.get('SHARDED_GENERATION', nl2iac_pipeline.SHARDED_MODE)).lower() == 'true'
+# models by stage and fast models of the cascade (tables on the secrets), see nl2iac_agent.STAGE_MODELS
+nl2iac_agent.STAGE_MODELS.update({stage: dict(model) for stage, model in st.secrets.get('STAGE_MODELS', {}).items()})
+nl2iac_agent.CASCADE_MODELS.update(dict(st.secrets.get('CASCADE_MODELS', {})))
+# images bigger than these limits are downsized and recompressed before sending them to the model
+IMAGE_MAX_SIZE = 1568
+IMAGE_MAX_BYTES = 1024 * 1024
+IMAGE_JPEG_QUALITY = 85
+# status messages shown by page (the rest are read from the status log when paging)
+STATUS_PAGE_SIZE = nl2iac_sessions.STATUS_PAGE_SIZE
+# terraform output lines kept on the detailed steps tab
+TERRAFORM_OUTPUT_LINES = 200
 # prompt
 PROMPT_IDENTIFY_GCP_COMPONENTS_FROM_IMAGE = """
   You are a Google cloud architect guru. Your job is to create a text describing all the components represented on the provided image. 
@@ -35,7 +63,6 @@ PROMPT_IDENTIFY_GCP_COMPONENTS_FROM_IMAGE = """
   - Identify all the Google cloud components drawn in the image and don't miss anyone of them.
   - List and describe one by one every component with the provided configurations for each one without missing anyone.
   - Provide as many details as possible with the configurations and parameters, but don't make up any info.
-  - Append the provided Configuration in the output as well.
 
   """
 
@@ -53,12 +80,14 @@ if st.secrets['LANGCHAIN_API_KEY'] != "":
 #######################################################
 # functions
 #######################################################
-def add_status_message(status_message, message_type, save=True):
-  """Add a message to he status tab"""
+def add_status_message(status_message, message_type, save=True, timestamp=None):
+  """Add a message to he status tab (and to the session status log if save)"""
   if save:
-    st.session_state['history_status_message'].append((status_message, message_type))
+    timestamp = nl2iac_sessions.get_status_log().add(st.session_state['session_id'], status_message, message_type,
+                                                     st.session_state.get('run_id'))
   # adding timestamp
-  status_message = datetime.now().strftime("%H:%M:%S") + ' ' + status_message
+  status_message = datetime.fromtimestamp(timestamp or datetime.now().timestamp()).strftime("%H:%M:%S") + ' ' \
+    + status_message
   match message_type:
     case 'info':
       status_tab_cont.info(status_message, icon="ℹ️")
@@ -70,46 +99,165 @@ def add_status_message(status_message, message_type, save=True):
       status_tab_cont.error(status_message, icon="🚨")
 
 
+def terraform_output_writer(container):
+  """Returning a handler streaming terraform output lines into a container of the detailed steps tab"""
+  placeholder = container.empty()
+  lines = []
+
+  def write(stream, line):
+    lines.append(line if stream == 'stdout' else f'[{stream}] {line}')
+    placeholder.code('\n'.join(lines[-TERRAFORM_OUTPUT_LINES:]), language='text')
+
+  return write
+
+
+def template_stream_writer(container):
+  """Callback handler showing on container the template tokens as they are generated."""
+  return nl2iac_pipeline.TokenStreamHandler(
+    lambda text: container.code(nl2iac_agent.clean_str(text), language='hcl'))
+
+
+def result_stream_writer(container):
+  """Callback handler showing on container the validation or deployment result as it's generated."""
+  return nl2iac_pipeline.TokenStreamHandler(
+    lambda text: container.json(nl2iac_pipeline.parse_partial_result(text)))
+
+
+def prepare_image(file_bytes):
+  """Downsizing and recompressing large images before sending them to the model.
+      Returns the image bytes and its mime type.
+  """
+  image = Image.open(io.BytesIO(file_bytes))
+  mime_type = Image.MIME.get(image.format, 'image/jpeg')
+  if max(image.size) <= IMAGE_MAX_SIZE and len(file_bytes) <= IMAGE_MAX_BYTES:
+    return file_bytes, mime_type
+
+  image.thumbnail((IMAGE_MAX_SIZE, IMAGE_MAX_SIZE), Image.Resampling.LANCZOS)
+  # flattening transparency on white, the usual background of the diagrams
+  if image.mode != 'RGB':
+    image = image.convert('RGBA')
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel('A'))
+    image = background
+  output = io.BytesIO()
+  image.save(output, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+  return output.getvalue(), 'image/jpeg'
+
+
 def upload_image_and_generate_description():
   """Uploading an image to be processed."""
-  file_base64 = base64.b64encode(uploaded_file.getvalue()).decode('utf-8')
-  if ('file_base64' not in st.session_state) or (file_base64 != st.session_state['file_base64']):
-    st.session_state['image'] = Image.open(uploaded_file)
+  file_bytes = uploaded_file.getvalue()
+  file_digest = hashlib.sha256(file_bytes).hexdigest()
+  if file_digest == st.session_state.get('failed_file_digest'):
+    # not described again on every rerun, the same image would fail the same way
+    return
+  # the description is generated again if it was evicted from an idle session
+  if file_digest != st.session_state.get('file_digest') or 'image_description' not in st.session_state:
     add_status_message("Image uplodaded", 'info')
-    # if an image is being used a description must be obtained
-    image_message =  {
-      "type": "image_url",
-      "image_url": {"url": f"""data:image/jpeg;base64,{file_base64}"""},
-    }
-    text_message = {
-        "type": "text",
-        "text": PROMPT_IDENTIFY_GCP_COMPONENTS_FROM_IMAGE + st.session_state["parameters"],
-    }
-    content = [image_message, text_message]
-    message = [HumanMessage(content=content)]
-    image_description = st.session_state['tf_developer_agent'].invoke(
-      {'user_message': message},
-      config=RunnableConfig(callbacks=[StreamlitCallbackHandler(detailed_tab_image)]))
-    st.session_state['solution_description'] = image_description['output']
-    add_status_message("Image description generated", 'info')
-
-    # saving the file for later checks
-    st.session_state['file_base64'] = file_base64
+    # descriptions are shared by sessions: same image and model of the developer stage, as routed
+    # (the configuration is appended later)
+    settings = nl2iac_agent.stage_settings('developer', **get_settings())
+    cache_key = nl2iac_cache.content_key(file_digest, settings['provider_id'], settings['model_id'],
+                                         settings['temperature'], settings['max_tokens'],
+                                         PROMPT_IDENTIFY_GCP_COMPONENTS_FROM_IMAGE)
+    image_description = nl2iac_cache.get_image_description_cache().get(cache_key)
+    if image_description is None:
+      # if an image is being used a description must be obtained
+      image_bytes, mime_type = prepare_image(file_bytes)
+      image_message =  {
+        "type": "image_url",
+        "image_url": {"url": f"""data:{mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"""},
+      }
+      text_message = {
+          "type": "text",
+          "text": PROMPT_IDENTIFY_GCP_COMPONENTS_FROM_IMAGE,
+      }
+      content = [image_message, text_message]
+      message = [HumanMessage(content=content)]
+      try:
+        with nl2iac_metrics.stage('image_description'):
+          image_description = get_agent('developer').invoke(
+            {'user_message': message},
+            config=RunnableConfig(callbacks=nl2iac_pipeline.stage_callbacks(
+              'developer', [StreamlitCallbackHandler(detailed_tab_image)])))['output']
+      except nl2iac_agent.AgentBudgetExceeded as e:
+        # the image can't be described, the template can't be generated until another one is uploaded
+        add_status_message(f"Image description stopped: {e}", 'error')
+        st.session_state.pop('image_description', None)
+        st.session_state['failed_file_digest'] = file_digest
+        return
+      nl2iac_cache.get_image_description_cache().set(cache_key, image_description)
+      add_status_message("Image description generated", 'info')
+    else:
+      add_status_message("Image description generated (cached)", 'info')
+    st.session_state['image_description'] = image_description
+
+    # saving the file digest for later checks
+    st.session_state['file_digest'] = file_digest
+
+
+def set_solution_description():
+  """Setting the solution description from the text provided or the image one, with the configuration.
+      The solution alone is kept too, it's saved with the validated template as an example.
+  """
+  st.session_state['solution_text'] = st.session_state['image_description'] if uploaded_file is not None \
+    else user_input
+  st.session_state['solution_description'] = st.session_state['solution_text'] + '\nConfiguration:\n' \
+    + st.session_state["parameters"]
+
+
+def template_cache_key():
+  """Key of the current request on the template cache, None if it can't be cached (temperature > 0)."""
+  if st.session_state.temperature != 0:
+    return None
+  return nl2iac_cache.template_key(st.session_state['solution_description'], st.session_state["parameters"],
+                                   st.session_state.provider_id, st.session_state.model_id,
+                                   st.session_state.temperature)
+
+
+def use_cached_template():
+  """Showing the template already validated for the same request, if any. Returns True if cached."""
+  if not ((uploaded_file) or (user_input != '')):
+    return False
+  set_solution_description()
+  key = template_cache_key()
+  cached = nl2iac_cache.get_template_cache().get(key) if key else None
+  if cached is None:
+    return False
+
+  st.session_state['candidate_terraform_template'] = {'output': cached['template']}
+  st.session_state['tf_validation'] = cached['validation']
+  # the deployer applies the template on the workspace, as the validator would have left it
+  nl2iac_agent.write_terraform_template(cached['template'])
+  add_status_message("Template validated (cached).", 'success')
+  finish_run('valid')
+  st.session_state['code_exp'] = state_cont.expander('Generated Template (cached)', expanded=True)
+  show_validated_template()
+  return True
 
 
 def generate_template():
   """Generating a candidate template with the info provided."""
   if (uploaded_file) or (user_input != ''):
-    if uploaded_file is None:
-      st.session_state['solution_description'] = user_input + '\nConfiguration:\n' + st.session_state["parameters"]
+    set_solution_description()
 
-    message = [HumanMessage(content=st.session_state['solution_description'] +
-                            st.session_state.get('previous_error', ''))]
     # if the template hasn't been already generated
+    if 'candidate_terraform_template' not in st.session_state and SHARDED_GENERATION:
+      # the component groups are generated concurrently, single generation if it can't be split
+      template = nl2iac_pipeline.generate_sharded(
+        get_settings(), st.session_state['solution_description'], st.session_state.get('previous_error', ''),
+        callbacks=[StreamlitCallbackHandler(detailed_tab_generate)])
+      if template is not None:
+        st.session_state['candidate_terraform_template'] = {'output': template}
+        add_status_message("Candidate template generated by component groups", 'info')
     if 'candidate_terraform_template' not in st.session_state:
-      st.session_state['candidate_terraform_template'] = st.session_state['tf_developer_agent'].invoke(
-        {'user_message': message},
-        config = RunnableConfig(callbacks=[StreamlitCallbackHandler(detailed_tab_generate)]))
+      # the template is shown while it's being generated
+      stream_cont = state_cont.empty()
+      st.session_state['candidate_terraform_template'] = {'output': nl2iac_pipeline.generate_template(
+        nl2iac_pipeline.developer_agent(get_settings(), st.session_state.get('previous_error', '')),
+        st.session_state['solution_description'], st.session_state.get('previous_error', ''),
+        callbacks=[StreamlitCallbackHandler(detailed_tab_generate), template_stream_writer(stream_cont)])}
+      stream_cont.empty()
       add_status_message("Candidate template generated", 'info')
   else:
     add_status_message("Provide a text or a file describing the architecture of the solution", 'error')
@@ -118,75 +266,161 @@ def generate_template():
 def validate_template():
   """Validating the template."""
   if ('tf_validation' not in st.session_state) or (st.session_state['tf_validation']['valid'] is not True):
-    # validating the generated template
-    st.session_state['terraform_template_validation'] = st.session_state['tf_validator_agent'].invoke(
-      {'user_message': [HumanMessage(
-        content='Validate this terraform template calling the available functions:\n' + nl2iac_agent.clean_str(
-          st.session_state['candidate_terraform_template']['output']))]},
-        config = RunnableConfig(callbacks=[StreamlitCallbackHandler(detailed_tab_generate)]))
-
-    mess_clean = nl2iac_agent.clean_str(st.session_state['terraform_template_validation']['output'])
-    st.session_state['tf_validation'] = json.loads(mess_clean)
-
-    st.session_state['tf_validation'] = json.loads(st.session_state['terraform_template_validation']['output'])
-    st.session_state['tf_validation_valid'] = st.session_state['tf_validation']['valid']
-    code_expander_label = 'Generated Template ' + str(st.session_state.get('validate_retry_number', ''))
-    code_expander_expanded = True
-    st.session_state['code_exp'] = state_cont.expander(code_expander_label, expanded=code_expander_expanded)
-    if st.session_state['tf_validation_valid'] is True:
-      del st.session_state['validate_retry_number']
-      # showing suggestions if available
-      add_status_message("Template validated.", 'success')
-      # creating the container to show the template and suggestions
-      # showing suggestions if any
-      if st.session_state['tf_validation']['suggestions']:
-        st.session_state['tf_validation_suggestions'] = "\n".join(st.session_state['tf_validation']['suggestions'])
-        st.session_state['code_exp'].info(
-          f"Improvement suggestions for the solution:\n {st.session_state['tf_validation_suggestions']}",
-          icon="ℹ️")
-      st.session_state['terraform_template'] = st.session_state['candidate_terraform_template']
-      # showing the validate template
-      st.session_state['code_exp'].code(st.session_state['candidate_terraform_template']['output'], language="json")
-      # creating a button to deploy the template
-      st.session_state['code_exp'].button('Deploy template', key='deploy_button', type='primary')
+    # validating the generated template (obvious defects are found locally, without calling the agent)
+    stream_cont = state_cont.empty()
+    with nl2iac_runner.stream_output(terraform_output_writer(detailed_tab_validate)):
+      st.session_state['tf_validation'] = nl2iac_pipeline.validate_cascade(
+        get_settings(), st.session_state['candidate_terraform_template']['output'],
+        callbacks=[StreamlitCallbackHandler(detailed_tab_generate), result_stream_writer(stream_cont)])
+    stream_cont.empty()
+    if st.session_state['tf_validation'].get('prevalidated'):
+      add_status_message("Candidate template failed the local pre-validation.", 'warning')
+    show_validation_result()
+
+
+def generate_and_validate_speculative():
+  """Generating and validating several candidate templates concurrently, keeping the first valid one."""
+  if not ((uploaded_file) or (user_input != '')):
+    add_status_message("Provide a text or a file describing the architecture of the solution", 'error')
+    return
+  set_solution_description()
+  add_status_message(f"Generating {SPECULATIVE_CANDIDATES} candidate templates concurrently", 'info')
+  winner, failed = nl2iac_pipeline.generate_speculative(
+    st.session_state['solution_description'], st.session_state.get('previous_error', ''),
+    settings=get_settings(), candidates=SPECULATIVE_CANDIDATES, owner=st.session_state['session_id'])
+  template, st.session_state['tf_validation'] = nl2iac_pipeline.speculative_outcome(winner, failed)
+  st.session_state['candidate_terraform_template'] = {'output': template}
+  if winner:
+    # the deployer applies the template on the session workspace
+    nl2iac_agent.write_terraform_template(template)
+    add_status_message(f"Candidate template {winner['candidate'] + 1} validated first", 'info')
+  show_validation_result()
+
+
+def show_validation_result():
+  """Showing the validated template, or the errors and preparing the next retry."""
+  st.session_state['tf_validation_valid'] = st.session_state['tf_validation']['valid']
+  code_expander_label = 'Generated Template ' + str(st.session_state.get('validate_retry_number', ''))
+  code_expander_expanded = True
+  st.session_state['code_exp'] = state_cont.expander(code_expander_label, expanded=code_expander_expanded)
+  if st.session_state['tf_validation_valid'] is True:
+    del st.session_state['validate_retry_number']
+    # showing suggestions if available
+    add_status_message("Template validated.", 'success')
+    finish_run('valid')
+    # saving the validated template for the same requests
+    cache_key = template_cache_key()
+    if cache_key:
+      nl2iac_cache.get_template_cache().set(cache_key, {
+        'template': st.session_state['candidate_terraform_template']['output'],
+        'validation': st.session_state['tf_validation']})
+    # and as an example for similar ones
+    if nl2iac_pipeline.EXAMPLES_MODE:
+      nl2iac_examples.add_example(st.session_state['solution_text'],
+                                  st.session_state['candidate_terraform_template']['output'],
+                                  configuration={'project': st.session_state['project_id'],
+                                                 'region': st.session_state['region_id']})
+    show_validated_template()
 
-    else:
-      add_status_message("Candidate template not correct after validation.", 'error')
+  else:
+    add_status_message("Candidate template not correct after validation.", 'error')
 
-      st.session_state['code_exp'].error(st.session_state['tf_validation']['errors'], icon="🚨")
-      # showing the incorrect template template
-      st.session_state['code_exp'].code(st.session_state['candidate_terraform_template']['output'], language="json")
+    st.session_state['code_exp'].error(st.session_state['tf_validation']['errors'], icon="🚨")
+    # showing the incorrect template template
+    st.session_state['code_exp'].code(st.session_state['candidate_terraform_template']['output'], language="json")
 
+    # patching just the failing blocks if they can be identified (and there's a validation left for them)
+    repaired = None
+    if nl2iac_pipeline.REPAIR_MODE and st.session_state['candidate_terraform_template']['output'] \
+       and st.session_state.get('validate_retry_number', 0) < MAX_RETRIES:
+      stream_cont = state_cont.empty()
+      repaired = nl2iac_pipeline.repair_template(
+        get_settings(), st.session_state['candidate_terraform_template']['output'],
+        st.session_state['tf_validation']['errors'],
+        callbacks=[StreamlitCallbackHandler(detailed_tab_generate), template_stream_writer(stream_cont)])
+      stream_cont.empty()
+    if repaired:
+      add_status_message(f"Repairing the failing blocks... {st.session_state['validate_retry_number']}/{MAX_RETRIES}",
+                         'info')
+      st.session_state['candidate_terraform_template'] = {'output': repaired}
+    else:
       # adding (not replacing) errors to be resolved
       st.session_state['previous_error'] = st.session_state.get('previous_error', '') \
-        + '\nKeep the names and components on the description, but solve the following error made while creating the previous template: ' \
-        + ". ".join(st.session_state['tf_validation']['errors'])
+        + nl2iac_pipeline.retry_error(st.session_state['tf_validation']['errors'])
       add_status_message(f"Retrying generation... {st.session_state['validate_retry_number']}/{MAX_RETRIES}", 'info')
       del st.session_state['candidate_terraform_template']
-      # restoring correct main.tf to be sure all terraform commands works
-      shutil.copyfile('main.tf.bk', 'main.tf')
+    # restoring correct main.tf to be sure all terraform commands works
+    nl2iac_workspace.reset_workspace(nl2iac_workspace.current_workdir())
 
 
-def deploy_template():
-  """Deploying the template."""
-  # calling the agent to deploy the template
-  st.session_state['terraform_template_deploy'] = st.session_state['tf_deployer_agent'].invoke(
-    {'user_message': [HumanMessage(
-      content='Deploy the already created Terraform template.')]},
-      config=RunnableConfig(callbacks=[StreamlitCallbackHandler(detailed_tab_deploy)]))
+def show_validated_template():
+  """Showing the validated template with its suggestions and the deploy button."""
+  # showing suggestions if any
+  if st.session_state['tf_validation']['suggestions']:
+    st.session_state['tf_validation_suggestions'] = "\n".join(st.session_state['tf_validation']['suggestions'])
+    st.session_state['code_exp'].info(
+      f"Improvement suggestions for the solution:\n {st.session_state['tf_validation_suggestions']}",
+      icon="ℹ️")
+  st.session_state['terraform_template'] = st.session_state['candidate_terraform_template']
+  # showing the validate template
+  st.session_state['code_exp'].code(st.session_state['candidate_terraform_template']['output'], language="json")
+  # creating a button to deploy the template
+  st.session_state['code_exp'].button('Deploy template', key='deploy_button', type='primary')
 
-  # as the output returned is a json let's format it
-  tmp_output = nl2iac_agent.clean_str(st.session_state['terraform_template_deploy']['output'])
-  tf_deploy_result = json.loads(tmp_output)
+
+def deploy_template():
+  """Deploying the validated template on a background job, the page isn't blocked while it runs."""
+  if 'terraform_template' not in st.session_state:
+    add_status_message("The validated template isn't available anymore, generate it again.", 'error')
+    return
+  # a deploy already pending on the session workspace is kept (reruns, double clicks)
+  st.session_state['deploy_job_id'] = nl2iac_jobs.get_queue().submit(
+    'deploy', st.session_state['workspace'], owner=st.session_state['session_id'],
+    trace_id=st.session_state['session_id'], settings=get_settings(),
+    template=st.session_state['terraform_template']['output'])
+  add_status_message(f"Deploy job {st.session_state['deploy_job_id']} queued.", 'info')
+
+
+def deploy_pending():
+  """True while the deploy job of the session is queued or running."""
+  if 'deploy_job_id' not in st.session_state:
+    return False
+  job = nl2iac_jobs.get_queue().status(st.session_state['deploy_job_id'])
+  return job is not None and job['status'] in nl2iac_jobs.JOB_PENDING_STATUSES
+
+
+@st.fragment(run_every=nl2iac_jobs.JOB_POLL_INTERVAL)
+def poll_deploy_job():
+  """Showing the progress of the deploy job, the whole app is rerun to show the result when it finishes."""
+  job = nl2iac_jobs.get_queue().status(st.session_state['deploy_job_id'])
+  if job is None or job['status'] not in nl2iac_jobs.JOB_PENDING_STATUSES:
+    st.rerun()
+  st.info(f"Deploy job {job['job_id']} {job['status']}...", icon="⏳")
+  if job['output']:
+    st.code('\n'.join(job['output'].splitlines()[-TERRAFORM_OUTPUT_LINES:]), language='text')
+
+
+def show_deploy_result(job):
+  """Showing the result of a finished deploy job."""
+  if job is None or job['status'] != 'done':
+    add_status_message("Error running the deploy job.", 'error')
+    finish_run('deploy_failed')
+    state_cont.error(f"Deploy job failed: {job['error'] if job else 'unknown job'}", icon="🚨")
+    return
+  st.session_state['terraform_template_deploy'] = {'output': job['result']}
+  detailed_tab_deploy.code(job['output'] or '', language='text')
+  tf_deploy_result = job['result']
   # keeping the state for the widgets
   st.session_state['code_exp'] = state_cont.expander('Generated Template', expanded=True)
   if tf_deploy_result['valid'] is True:
     # showing suggestions if available
     add_status_message("Terraform apply executed Ok.", 'success')
+    finish_run('deployed')
     st.session_state['code_exp'].success("Template is being deployed. Please check status on cloud. ", icon="✅")
 
   else:
     add_status_message("Error deploying template (errors above template).", 'error')
+    finish_run('deploy_failed')
     tmp_error = 'Error deploying template: ' + '. '.join(tf_deploy_result['errors'])
     st.session_state['code_exp'].error(tmp_error, icon="🚨")
     tmp_suggestions = 'Suggestions to solve the deployment errors: ' + '. '.join(tf_deploy_result['suggestions'])
@@ -201,11 +435,7 @@ def deploy_template():
 def deploy_template_gemini():
   """Deploying the template."""
   # creating a gemini model and binding the tools
-  model = nl2iac_agent.create_model(provider_id=st.session_state.provider_id,
-                                    model_id=st.session_state.model_id,
-                                    temperature=st.session_state.temperature,
-                                    region_id=st.session_state.region_id,
-                                    project_id=st.session_state.project_id)
+  model = nl2iac_agent.get_model(**nl2iac_agent.stage_settings('deployer', **get_settings()))
 
   gemini_tools = [nl2iac_agent.terraform_apply]
   model_with_tools = model.bind_tools(tools=gemini_tools)
@@ -237,31 +467,74 @@ def submit_on_change():
 
 def keeping_state_messages():
   """Keeping the app state showing widgets"""
-  # restoring status info tab
-  for m_text, m_type in st.session_state['history_status_message']:
-    add_status_message(m_text, m_type, save=False)
+  # restoring status info tab, just a page of the session status log
+  status_log = nl2iac_sessions.get_status_log()
+  pages = max(1, math.ceil(status_log.count(st.session_state['session_id']) / STATUS_PAGE_SIZE))
+  page = 1
+  if pages > 1:
+    page = status_tab_cont.number_input(f'Status page (1 is the latest, {pages} pages)', min_value=1,
+                                        max_value=pages, value=1, step=1, key='status_page')
+  for m_ts, m_text, m_type in status_log.page(st.session_state['session_id'], page - 1, STATUS_PAGE_SIZE):
+    add_status_message(m_text, m_type, save=False, timestamp=m_ts)
+
+
+def finish_run(status):
+  """Recording the final status of the current run on the status log."""
+  if 'run_id' in st.session_state:
+    nl2iac_sessions.get_status_log().finish_run(st.session_state['run_id'], status)
 
 
 def keeping_state_image():
   """Keeping the state for the image and description"""
   st.session_state['img_exp'] = image_cont.expander(label='Image uploaded.', expanded=True)
   st.session_state['img_exp'].image(uploaded_file, caption= "Content Image")
-  st.session_state['img_exp'].success(st.session_state['solution_description'], icon="✅")
+  if 'image_description' in st.session_state:
+    st.session_state['img_exp'].success(st.session_state['image_description'], icon="✅")
 
 
 def keeping_state_submit_button():
   """."""
-  if uploaded_file or user_input != '':
+  # an uploaded image needs its description (it may have failed), and nothing is generated while deploying
+  if deploy_pending():
+    st.session_state['submit_button_disabled'] = True
+  elif (uploaded_file and 'image_description' in st.session_state) or (not uploaded_file and user_input != ''):
     st.session_state['submit_button_disabled'] = False
   else:
     st.session_state['submit_button_disabled'] = True
 
 
-def new_agent_on_change_settings():
-  """Forcing to create new agents if some settings are modified"""
-  # whenever a setting is changed a new agent should be created
-  if 'tf_developer_agent' in st.session_state:
-    del st.session_state['tf_developer_agent']
+def get_settings():
+  """Model settings selected on the sidebar, as expected by the agents."""
+  return {'provider_id': st.session_state.provider_id, 'model_id': st.session_state.model_id,
+          'temperature': st.session_state.temperature, 'project_id': st.session_state.project_id,
+          'region_id': st.session_state.region_id}
+
+
+def get_agent(agent_name):
+  """Returning the agent (developer, validator or deployer) for the current settings, built on first use."""
+  return nl2iac_agent.get_agent(agent_name, **get_settings())
+
+
+def lease_workspace():
+  """Leasing a terraform workspace to the session (the same one if it already holds it).
+      Returns None, with an error on the status tab, if none is free after WORKSPACE_ACQUIRE_TIMEOUT seconds.
+  """
+  try:
+    st.session_state['workspace'] = nl2iac_workspace.get_pool().acquire(
+      st.session_state['session_id'], timeout=nl2iac_workspace.WORKSPACE_ACQUIRE_TIMEOUT)
+  except TimeoutError:
+    st.session_state.pop('workspace', None)
+    add_status_message("All the terraform workspaces are in use, try again in a few minutes.", 'error')
+  return st.session_state.get('workspace')
+
+
+def renew_workspace():
+  """Renewing the workspace lease of the session, if it still holds one (idle ones are released)."""
+  workspace = nl2iac_workspace.get_pool().renew(st.session_state['session_id'])
+  if workspace is None:
+    st.session_state.pop('workspace', None)
+  else:
+    st.session_state['workspace'] = workspace
 
 
 ##################################################
@@ -276,10 +549,6 @@ st.title("NL2IaC")
 if st.secrets['LANGCHAIN_API_KEY'] != "":
   client = Client()
 
-# initializing message history
-if 'history_status_message' not in st.session_state:
-  st.session_state['history_status_message'] = []
-
 # creating a side bar for config purposes
 if st.session_state['MULTIPROVIDER'] == "True":
   PROVIDERS = ['Google', 'OpenAI']
@@ -287,7 +556,7 @@ if st.session_state['MULTIPROVIDER'] == "True":
 with st.sidebar:
   st.markdown("<h1 style='text-align: center;'>Settings</h1>", unsafe_allow_html=True)
   st.radio("Choose provider to use:", PROVIDERS, horizontal=True,
-          key='provider_id', on_change=new_agent_on_change_settings)
+          key='provider_id')
   empty_model = st.empty()
   temperature_empty = st.empty()
 
@@ -296,19 +565,19 @@ with st.sidebar:
 
   if st.session_state.provider_id.lower() == 'openai':
     empty_model.text_input("Model Id: ", value=st.session_state['OPENAI_MODEL_ID'],
-                  key='model_id', on_change=new_agent_on_change_settings)
+                  key='model_id')
     temperature_empty.slider(label='Temperature', key='temperature',
               min_value=0.0, max_value=1.0, step=0.1,
-              value=TEMPERATURE, on_change=new_agent_on_change_settings)
+              value=TEMPERATURE)
     st.text_input("API KEY: ",
                   value=st.secrets["OPENAI_API_KEY"],
                   type="password", key='api_key')
   else:
     empty_model.text_input("Model Id: ", value=st.session_state['GOOGLE_MODEL_ID'],
-                  key='model_id', on_change=new_agent_on_change_settings)
+                  key='model_id')
     temperature_empty.slider(label='Temperature', key='temperature',
               min_value=0.0, max_value=2.0, step=0.1,
-              value=TEMPERATURE, on_change=new_agent_on_change_settings)
+              value=TEMPERATURE)
 
 # updating variables with the config provided values
 
@@ -318,20 +587,11 @@ if "parameters" not in st.session_state:
   st.session_state["parameters"] = f"""\nConfiguration:\nproject: {
     st.session_state['project_id']}, region: {st.session_state['region_id']}\n"""
 
-# creating LLM agents
-if "tf_developer_agent" not in st.session_state:
-  st.session_state['tf_developer_agent'] = nl2iac_agent.terraform_developer_agent(
-    provider_id=st.session_state.provider_id, model_id=st.session_state.model_id,
-    temperature=st.session_state.temperature, project_id=st.session_state.project_id,
-    region_id=st.session_state.region_id)
-  st.session_state['tf_validator_agent'] = nl2iac_agent.terraform_validator_agent(
-    provider_id=st.session_state.provider_id, model_id=st.session_state.model_id,
-    temperature=st.session_state.temperature, project_id=st.session_state.project_id,
-    region_id=st.session_state.region_id)
-  st.session_state['tf_deployer_agent'] = nl2iac_agent.terraform_deployer_agent(
-    provider_id=st.session_state.provider_id, model_id=st.session_state.model_id,
-    temperature=st.session_state.temperature, project_id=st.session_state.project_id,
-    region_id=st.session_state.region_id)
+if 'session_id' not in st.session_state:
+  st.session_state['session_id'] = uuid.uuid4().hex
+# bounding the memory of the sessions: idle ones lose their templates and results (and workspace),
+# the status messages are kept on the status log
+nl2iac_sessions.get_registry().touch(st.session_state['session_id'], get_script_run_ctx().session_state)
 
 # layout of the app
 main_col, info_col = st.columns([0.7, 0.3], gap='medium')
@@ -362,7 +622,8 @@ keeping_state_messages()
 
 # when a file has been uploaded
 if uploaded_file is not None:
-  upload_image_and_generate_description()
+  with nl2iac_metrics.trace(st.session_state['session_id']):
+    upload_image_and_generate_description()
   # keeping the state
   keeping_state_image()
 
@@ -375,34 +636,71 @@ with buttons_col:
                             disabled=st.session_state.get('submit_button_disabled', True))
   deploy_cont = st.empty()
 
-# if generate template button has been clicked
-EXIT_SUBMIT = False
-if submit_button:
-  while (not st.session_state.get('tf_validation_valid', False)) and (not EXIT_SUBMIT):
-    st.session_state['validate_retry_number'] = st.session_state.get('validate_retry_number', 0) + 1
-    generate_template()
-    validate_template()
-    if st.session_state.get('validate_retry_number', 0) >= MAX_RETRIES:
-      add_status_message(f"Template coudn't be validated after {MAX_RETRIES} retries.", 'error')
-      EXIT_SUBMIT = True
-
-  # resetting previous errors and restoring variables
+# an isolated terraform workspace is leased to the session when it submits or deploys
+# (and renewed on the next reruns), page loads without requests don't hold one
+if submit_button or st.session_state.get('deploy_button'):
+  lease_workspace()
+else:
+  renew_workspace()
+
+# terraform commands run on the session workspace, measures are traced by session
+with (nl2iac_workspace.use_workspace(st.session_state['workspace']) if 'workspace' in st.session_state
+      else nullcontext()), nl2iac_metrics.trace(st.session_state['session_id']):
+  # if generate template button has been clicked
   EXIT_SUBMIT = False
-  if 'previous_error' in st.session_state:
-    del st.session_state['previous_error']
-  if 'validate_retry_number' in st.session_state:
-    del st.session_state['validate_retry_number']
-  if 'tf_validation_valid' in st.session_state:
-    del st.session_state['tf_validation_valid']
-
-# deploying if clicked
-if ('deploy_button' in st.session_state) and (st.session_state.deploy_button):
-  #deploy_template_gemini()
-  try:
+  if submit_button and 'workspace' in st.session_state:
+    # the candidates are written (and the workspace reset) holding the workspace, never while a job applies it:
+    # the script doesn't wait for the lock, a deploy can take the whole apply timeout
+    try:
+      with nl2iac_workspace.workspace_lock(st.session_state['workspace'], blocking=False):
+        st.session_state['run_id'] = nl2iac_sessions.get_status_log().start_run(
+          st.session_state['session_id'], {'provider_id': st.session_state.provider_id,
+                                           'model_id': st.session_state.model_id, 'image': uploaded_file is not None})
+        # already validated templates for the same request are reused
+        if use_cached_template():
+          st.session_state['tf_validation_valid'] = True
+        while (not st.session_state.get('tf_validation_valid', False)) and (not EXIT_SUBMIT):
+          st.session_state['validate_retry_number'] = st.session_state.get('validate_retry_number', 0) + 1
+          # repaired templates are validated again instead of generating new candidates
+          try:
+            if SPECULATIVE_CANDIDATES > 1 and 'candidate_terraform_template' not in st.session_state:
+              generate_and_validate_speculative()
+            else:
+              generate_template()
+              validate_template()
+          except nl2iac_agent.AgentBudgetExceeded as e:
+            # the agent run was stopped by its context budget, retrying would fail the same way
+            add_status_message(f"Generation stopped: {e}", 'error')
+            finish_run('invalid')
+            break
+          if st.session_state.get('validate_retry_number', 0) >= MAX_RETRIES:
+            add_status_message(f"Template coudn't be validated after {MAX_RETRIES} retries.", 'error')
+            finish_run('invalid')
+            EXIT_SUBMIT = True
+
+        # resetting previous errors and restoring variables
+        EXIT_SUBMIT = False
+        if 'previous_error' in st.session_state:
+          del st.session_state['previous_error']
+        if 'validate_retry_number' in st.session_state:
+          del st.session_state['validate_retry_number']
+        if 'tf_validation_valid' in st.session_state:
+          del st.session_state['tf_validation_valid']
+    except nl2iac_workspace.WorkspaceBusy:
+      add_status_message("Deploy in progress on the session workspace, generate the template when it finishes.",
+                         'error')
+
+  # deploying if clicked
+  if ('deploy_button' in st.session_state) and (st.session_state.deploy_button) and ('workspace' in st.session_state):
+    #deploy_template_gemini()
     deploy_template()
-  except json.JSONDecodeError as e:
-    # restarting the retries count
-    if 'true' in nl2iac_agent.clean_str(st.session_state['terraform_template_deploy']['output']).lower():
-      # showing suggestions if available
-      add_status_message("Terraform apply executed Ok.", 'success')
-      st.session_state['code_exp'].success("Template is being deployed. Please check status on cloud. ", icon="✅")
+
+  # polling the deploy job until it finishes and then showing its result
+  if 'deploy_job_id' in st.session_state:
+    deploy_job = nl2iac_jobs.get_queue().status(st.session_state['deploy_job_id'])
+    if deploy_job and deploy_job['status'] in nl2iac_jobs.JOB_PENDING_STATUSES:
+      with state_cont:
+        poll_deploy_job()
+    else:
+      del st.session_state['deploy_job_id']
+      show_deploy_result(deploy_job)
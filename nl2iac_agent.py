@@ -1,25 +1,74 @@
 """Imports"""
 #import logging
-import subprocess
+import os
+import re
 import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
 # langchain
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.messages import SystemMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.tools import tool
 from langchain.agents import AgentExecutor, create_tool_calling_agent
-# Google
-from langchain_google_vertexai import ChatVertexAI, VertexAI, HarmBlockThreshold, HarmCategory
-# OpenAI
-from langchain_openai import ChatOpenAI, OpenAI
+from pydantic import BaseModel, Field
+# providers SDKs (Google, OpenAI) are imported by create_model when the provider is selected
+# nl2iac
+import nl2iac_cache
+import nl2iac_hcl
+import nl2iac_metrics
+import nl2iac_runner
+import nl2iac_schema
+import nl2iac_workspace
 
 
 ##################
 # terraform
 TERRAFORM_VALIDATE = ["terraform", "validate", "-no-color"]
+TERRAFORM_VALIDATE_JSON = ["terraform", "validate", "-json", "-no-color"]
 TERRAFORM_PLAN = ["terraform", "plan", "-no-color"]
 TERRAFORM_APPLY = ["terraform", "apply", "-auto-approve"]
-TERRAFORM_RESOURCES_DESCRIPTION = ["terraform", "providers", "schema", "-json"]
-TERRAFORM_RESOURCES_FILTER = ['google_compute_']
+# plans are saved during the validation and applied on deploy, see terraform_template_plan
+TERRAFORM_PARALLELISM = int(os.environ.get('NL2IAC_TERRAFORM_PARALLELISM', '10'))
+# refreshing the state on plan (and on apply when there's no saved plan)
+TERRAFORM_REFRESH = os.environ.get('NL2IAC_TERRAFORM_REFRESH', 'true').lower() != 'false'
+TERRAFORM_RESOURCES_FILTER = ['google_']
+# resources returned to the developer agent, the most relevant to the solution components
+TERRAFORM_RESOURCES_TOP_K = 30
+# agents context budget: iterations, seconds and tokens of an agent run (exceeding them fails the run),
+# tokens of every model call and tool outputs compacted before they are added to the scratchpad
+AGENT_MAX_ITERATIONS = int(os.environ.get('NL2IAC_AGENT_MAX_ITERATIONS', '8'))
+AGENT_MAX_EXECUTION_TIME = float(os.environ.get('NL2IAC_AGENT_MAX_EXECUTION_TIME', '600'))
+AGENT_MAX_TOKENS = int(os.environ.get('NL2IAC_AGENT_MAX_TOKENS', '200000'))
+AGENT_MAX_PROMPT_TOKENS = int(os.environ.get('NL2IAC_AGENT_MAX_PROMPT_TOKENS', '60000'))
+# answers of the agent executor stopped by max_iterations or max_execution_time
+AGENT_STOPPED_OUTPUTS = ('Agent stopped due to iteration limit or time limit.', 'Agent stopped due to max iterations.')
+# characters per token to estimate the prompt size before calling the model,
+# and tokens of every image part (their base64 data isn't text sent as tokens)
+CHARS_PER_TOKEN = 4
+IMAGE_PART_TOKENS = 1600
+IMAGE_PART_TYPES = ('image_url', 'image', 'media')
+TOOL_OUTPUT_MAX_CHARS = 6000
+# observations of the older steps are replaced by a note: the last steps are always kept
+SCRATCHPAD_KEEP_STEPS = 3
+SCRATCHPAD_MAX_CHARS = 24000
+# terraform output lines kept when compacting (and the next lines of context)
+TOOL_OUTPUT_KEY_LINES = re.compile(r'\b(error|warning)\b|^\s*(on \S+ line \d+|plan:|apply complete|success)',
+                                   re.IGNORECASE)
+TOOL_OUTPUT_CONTEXT_LINES = 4
+TOOL_OUTPUT_TAIL_LINES = 5
+# models and agents shared by sessions
+MODEL_POOL_SIZE = 8
+AGENT_POOL_SIZE = 24
+# models by stage (developer, validator, deployer, repair, planner): model_id, temperature and max_tokens
+# replacing the request ones, e.g. '{"validator": {"model_id": "gemini-1.5-flash", "max_tokens": 2048}}'
+STAGE_MODELS = json.loads(os.environ.get('NL2IAC_STAGE_MODELS', '{}'))
+# cascade: fast model by provider tried first by the stages in CASCADE_STAGES, the stage model
+# is used when it fails, e.g. '{"google": "gemini-1.5-flash", "openai": "gpt-4o-mini"}'
+CASCADE_MODELS = json.loads(os.environ.get('NL2IAC_CASCADE_MODELS', '{}'))
+CASCADE_STAGES = ('developer', 'validator')
 # logging
 LOGGING_FORMAT = "[%(asctime)s %(filename)s->%(funcName)s():%(lineno)s]%(levelname)s: %(message)s"
 
@@ -27,8 +76,8 @@ LOGGING_FORMAT = "[%(asctime)s %(filename)s->%(funcName)s():%(lineno)s]%(levelna
 PROMPT_TERRAFORM_DEVELOPER = """
   You're a Terraform seasoned developer being able to get information from terraform commands, to identify the terraform resources involved in a solution design, and to generate terraform templates.
   Always follow all these steps to the end:
-    1: Get a list of the allowed resources for the provider.
-    2: Identify all the Google cloud components mentioned on the solution provided by the user.
+    1: Identify all the Google cloud components mentioned on the solution provided by the user.
+    2: Get the allowed resources for the provider relevant to those components.
     3: Create a list of mandatory attributes' rules needed for the resources and include them on the terraform template.
     4: Generate a valid terraform template.
   
@@ -57,9 +106,8 @@ PROMPT_TERRAFORM_VALIDATOR = """
   - Check that all the required arguments indicated are included on the template.
   - To be considered valid a Terraform template must be correct, follow all the rules from the HCL language and be able to pass correctly the terraform validate and terraform plan command execution.
   - Based on the user description find suggestions about other components that can be added to improve the solution performance and security.
-  - Respond always using a valid python dict format with three elements: valid (use exactly True or False), errors (if any) and suggestions (a list of suggestions).
-  - Respond just with the valid JSON, don't add any other text. In the JSON data format, the keys must be enclosed in double quotes. Document must start with LEFT CURLY BRACKET character and end with the RIGHT CURLY BRACKET character
-  - The output must be just the JSON described above and cannot contain ```json nor ```.
+  - Always finish calling the report_verdict function with the result: valid (true or false), errors (if any) and suggestions (a list of suggestions).
+  - If you can't call report_verdict respond just with a JSON with the same three keys enclosed in double quotes, without any other text nor ```json.
   """
 
 PROMPT_TERRAFORM_DEPLOYER = """
@@ -68,20 +116,52 @@ PROMPT_TERRAFORM_DEPLOYER = """
   Deploy the terraform templates using the tools you have available.
 
   Guidelines:
-  - Respond always using a valid json with three elements: valid (use exactly True or False), suggestions (if any error is detected analyze it and provide a list of suggestions to solve it) and errors (a list of errors if any)
-  - Respond just with the valid json, don't add any other additional text.
+  - Always finish calling the report_verdict function with the result: valid (true if the deployment succeeded), errors (a list of errors if any) and suggestions (if any error is detected analyze it and provide a list of suggestions to solve it).
+  - If you can't call report_verdict respond just with a JSON with the same three keys enclosed in double quotes, without any other text.
+  """
+
+PROMPT_TERRAFORM_REPAIR = """
+  You're a Terraform seasoned developer fixing the blocks of a Terraform template that failed the validation.
+
+  Guidelines:
+    - Fix all the errors reported, keeping the names, labels and the correct arguments of every block.
+    - Follow the instructions on the required arguments for every resource.
+    - Be sure all the references point to blocks declared on the template. If a referenced block is missing add it.
+    - The output must be ONLY the complete fixed blocks, each one with its original type and labels, without any additional comment.
+    - Don't output ```hcl, ```terraform nor ```.
+  """
+
+PROMPT_TERRAFORM_SHARDS = """
+  You're a Google cloud architect splitting a solution design into component groups, so the Terraform blocks of every group can be written separately.
+
+  Guidelines:
+    - Use groups like network (VPCs, subnetworks, routers, NAT, addresses), firewall, compute (instances, templates, groups), storage, databases, load balancing or IAM, only the ones with components on the solution.
+    - Describe the components of every group with all the details on the solution: names, sizes, regions, images, ports and the components of other groups they connect to.
+    - List the Terraform addresses (resource_type.name) of the blocks of every group, using the same names on all the groups.
+    - Respond just with a valid JSON with one element: groups (a list of objects with name, description and resources), without any other text. The keys must be enclosed in double quotes.
+    - The output cannot contain ```json nor ```.
   """
 
 #######################################################
 #######################################################
 # external functions
 #######################################################
-def terraform_commands(command, command_type='exec'):
-  """checking with Terraform validate if the template is ok."""
-  terraform_execution = subprocess.run(command, capture_output=True, check=False)
+def terraform_commands(command, command_type='exec', workdir=None):
+  """checking with Terraform validate if the template is ok.
+      Runs on workdir, by default the workspace of the current session or job,
+      with a timeout and streaming its output to the current output handler.
+  """
+  terraform_execution = nl2iac_runner.run(command, cwd=workdir or nl2iac_workspace.current_workdir())
   #logger.debug(terraform_execution.stdout.decode())
+  return command_output(terraform_execution, command, command_type)
+
+
+def command_output(terraform_execution, command, command_type='exec'):
+  """Output of a terraform execution: the errors (empty if none) for 'exec', the stdout otherwise."""
   if command_type == 'exec':
-    if terraform_execution.returncode != 0:
+    if terraform_execution.timed_out:
+      val = f"'{' '.join(command)}' timed out after {terraform_execution.duration:.0f} seconds."
+    elif terraform_execution.returncode != 0:
       val = terraform_execution.stderr.decode().replace('\n\n', '.').replace('\n', '')
     else:
       val = ""
@@ -93,33 +173,20 @@ def terraform_commands(command, command_type='exec'):
 
 def get_available_terraform_resources(output_type: str):
   """Get the resources available for the terraform provider executing 
-      the command: terraform providers schema -json
+      the command: terraform providers schema -json (cached by provider version)
       Returns a list or a dict based on output_type
   """
   #logger.debug('Getting the resources available for the provider')
-  # getting the full list from terraform command as a dict
-  res_list_str = terraform_commands(TERRAFORM_RESOURCES_DESCRIPTION, 'desc')
-  provider_resources_dict = json.loads(res_list_str)['provider_schemas']\
-    ['registry.terraform.io/hashicorp/google']['resource_schemas']
-
-  # getting list of resources taking care of filters
-  output = ''
-  to_del = []
-  for resource in provider_resources_dict:
-    if any(f in resource for f in TERRAFORM_RESOURCES_FILTER):
-      output += resource + ', '
-    else:
-      to_del.append(resource)
+  # getting the filtered resources from the schema cache as a lazy dict
+  provider_resources_dict = nl2iac_schema.get_provider_schema(TERRAFORM_RESOURCES_FILTER,
+                                                             nl2iac_workspace.current_workdir())
 
   if output_type == "dict":
-    # deleting not needed resources
-    for k in to_del:
-      del provider_resources_dict[k]
     #returning a dict with all of the resources' properties
     return provider_resources_dict
 
   #returning a list with just the names
-  return output
+  return ''.join(resource + ', ' for resource in provider_resources_dict)
 
 
 #################################################
@@ -135,48 +202,322 @@ def clean_str(text: str) -> str:
             replace("\\n", "\n")
 
 
-def create_model(provider_id, model_id, temperature, region_id, project_id, model_type='chat'):
-  """creating the model to be used."""
-  # security settings default to NONE as we're not processing sensitive data
-  safety_settings = {
-    HarmCategory.HARM_CATEGORY_UNSPECIFIED: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-  }
+def compact_output(text: str, max_chars: int = TOOL_OUTPUT_MAX_CHARS) -> str:
+  """Compacting a long tool output once, before it's added to the agent scratchpad:
+      the errors and warnings (with the next lines of context) and then the last lines are kept,
+      then the first ones while there's room. The omitted lines are marked.
+  """
+  if not text or len(text) <= max_chars:
+    return text
+  # the errors of the exec commands are a single line: it's split by diagnostic and then by size
+  lines = []
+  for line in text.splitlines():
+    for part in [p for p in re.split(r'(?=(?:Error|Warning): )', line) if p] or ['']:
+      lines += [part[start:start + max_chars // 4] for start in range(0, len(part), max_chars // 4)] or ['']
+  # by priority: the key lines with their context, the last lines and the first ones
+  tail = range(max(0, len(lines) - TOOL_OUTPUT_TAIL_LINES), len(lines))
+  key = [n for number, line in enumerate(lines) if TOOL_OUTPUT_KEY_LINES.search(line)
+         for n in range(number, min(number + TOOL_OUTPUT_CONTEXT_LINES, len(lines)))]
+  keep, size = set(), 0
+  for number in [*key, *tail, *range(len(lines))]:
+    if number not in keep and size + len(lines[number]) + 1 <= max_chars:
+      keep.add(number)
+      size += len(lines[number]) + 1
+  output, omitted = [], 0
+  for number, line in enumerate(lines):
+    if number not in keep:
+      omitted += 1
+      continue
+    if omitted:
+      output.append(f'[... {omitted} lines omitted ...]')
+      omitted = 0
+    output.append(line)
+  if omitted:
+    output.append(f'[... {omitted} lines omitted ...]')
+  return '\n'.join(output)
+
+
+def trim_scratchpad(steps: list, keep_steps: int = SCRATCHPAD_KEEP_STEPS, max_chars: int = SCRATCHPAD_MAX_CHARS) -> list:
+  """Intermediate steps sent back to the model: the observations of the steps older than keep_steps,
+      and of the oldest ones while they exceed max_chars, are replaced by a note (the tool calls are kept,
+      so every call still has its result). The last step is never trimmed.
+  """
+  sizes = [len(str(observation)) for _, observation in steps]
+  total = sum(sizes)
+  trimmed = []
+  for number, (action, observation) in enumerate(steps):
+    stale = number < len(steps) - keep_steps or (total > max_chars and number < len(steps) - 1)
+    note = f'[{action.tool} output already used, {sizes[number]} characters omitted]'
+    if stale and sizes[number] > len(note):
+      total -= sizes[number] - len(note)
+      observation = note
+    trimmed.append((action, observation))
+  return trimmed
+
+
+def template_content(terraform_template: str) -> str:
+  """Content of the main.tf written for a template (the saved plans are named by it)."""
+  cleaned_terraform_template = terraform_template.replace("\\\\n", "\n").replace('\\"', '"')
+  return clean_str(cleaned_terraform_template)
+
+
+def write_terraform_template(terraform_template: str) -> str:
+  """Writing the template as the main.tf of the current workspace, returning the content written.
+      The file isn't written again if it already has the same content.
+  """
+  content = template_content(terraform_template)
+  template_path = os.path.join(nl2iac_workspace.current_workdir(), "main.tf")
+  try:
+    with open(template_path, encoding="utf-8") as file_template:
+      if file_template.read() == content:
+        return content
+  except FileNotFoundError:
+    pass
+  with open(template_path, "w", encoding="utf-8") as file_template:
+    file_template.write(content)
+  return content
+
+
+def terraform_template_command(command, terraform_template: str, command_type='exec', output_files=()):
+  """Writing the template on the current workspace and running a terraform command on it.
+      Outputs are memoized by command, template content and provider version (lock file),
+      so an identical template doesn't start terraform again. Timeouts aren't memoized.
+      A memoized success is only used if the output_files it produces exist on the workspace.
+  """
+  template = write_terraform_template(terraform_template)
+  workdir = nl2iac_workspace.current_workdir()
+  provider_key, _ = nl2iac_schema.lock_file_key(workdir, TERRAFORM_RESOURCES_FILTER)
+  cache = nl2iac_cache.get_terraform_result_cache(command[1])
+  key = nl2iac_cache.content_key(command, command_type, template, provider_key) if provider_key else None
+  cached = cache.get(key) if key else None
+  if cached is not None and (cached or all(os.path.exists(os.path.join(workdir, f)) for f in output_files)):
+    nl2iac_metrics.increment('nl2iac_terraform_memo_hits_total', event_type='terraform_memo', subcommand=command[1])
+    return cached
+
+  terraform_execution = nl2iac_runner.run(command, cwd=workdir)
+  output = command_output(terraform_execution, command, command_type)
+  if key and not terraform_execution.timed_out:
+    cache.set(key, output)
+  return output
+
+
+def saved_plan_file(template: str) -> str:
+  """Path (relative to the workspace) of the plan saved for a template content."""
+  return os.path.join(nl2iac_workspace.TERRAFORM_PLANS_DIR,
+                      hashlib.sha256(template.encode('utf-8')).hexdigest()[:32] + '.tfplan')
+
+
+def copy_saved_plan(terraform_template: str, source_workdir: str, target_workdir: str) -> bool:
+  """Copying the plan saved for a template from a workspace to another, False if there's none."""
+  plan_file = saved_plan_file(template_content(terraform_template))
+  if not os.path.exists(os.path.join(source_workdir, plan_file)):
+    return False
+  os.makedirs(os.path.join(target_workdir, nl2iac_workspace.TERRAFORM_PLANS_DIR), exist_ok=True)
+  shutil.copyfile(os.path.join(source_workdir, plan_file), os.path.join(target_workdir, plan_file))
+  return True
 
+
+def terraform_validate_diagnostics(terraform_template: str) -> list:
+  """Running terraform validate -json on the template, returning its error diagnostics."""
+  output = terraform_template_command(TERRAFORM_VALIDATE_JSON, terraform_template, 'desc')
+  try:
+    diagnostics = json.loads(output).get('diagnostics', [])
+  except ValueError:
+    return []
+  return [d for d in diagnostics if d.get('severity') == 'error']
+
+
+def prevalidate_template(terraform_template: str) -> list:
+  """Checking a template against the provider schema in-process, before the validator agent is called.
+      Returns the list of errors found, empty if none or if the schema isn't available.
+  """
+  try:
+    provider_resources_dict = get_available_terraform_resources("dict")
+  except (OSError, ValueError, KeyError):
+    # no terraform or provider schema available, terraform validate will do the job
+    return []
+  return nl2iac_hcl.prevalidate(clean_str(terraform_template), provider_resources_dict, TERRAFORM_RESOURCES_FILTER)
+
+
+def create_model(provider_id, model_id, temperature, region_id, project_id, model_type='chat', max_tokens=None):
+  """creating the model to be used, max_tokens caps its answers (None is the provider default)."""
   match provider_id.lower():
     case 'google':
+      from langchain_google_vertexai import ChatVertexAI, VertexAI, HarmBlockThreshold, HarmCategory
+      # security settings default to NONE as we're not processing sensitive data
+      safety_settings = {
+        HarmCategory.HARM_CATEGORY_UNSPECIFIED: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+      }
       if model_type == 'chat':
         model = ChatVertexAI(model_name=model_id, temperature=temperature,
                             project=project_id, location=region_id,
                             convert_system_message_to_human = False,
                             safety_settings=safety_settings,
-                            streaming = False,
+                            # tokens are passed to the callbacks as they are generated
+                            streaming = True,
                             max_retries = 3,
                             request_parallelism = 2,
                             #api_transport = 'rest',
-                            #max_output_tokens = 8192,
+                            max_output_tokens = max_tokens,
                             verbose=False)
       else:
         model = VertexAI(model_name=model_id, temperature=temperature,
                             project=project_id, location=region_id,
                             convert_system_message_to_human = False,
                             safety_settings=safety_settings,
+                            max_output_tokens = max_tokens,
                             verbose=True)
     case 'openai':
+      from langchain_openai import ChatOpenAI, OpenAI
       if model_type == 'chat':
         model = ChatOpenAI(model_name=model_id, temperature=temperature,
+                          streaming=True, stream_usage=True,
+                          max_tokens=max_tokens,
                           verbose=True)
       else:
         model = OpenAI(model_name=model_id, temperature=temperature,
+                          max_tokens=max_tokens if max_tokens is not None else 256,
                           verbose=True)
+    case 'scripted':
+      # replayed answers, used by the offline benchmark (nl2iac_bench.py)
+      from nl2iac_fakes import ScriptedChatModel
+      model = ScriptedChatModel(model_name=model_id)
 
   return model
 
 
-def create_agent(llm_model, agent_tools, system):
+def _pooled(pool, key, factory, max_size):
+  """Returning pool[key], creating it with factory if missing and evicting the least recently used."""
+  with _pools_lock:
+    if key in pool:
+      pool.move_to_end(key)
+      return pool[key]
+  value = factory()
+  with _pools_lock:
+    value = pool.setdefault(key, value)
+    pool.move_to_end(key)
+    while len(pool) > max_size:
+      pool.popitem(last=False)
+  return value
+
+
+def _credentials_key(provider_id):
+  """Part of the pools keys identifying the credentials read by the provider client (OpenAI API key)."""
+  if provider_id.lower() == 'openai':
+    return hashlib.sha256(os.environ.get('OPENAI_API_KEY', '').encode()).hexdigest()
+  return ''
+
+
+def get_model(provider_id, model_id, temperature, region_id, project_id, model_type='chat', max_tokens=None):
+  """Returning the model client for these settings, shared by all the agents and sessions."""
+  key = (provider_id.lower(), model_id, float(temperature), region_id, project_id, model_type, max_tokens,
+         _credentials_key(provider_id))
+  return _pooled(_models, key, lambda: create_model(provider_id, model_id, temperature, region_id=region_id,
+                                                    project_id=project_id, model_type=model_type,
+                                                    max_tokens=max_tokens),
+                 MODEL_POOL_SIZE)
+
+
+def cascade_enabled(stage, provider_id) -> bool:
+  """Whether stage tries the fast model of the provider before its own one."""
+  return stage in CASCADE_STAGES and provider_id.lower() in CASCADE_MODELS
+
+
+def stage_settings(stage, provider_id, model_id, temperature, project_id, region_id, fast=False) -> dict:
+  """Model settings of a pipeline stage: the request ones with the STAGE_MODELS overrides of the stage,
+      and the CASCADE_MODELS model of the provider if fast (and the stage cascades).
+  """
+  overrides = STAGE_MODELS.get(stage, {})
+  settings = {'provider_id': provider_id, 'model_id': overrides.get('model_id', model_id),
+              'temperature': overrides.get('temperature', temperature), 'project_id': project_id,
+              'region_id': region_id, 'max_tokens': overrides.get('max_tokens')}
+  if fast and cascade_enabled(stage, provider_id):
+    settings['model_id'] = CASCADE_MODELS[provider_id.lower()]
+  return settings
+
+
+class AgentBudgetExceeded(RuntimeError):
+  """An agent run reached its iterations, time or tokens ceiling before finishing."""
+
+
+def estimate_tokens(messages) -> int:
+  """Estimated prompt tokens of messages: the text parts and tool calls by CHARS_PER_TOKEN
+      and IMAGE_PART_TOKENS for every image part.
+  """
+  chars, images = 0, 0
+  for message in messages:
+    parts = message.content if isinstance(message.content, list) else [message.content]
+    for part in parts:
+      if isinstance(part, dict) and part.get('type') in IMAGE_PART_TYPES:
+        images += 1
+      elif isinstance(part, dict) and part.get('type') == 'text':
+        chars += len(part.get('text') or '')
+      else:
+        chars += len(str(part))
+    chars += len(str(getattr(message, 'tool_calls', '') or ''))
+  return chars // CHARS_PER_TOKEN + images * IMAGE_PART_TOKENS
+
+
+class TokenBudgetHandler(BaseCallbackHandler):
+  """Failing an agent run before a model call with a prompt over max_prompt_tokens (estimated)
+      and after the call making the run exceed max_tokens (reported by the provider).
+  """
+  raise_error = True
+
+  def __init__(self, agent_name, max_tokens=AGENT_MAX_TOKENS, max_prompt_tokens=AGENT_MAX_PROMPT_TOKENS):
+    self.agent_name = agent_name
+    self.max_tokens = max_tokens
+    self.max_prompt_tokens = max_prompt_tokens
+    self.tokens = 0
+
+  def on_chat_model_start(self, serialized, messages, **kwargs):
+    prompt_tokens = sum(estimate_tokens(batch) for batch in messages)
+    if prompt_tokens > self.max_prompt_tokens:
+      nl2iac_metrics.increment('nl2iac_agent_budget_exceeded_total', agent=self.agent_name, reason='prompt_tokens')
+      raise AgentBudgetExceeded(f'The {self.agent_name} agent prompt has about {prompt_tokens} tokens, '
+                                f'over the {self.max_prompt_tokens} tokens allowed by model call.')
+
+  def on_llm_end(self, response, **kwargs):
+    self.tokens += sum(nl2iac_metrics.response_tokens(response))
+    if self.tokens > self.max_tokens:
+      nl2iac_metrics.increment('nl2iac_agent_budget_exceeded_total', agent=self.agent_name, reason='tokens')
+      raise AgentBudgetExceeded(f'The {self.agent_name} agent used {self.tokens} tokens, '
+                                f'over the {self.max_tokens} tokens allowed by run.')
+
+
+class BudgetedAgentExecutor(AgentExecutor):
+  """Agent executor enforcing the context budget: the tool outputs on the scratchpad are trimmed
+      (see trim_scratchpad) and reaching the iterations, time or tokens ceiling raises AgentBudgetExceeded
+      instead of returning a partial answer.
+  """
+  agent_name: str = 'agent'
+  max_tokens: int = AGENT_MAX_TOKENS
+  max_prompt_tokens: int = AGENT_MAX_PROMPT_TOKENS
+
+  def invoke(self, input, config=None, **kwargs):  # pylint: disable=redefined-builtin
+    # the executors are shared by sessions, the tokens are counted by run
+    config = dict(config or {})
+    callbacks = config.get('callbacks') or []
+    budget = TokenBudgetHandler(self.agent_name, self.max_tokens, self.max_prompt_tokens)
+    if isinstance(callbacks, list):
+      config['callbacks'] = [*callbacks, budget]
+    else:
+      callbacks = callbacks.copy()
+      callbacks.add_handler(budget)
+      config['callbacks'] = callbacks
+    output = super().invoke(input, config, **kwargs)
+    if output.get('output') in AGENT_STOPPED_OUTPUTS:
+      nl2iac_metrics.increment('nl2iac_agent_budget_exceeded_total', agent=self.agent_name, reason='iterations')
+      raise AgentBudgetExceeded(f'The {self.agent_name} agent didn\'t finish after {self.max_iterations} '
+                                f'iterations or {self.max_execution_time} seconds.')
+    return output
+
+
+def create_agent(llm_model, agent_tools, system, name='agent'):
   """creating an agent working node with a name and tools."""
   prompt = ChatPromptTemplate.from_messages(
     [
@@ -187,20 +528,33 @@ def create_agent(llm_model, agent_tools, system):
   )
   # creating the agent and the executor with the tools
   agent = create_tool_calling_agent(llm=llm_model, tools=agent_tools, prompt=prompt)
-  executor = AgentExecutor(agent=agent, tools=agent_tools, return_intermediate_steps=False,
-                           verbose=True, early_stopping_method='forced')
+  executor = BudgetedAgentExecutor(agent=agent, tools=agent_tools, return_intermediate_steps=False,
+                                   verbose=True, early_stopping_method='force', agent_name=name,
+                                   max_iterations=AGENT_MAX_ITERATIONS, max_execution_time=AGENT_MAX_EXECUTION_TIME,
+                                   trim_intermediate_steps=trim_scratchpad)
   return executor
 
 
+_models = OrderedDict()
+_agents = OrderedDict()
+_pools_lock = threading.Lock()
+
+
 #################################################
 ## Tools for the agents
 #################################################
 @tool
-def get_provider_resources() -> dict:
-  """Return a list of allowed resources by the provider to be used on the templates.
+def get_provider_resources(components: str) -> dict:
+  """Return the allowed resources by the provider most relevant to the solution components, to be used on the templates.
+
+      Args:
+        components: the Google cloud components of the solution, e.g. 'vpc network, subnetwork, vm instances, sql database'.
   """
   #logger.info('(tool) Getting a list of the resources')
-  output = get_available_terraform_resources("list")
+  # ranking the resources by relevance instead of returning all of them
+  resources = nl2iac_schema.search_resources(get_available_terraform_resources("dict"), components,
+                                             TERRAFORM_RESOURCES_TOP_K)
+  output = ''.join(resource + ', ' for resource in resources)
   #logger.debug('(tool) Provider resources: %s', output)
   # returning a string with the resources
   return {'available_resources': output}
@@ -218,32 +572,21 @@ def get_required_arguments_list(resources_names: str) -> dict:
   # creating a list os resources
   #logger.debug('Input string. resources_names: %s', resources_names)
     # taking care of wrong inputs
-  resources_names.replace("'", '"')
+  resources_names = resources_names.replace("'", '"')
   if "[" not in resources_names:
     resources_names = '[' + resources_names + ']'
 
   list_resources = json.loads(resources_names)
-  # getting REQUIRED arguments and blocks for every resource
-  # calling the aux function
-  resources_dict = get_available_terraform_resources("dict")
-  output = ''
-  for resource in list_resources:
-    res = [a for a, obj in (
-      resources_dict[resource]['block']['block_types']).items()
-      if 'min_items' in obj]
-    res += [a for a, obj in (
-      resources_dict[resource]['block']['attributes']).items()
-      if 'required' in obj]
-    output += '\nresource ' + resource + ' mandatory requires ' + ','.join(res) + ' as arguments.'
-    # some blocks have required arguments
-    blocks_required_arguments = [(k, k2)  for k, v in (
-      resources_dict[resource]['block']['block_types']).items()
-      for k2, v2 in v['block']['attributes'].items() if 'required' in v2 ]
-    if blocks_required_arguments:
-      for block, argument in blocks_required_arguments:
-        output += 'If Block ' + block + ' is being used within ' \
-          + resource + ' it mandatory requires ' + argument + ' argument.'
+  # getting REQUIRED arguments and blocks (at any depth) for every resource from the precomputed index
+  required_index = nl2iac_schema.get_required_arguments_index(get_available_terraform_resources("dict"))
+  output = []
+  for resource in dict.fromkeys(list_resources):
+    if resource not in required_index:
+      output.append(f'resource {resource} is not available for the provider.')
+    else:
+      output += [rule for rule in required_index[resource] if rule not in output]
 
+  output = '\n'.join(output)
   return {'attributes_rules': output}
 
 
@@ -255,14 +598,10 @@ def terraform_template_validate(terraform_template: str) -> dict:
         terraform_template: A string containing the terraform template to be validated.
   """
   #logger.info('terraform_template_validation EXECUTION')
-  # to use terraform validate a file must be created on the local system
-  cleaned_terraform_template = terraform_template.replace("\\\\n", "\n").replace('\\"', '"')
-  with open("main.tf", "w", encoding="utf-8") as file_template:
-    file_template.write(clean_str(cleaned_terraform_template))
-
-  validation_errors = terraform_commands(TERRAFORM_VALIDATE)
+  # to use terraform validate a file must be created on the local system (memoized by template)
+  validation_errors = terraform_template_command(TERRAFORM_VALIDATE, terraform_template)
   if validation_errors != '':
-    return {'validation_errors_terraform': validation_errors }
+    return {'validation_errors_terraform': compact_output(validation_errors)}
 
   return {'validation_errors_terraform': None}
 
@@ -275,14 +614,15 @@ def terraform_template_plan(terraform_template: str) -> dict:
         terraform_template: A string containing the terraform template to be validated.
   """
   #logger.info('terraform_template_validation EXECUTION')
-  # to use terraform validate a file must be created on the local system
-  cleaned_terraform_template = terraform_template.replace("\\\\n", "\n").replace('\\"', '"')
-  with open("main.tf", "w", encoding="utf-8") as file_template:
-    file_template.write(clean_str(cleaned_terraform_template))
-
-  validation_errors = terraform_commands(TERRAFORM_PLAN)
+  # to use terraform plan a file must be created on the local system (memoized by template)
+  # the plan is saved for the template content, so the deploy applies exactly what was validated
+  plan_file = saved_plan_file(write_terraform_template(terraform_template))
+  os.makedirs(os.path.join(nl2iac_workspace.current_workdir(), nl2iac_workspace.TERRAFORM_PLANS_DIR), exist_ok=True)
+  command = TERRAFORM_PLAN + [f'-parallelism={TERRAFORM_PARALLELISM}', f'-refresh={str(TERRAFORM_REFRESH).lower()}',
+                              f'-out={plan_file}']
+  validation_errors = terraform_template_command(command, terraform_template, output_files=[plan_file])
   if validation_errors != '':
-    return {'validation_errors_terraform': validation_errors }
+    return {'validation_errors_terraform': compact_output(validation_errors)}
 
   return {'validation_errors_terraform': None}
 
@@ -292,35 +632,78 @@ def terraform_apply():
   """ Deploy an already created main.tf template using the 'Terraform Apply' command.
   """
   #logger.info('terraform_apply EXECUTION')
+  # applying the plan saved when the current main.tf was validated, without planning again
+  workdir = nl2iac_workspace.current_workdir()
+  with open(os.path.join(workdir, "main.tf"), encoding="utf-8") as file_template:
+    plan_file = saved_plan_file(file_template.read())
+  command = TERRAFORM_APPLY + [f'-parallelism={TERRAFORM_PARALLELISM}']
+  if os.path.exists(os.path.join(workdir, plan_file)):
+    deployment_errors = terraform_commands(command + ['-no-color', plan_file])
+    if 'Saved plan is stale' not in deployment_errors:
+      return {'deployment_errors' : compact_output(deployment_errors)}
   # getting the full list from terraform command as a dict
-  deployment_errors = terraform_commands(TERRAFORM_APPLY)
-  return {'deployment_errors' : deployment_errors}
+  deployment_errors = terraform_commands(command + [f'-refresh={str(TERRAFORM_REFRESH).lower()}'])
+  return {'deployment_errors' : compact_output(deployment_errors)}
+
+
+class Verdict(BaseModel):
+  """Result of the validation or the deployment of a template."""
+  valid: bool = Field(description='true if the template is correct (validation) or was deployed (deploy)')
+  errors: list[str] = Field(default_factory=list, description='errors found, if any')
+  suggestions: list[str] = Field(default_factory=list, description='suggestions to solve the errors or improve the template')
+
+
+@tool(args_schema=Verdict, return_direct=True)
+def report_verdict(valid: bool, errors: list[str] = None, suggestions: list[str] = None) -> dict:
+  """Report the final result of the validation or the deployment. Always call it as the last step."""
+  # returned directly as the agent output, the verdict is never parsed from the model text
+  return {'valid': valid, 'errors': errors or [], 'suggestions': suggestions or []}
 
 
 #################################################
 # agents
 #################################################
-def terraform_developer_agent(provider_id, model_id, temperature, project_id, region_id):
+def terraform_developer_agent(provider_id, model_id, temperature, project_id, region_id, max_tokens=None):
   """Terraform developer agent designed to identify components and resources and generate templates."""
-  llm = create_model(provider_id, model_id, temperature, project_id=project_id, region_id=region_id)
+  llm = get_model(provider_id, model_id, temperature, project_id=project_id, region_id=region_id,
+                  max_tokens=max_tokens)
   tools = [get_provider_resources, get_required_arguments_list]
-  agent = create_agent(llm_model=llm, agent_tools=tools,system=PROMPT_TERRAFORM_DEVELOPER)
+  agent = create_agent(llm_model=llm, agent_tools=tools,system=PROMPT_TERRAFORM_DEVELOPER, name='developer')
   return agent
 
 
-def terraform_validator_agent(provider_id, model_id, temperature, project_id, region_id):
+def terraform_validator_agent(provider_id, model_id, temperature, project_id, region_id, max_tokens=None):
   """Terraform agent designed to validate and suggest improvements an already generated template."""
-  llm = create_model(provider_id, model_id, temperature, project_id=project_id, region_id=region_id)
-  tools = [terraform_template_validate, terraform_template_plan]
-  agent = create_agent(llm_model=llm, agent_tools=tools, system=PROMPT_TERRAFORM_VALIDATOR)
+  llm = get_model(provider_id, model_id, temperature, project_id=project_id, region_id=region_id,
+                  max_tokens=max_tokens)
+  tools = [terraform_template_validate, terraform_template_plan, report_verdict]
+  agent = create_agent(llm_model=llm, agent_tools=tools, system=PROMPT_TERRAFORM_VALIDATOR, name='validator')
   return agent
 
 
-def terraform_deployer_agent(provider_id, model_id, temperature, project_id, region_id):
+def terraform_deployer_agent(provider_id, model_id, temperature, project_id, region_id, max_tokens=None):
   """Terraform agent designed to deploy the already generated and validated template."""
-  llm = create_model(provider_id, model_id, temperature, project_id=project_id, region_id=region_id)
-  tools = [terraform_apply]
-  agent = create_agent(llm_model=llm, agent_tools=tools, system=PROMPT_TERRAFORM_DEPLOYER)
+  llm = get_model(provider_id, model_id, temperature, project_id=project_id, region_id=region_id,
+                  max_tokens=max_tokens)
+  tools = [terraform_apply, report_verdict]
+  agent = create_agent(llm_model=llm, agent_tools=tools, system=PROMPT_TERRAFORM_DEPLOYER, name='deployer')
   return agent
+
+
+AGENTS = {
+  'developer': terraform_developer_agent,
+  'validator': terraform_validator_agent,
+  'deployer': terraform_deployer_agent,
+}
+
+
+def get_agent(agent_name, provider_id, model_id, temperature, project_id, region_id, fast=False):
+  """Returning the agent for these settings, built on first use and shared by sessions.
+      The agent uses the model of its stage (see stage_settings), the fast one of the cascade if fast.
+  """
+  settings = stage_settings(agent_name, provider_id, model_id, temperature, project_id, region_id, fast=fast)
+  key = (agent_name, provider_id.lower(), settings['model_id'], float(settings['temperature']), project_id,
+         region_id, settings['max_tokens'], _credentials_key(provider_id))
+  return _pooled(_agents, key, lambda: AGENTS[agent_name](**settings), AGENT_POOL_SIZE)
 # logger = logging.getLogger(__name__)
 # logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
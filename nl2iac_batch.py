@@ -0,0 +1,132 @@
+"""Imports"""
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# nl2iac
+import nl2iac_metrics
+import nl2iac_pipeline
+import nl2iac_workspace
+
+
+##################
+# batch
+BATCH_CONCURRENCY = 4
+# fields accepted on the requests file for the id and the architecture description
+ID_FIELDS = ('id', 'request_id')
+DESCRIPTION_FIELDS = ('description', 'body')
+# statuses not processed again when resuming
+DONE_STATUSES = ('valid', 'invalid', 'deployed', 'deploy_failed')
+
+
+#######################################################
+#######################################################
+# functions
+#######################################################
+def read_requests(path):
+  """Reading the architecture requests from a jsonl file."""
+  requests = []
+  with open(path, encoding='utf-8') as requests_file:
+    for number, line in enumerate(requests_file, start=1):
+      if not line.strip():
+        continue
+      request = json.loads(line)
+      request_id = next((str(request[f]) for f in ID_FIELDS if f in request), str(number))
+      description = next((request[f] for f in DESCRIPTION_FIELDS if f in request), None)
+      if description is None:
+        raise ValueError(f'{path}:{number} has no description field ({", ".join(DESCRIPTION_FIELDS)}).')
+      requests.append({'id': request_id, 'description': description, 'parameters': request.get('parameters')})
+  return requests
+
+
+def read_done(path):
+  """Ids already processed on a previous run of the same results file."""
+  done = set()
+  if not os.path.exists(path):
+    return done
+  with open(path, encoding='utf-8') as results_file:
+    for line in results_file:
+      try:
+        result = json.loads(line)
+      except json.JSONDecodeError:
+        # last line of an interrupted run
+        continue
+      if result.get('status') in DONE_STATUSES:
+        done.add(result['id'])
+  return done
+
+
+def process_request(request, settings, args, pool):
+  """Processing one request on its own workspace, errors are returned as results."""
+  parameters = request['parameters'] or \
+    f"\nConfiguration:\nproject: {settings['project_id']}, region: {settings['region_id']}\n"
+  started = time.monotonic()
+  try:
+    with pool.lease(owner=f"batch-{request['id']}"), nl2iac_metrics.trace(request['id']):
+      result = nl2iac_pipeline.run_request(request['description'], parameters, settings,
+                                           max_retries=args.max_retries, deploy=args.deploy,
+                                           candidates=args.candidates, sharded=args.sharded)
+  except Exception as e:  # pylint: disable=broad-except
+    result = {'status': 'error', 'errors': [f'{type(e).__name__}: {e}'], 'traceback': traceback.format_exc(),
+              'timings': {'total': time.monotonic() - started}}
+  return {'id': request['id'], **result}
+
+
+def parse_args(argv=None):
+  """Command line arguments, settings default to the same environment variables of the app secrets."""
+  parser = argparse.ArgumentParser(description='Generate, validate and optionally deploy terraform templates '
+                                               'for a jsonl file of architecture requests.')
+  parser.add_argument('requests', help='jsonl file, one request per line with an id and a description')
+  parser.add_argument('-o', '--output', default='results.jsonl', help='jsonl results file (default: %(default)s)')
+  parser.add_argument('-c', '--concurrency', type=int, default=BATCH_CONCURRENCY,
+                      help='requests processed at the same time (default: %(default)s)')
+  parser.add_argument('--deploy', action='store_true', help='deploy the validated templates')
+  parser.add_argument('--no-resume', dest='resume', action='store_false',
+                      help='process again the requests already on the results file')
+  parser.add_argument('--max-retries', type=int, default=nl2iac_pipeline.MAX_RETRIES)
+  parser.add_argument('--candidates', type=int, default=nl2iac_pipeline.SPECULATIVE_CANDIDATES,
+                      help='candidates generated and validated concurrently on every round (default: %(default)s)')
+  parser.add_argument('--sharded', action='store_true',
+                      help='generate the templates by component groups concurrently')
+  parser.add_argument('--metrics-port', type=int,
+                      help='serve the prometheus metrics on this local port while running')
+  parser.add_argument('--provider', default='Google', choices=['Google', 'OpenAI'])
+  parser.add_argument('--model', default=os.environ.get('GOOGLE_MODEL_ID', 'gemini-1.5-flash'))
+  parser.add_argument('--temperature', type=float, default=0.0)
+  parser.add_argument('--project', default=os.environ.get('PROJECT_ID'))
+  parser.add_argument('--region', default=os.environ.get('REGION'))
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  """Running the batch pipeline, appending a result line per request as soon as it finishes."""
+  args = parse_args(argv)
+  settings = {'provider_id': args.provider, 'model_id': args.model, 'temperature': args.temperature,
+              'project_id': args.project, 'region_id': args.region}
+  requests = read_requests(args.requests)
+  done = read_done(args.output) if args.resume else set()
+  pending = [r for r in requests if r['id'] not in done]
+  print(f'{len(pending)} requests to process ({len(requests) - len(pending)} already done).', file=sys.stderr)
+
+  if args.metrics_port:
+    nl2iac_metrics.start_http_server(args.metrics_port)
+  pool = nl2iac_workspace.get_pool()
+  with open(args.output, 'a', encoding='utf-8') as results_file, \
+       ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+    futures = [executor.submit(process_request, r, settings, args, pool) for r in pending]
+    for future in as_completed(futures):
+      result = future.result()
+      results_file.write(json.dumps(result) + '\n')
+      results_file.flush()
+      print(f"{result['id']}: {result['status']} ({result['timings']['total']:.1f}s)", file=sys.stderr)
+
+  nl2iac_metrics.export_prometheus()
+  print(f'Metrics: {nl2iac_metrics.PROMETHEUS_FILE}, trace: {nl2iac_metrics.TRACE_FILE}', file=sys.stderr)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,237 @@
+"""Imports"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import contextlib
+import tempfile
+import resource
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+##################
+# benchmark
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench')
+BENCH_CORPUS = os.path.join(BENCH_DIR, 'corpus.jsonl')
+BENCH_ITERATIONS = 5
+BENCH_WARMUP = 1
+BENCH_TERRAFORM_LATENCY = 0.05
+PERCENTILES = (50, 90, 99)
+# provider version written on the lock file of the benchmark workspaces
+BENCH_LOCK_FILE = '''provider "registry.terraform.io/hashicorp/google" {
+  version     = "0.0.0-bench"
+  constraints = ">= 0.0.0"
+}
+'''
+
+
+#######################################################
+#######################################################
+# functions
+#######################################################
+def percentile(values, p):
+  """Nearest rank percentile, None for no values."""
+  values = sorted(values)
+  if not values:
+    return None
+  return values[max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))]
+
+
+def distribution(values) -> dict:
+  """Percentiles, mean and max of a list of measures."""
+  stats = {f'p{p}': percentile(values, p) for p in PERCENTILES}
+  stats.update(mean=sum(values) / len(values) if values else None, max=max(values, default=None), n=len(values))
+  return stats
+
+
+def prepare_environment(workdir, terraform_latency):
+  """Isolating the caches, workspaces and metrics of the benchmark on workdir and putting
+      the stub terraform first on the PATH. Must run before the nl2iac modules are imported.
+  """
+  base_dir = os.path.join(workdir, 'base')
+  os.makedirs(base_dir)
+  shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.tf.bk'),
+                  os.path.join(base_dir, 'main.tf.bk'))
+  with open(os.path.join(base_dir, '.terraform.lock.hcl'), 'w', encoding='utf-8') as lock_file:
+    lock_file.write(BENCH_LOCK_FILE)
+  os.environ.update({
+    'NL2IAC_CACHE_DIR': os.path.join(workdir, 'cache'),
+    'NL2IAC_WORKSPACE_BASE_DIR': base_dir,
+    'NL2IAC_WORKSPACES_DIR': os.path.join(workdir, 'workspaces'),
+    'NL2IAC_METRICS_DIR': os.path.join(workdir, 'metrics'),
+    'NL2IAC_BENCH_TERRAFORM_LATENCY': str(terraform_latency),
+    'PATH': BENCH_DIR + os.pathsep + os.environ.get('PATH', ''),
+  })
+
+
+def read_corpus(path):
+  """Architectures of the benchmark: id, description, templates and the script of every role."""
+  with open(path, encoding='utf-8') as corpus_file:
+    return [json.loads(line) for line in corpus_file if line.strip()]
+
+
+def run_case(case, run_id, args):
+  """Running the whole pipeline for a corpus architecture with its scripted models."""
+  # imported after prepare_environment
+  import nl2iac_fakes  # pylint: disable=import-outside-toplevel
+  import nl2iac_metrics  # pylint: disable=import-outside-toplevel
+  import nl2iac_pipeline  # pylint: disable=import-outside-toplevel
+  import nl2iac_workspace  # pylint: disable=import-outside-toplevel
+  settings = {'provider_id': 'scripted', 'model_id': 'replay', 'project_id': 'bench-project',
+              'region_id': 'us-central1',
+              # templates are only cached at temperature 0, every run goes through the whole pipeline
+              'temperature': 0.1}
+  started = time.monotonic()
+  try:
+    with nl2iac_workspace.get_pool().lease(owner=run_id), nl2iac_metrics.trace(run_id), \
+         nl2iac_fakes.use_script(nl2iac_fakes.Script(case['script'], case.get('templates'))):
+      result = nl2iac_pipeline.run_request(case['description'], '\nConfiguration:\nproject: bench-project, '
+                                           'region: us-central1\n', settings, max_retries=args.max_retries,
+                                           deploy=args.deploy, candidates=1)
+  except Exception as e:  # pylint: disable=broad-except
+    result = {'status': 'error', 'errors': [f'{type(e).__name__}: {e}'], 'retries': 0, 'repairs': 0}
+  return {'id': case['id'], 'run_id': run_id, 'status': result['status'], 'errors': result['errors'],
+          'retries': result['retries'], 'repairs': result.get('repairs', 0),
+          'latency': time.monotonic() - started}
+
+
+def read_trace(path, run_ids) -> dict:
+  """Trace events of the measured runs, grouped by run id."""
+  events = defaultdict(list)
+  with open(path, encoding='utf-8') as trace_file:
+    for line in trace_file:
+      event = json.loads(line)
+      if event['trace_id'] in run_ids:
+        events[event['trace_id']].append(event)
+  return events
+
+
+def build_report(runs, events, elapsed, memory_peak) -> dict:
+  """Latency percentiles, subprocess and model calls, retries and memory peaks of the runs."""
+  stages = defaultdict(list)
+  per_run = defaultdict(list)
+  for run in runs:
+    run_events = events.get(run['run_id'], [])
+    for event in run_events:
+      if event['type'] == 'stage':
+        stages[event['stage']].append(event['value'])
+    per_run['terraform_subprocesses'].append(sum(e['type'] == 'terraform' for e in run_events))
+    per_run['terraform_seconds'].append(sum(e['value'] for e in run_events if e['type'] == 'terraform'))
+    # terraform commands answered by the memoized results, they don't start a subprocess
+    per_run['terraform_memo_hits'].append(sum(e['type'] == 'terraform_memo' for e in run_events))
+    per_run['llm_calls'].append(sum(e['type'] == 'llm' for e in run_events))
+    per_run['tool_calls'].append(sum(e['type'] == 'tool' for e in run_events))
+    # orchestration time: the run latency not spent on terraform nor on the (simulated) model
+    per_run['orchestration_seconds'].append(
+      run['latency'] - per_run['terraform_seconds'][-1]
+      - sum(e['value'] for e in run_events if e['type'] == 'llm'))
+  statuses = defaultdict(int)
+  for run in runs:
+    statuses[run['status']] += 1
+  return {
+    'runs': len(runs), 'elapsed': elapsed, 'throughput': len(runs) / elapsed if elapsed else None,
+    'statuses': dict(statuses),
+    'latency': distribution([r['latency'] for r in runs]),
+    'stages': {name: distribution(values) for name, values in sorted(stages.items())},
+    **{name: distribution(values) for name, values in per_run.items()},
+    'retries': distribution([r['retries'] for r in runs]),
+    'repairs': distribution([r['repairs'] for r in runs]),
+    'memory': {'python_peak_bytes': memory_peak,
+               # kilobytes on linux
+               'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024},
+    'failures': [{'run_id': r['run_id'], 'status': r['status'], 'errors': r['errors']}
+                 for r in runs if r['status'] not in ('valid', 'deployed')],
+  }
+
+
+def print_report(report):
+  """Human readable summary of the report."""
+  def row(name, stats, unit=''):
+    values = '  '.join(f"{k}={v:.3f}{unit}" if isinstance(v, float) else f'{k}={v}'
+                       for k, v in stats.items() if v is not None)
+    print(f'{name:<28}{values}')
+
+  print(f"{report['runs']} runs in {report['elapsed']:.2f}s ({report['throughput']:.2f} runs/s) "
+        f"statuses: {report['statuses']}")
+  row('latency', report['latency'], 's')
+  for name, stats in report['stages'].items():
+    row(f'  stage {name}', stats, 's')
+  for name in ('orchestration_seconds', 'terraform_seconds', 'terraform_subprocesses', 'terraform_memo_hits',
+               'llm_calls', 'tool_calls', 'retries', 'repairs'):
+    row(name, report[name])
+  print(f"memory: python peak {report['memory']['python_peak_bytes'] / 2**20:.1f}MB, "
+        f"max rss {report['memory']['max_rss_bytes'] / 2**20:.1f}MB")
+  for failure in report['failures']:
+    print(f"FAILED {failure['run_id']}: {failure['status']} {failure['errors']}")
+
+
+def parse_args(argv=None):
+  """Command line arguments."""
+  parser = argparse.ArgumentParser(description='Offline benchmark of the nl2iac pipeline: scripted models and '
+                                               'a stub terraform, no network nor credentials needed.')
+  parser.add_argument('corpus', nargs='?', default=BENCH_CORPUS, help='jsonl corpus (default: %(default)s)')
+  parser.add_argument('-n', '--iterations', type=int, default=BENCH_ITERATIONS,
+                      help='measured runs of every architecture (default: %(default)s)')
+  parser.add_argument('--warmup', type=int, default=BENCH_WARMUP,
+                      help='runs of every architecture before measuring (default: %(default)s)')
+  parser.add_argument('-c', '--concurrency', type=int, default=1, help='runs at the same time (default: %(default)s)')
+  parser.add_argument('--no-deploy', dest='deploy', action='store_false', help="don't run the deploy stage")
+  parser.add_argument('--max-retries', type=int, default=3)
+  parser.add_argument('--llm-latency', type=float, default=0.0,
+                      help='seconds every scripted model answer takes (default: %(default)s)')
+  parser.add_argument('--terraform-latency', type=float, default=BENCH_TERRAFORM_LATENCY,
+                      help='seconds every stub terraform command takes (default: %(default)s)')
+  parser.add_argument('-o', '--output', help='json file for the report, to compare runs')
+  parser.add_argument('--keep', action='store_true', help='keep the benchmark working directory')
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  """Running the benchmark and reporting it, exits with 1 if any run failed."""
+  args = parse_args(argv)
+  corpus = read_corpus(args.corpus)
+  workdir = tempfile.mkdtemp(prefix='nl2iac-bench-')
+  prepare_environment(workdir, args.terraform_latency)
+  # imported after prepare_environment
+  import nl2iac_cache  # pylint: disable=import-outside-toplevel
+  import nl2iac_fakes  # pylint: disable=import-outside-toplevel
+  import nl2iac_metrics  # pylint: disable=import-outside-toplevel
+  nl2iac_fakes.SCRIPTED_MODEL_LATENCY = args.llm_latency
+
+  try:
+    # the agents verbose output is dropped, just the report is printed
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor, \
+         open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+      list(executor.map(lambda c: run_case(c[1], f'warmup-{c[0]}-{c[1]["id"]}', args),
+                        enumerate(corpus * args.warmup)))
+      # the terraform results memoized by the warmup would spare the subprocesses of the measured runs
+      for subcommand in nl2iac_cache.TERRAFORM_RESULT_CACHE_TTL:
+        nl2iac_cache.get_terraform_result_cache(subcommand).clear()
+      tracemalloc.start()
+      started = time.monotonic()
+      runs = list(executor.map(lambda c: run_case(c[1], f'run-{c[0]}-{c[1]["id"]}', args),
+                               enumerate(corpus * args.iterations)))
+      elapsed = time.monotonic() - started
+      memory_peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+
+    report = build_report(runs, read_trace(nl2iac_metrics.TRACE_FILE, {r['run_id'] for r in runs}),
+                          elapsed, memory_peak)
+    print_report(report)
+    if args.output:
+      with open(args.output, 'w', encoding='utf-8') as report_file:
+        json.dump(report, report_file, indent=2)
+  finally:
+    if args.keep:
+      print(f'Benchmark working directory: {workdir}', file=sys.stderr)
+    else:
+      shutil.rmtree(workdir, ignore_errors=True)
+  return 1 if report['failures'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
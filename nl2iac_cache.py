@@ -0,0 +1,161 @@
+"""Imports"""
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+##################
+# cache
+CACHE_DIR = os.environ.get('NL2IAC_CACHE_DIR', '.nl2iac_cache')
+CACHE_DB = os.path.join(CACHE_DIR, 'cache.sqlite3')
+# generated and validated templates
+TEMPLATE_CACHE_TTL = 30 * 24 * 3600
+TEMPLATE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# descriptions generated from the uploaded images
+IMAGE_DESCRIPTION_CACHE_TTL = 30 * 24 * 3600
+IMAGE_DESCRIPTION_CACHE_MAX_BYTES = 16 * 1024 * 1024
+# terraform outputs by subcommand: validate only depends on the template and the provider,
+# plan also on the cloud project, so it's kept just for a while
+TERRAFORM_RESULT_CACHE_TTL = {'validate': 30 * 24 * 3600, 'plan': 15 * 60}
+TERRAFORM_RESULT_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+
+#######################################################
+#######################################################
+# keys
+#######################################################
+def normalize_text(text: str) -> str:
+  """Normalizing a free text before hashing it: collapsing whitespaces."""
+  return re.sub(r'\s+', ' ', text or '').strip()
+
+
+def content_key(*parts) -> str:
+  """Content address of the given parts (any json serializable values)."""
+  return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+#################################################
+## cache
+#################################################
+class Cache:
+  """Persistent key/value cache (json values) stored on SQLite, shared by processes and sessions.
+      Entries expire after ttl seconds and the least recently used ones are evicted
+      when the namespace grows over max_bytes.
+  """
+
+  def __init__(self, namespace, ttl=None, max_bytes=None, path=CACHE_DB):
+    self.namespace = namespace
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('''CREATE TABLE IF NOT EXISTS cache (
+      namespace TEXT, key TEXT, value TEXT, size INTEGER, created REAL, accessed REAL,
+      PRIMARY KEY (namespace, key))''')
+
+  def get(self, key, default=None):
+    """Returning the value cached for key, default if missing or expired."""
+    now = time.time()
+    with self._lock:
+      row = self._db.execute('SELECT value, created FROM cache WHERE namespace = ? AND key = ?',
+                             (self.namespace, key)).fetchone()
+      if row is None:
+        return default
+      if self.ttl is not None and now - row[1] > self.ttl:
+        self._db.execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (self.namespace, key))
+        return default
+      self._db.execute('UPDATE cache SET accessed = ? WHERE namespace = ? AND key = ?',
+                       (now, self.namespace, key))
+    return json.loads(row[0])
+
+  def set(self, key, value):
+    """Caching value for key and evicting entries over the limits."""
+    value = json.dumps(value)
+    now = time.time()
+    with self._lock:
+      self._db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+                       (self.namespace, key, value, len(value), now, now))
+      self._evict(now)
+
+  def delete(self, key):
+    """Removing the value cached for key."""
+    with self._lock:
+      self._db.execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (self.namespace, key))
+
+  def clear(self):
+    """Removing all the entries of the namespace."""
+    with self._lock:
+      self._db.execute('DELETE FROM cache WHERE namespace = ?', (self.namespace,))
+
+  def items(self):
+    """(key, value) of all the entries not expired, without updating their access time."""
+    with self._lock:
+      rows = self._db.execute('SELECT key, value FROM cache WHERE namespace = ? AND created >= ?',
+                              (self.namespace, time.time() - self.ttl if self.ttl is not None else 0)).fetchall()
+    return [(key, json.loads(value)) for key, value in rows]
+
+  def _evict(self, now):
+    if self.ttl is not None:
+      self._db.execute('DELETE FROM cache WHERE namespace = ? AND created < ?', (self.namespace, now - self.ttl))
+    if self.max_bytes is None:
+      return
+    total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM cache WHERE namespace = ?',
+                             (self.namespace,)).fetchone()[0]
+    if total <= self.max_bytes:
+      return
+    # removing the least recently used entries until the namespace fits
+    for key, size in self._db.execute('SELECT key, size FROM cache WHERE namespace = ? ORDER BY accessed',
+                                      (self.namespace,)).fetchall():
+      self._db.execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (self.namespace, key))
+      total -= size
+      if total <= self.max_bytes:
+        break
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(namespace, ttl=None, max_bytes=None) -> Cache:
+  """Returning the process wide cache for a namespace, created on first use."""
+  with _caches_lock:
+    if namespace not in _caches:
+      _caches[namespace] = Cache(namespace, ttl, max_bytes)
+    return _caches[namespace]
+
+
+#################################################
+## templates
+#################################################
+def template_key(description, parameters, provider_id, model_id, temperature) -> str:
+  """Key of a validated template: normalized description and parameters plus the model settings."""
+  return content_key(normalize_text(description), normalize_text(parameters),
+                     provider_id.lower(), model_id, float(temperature))
+
+
+def get_template_cache() -> Cache:
+  """Cache of the validated templates and their suggestions."""
+  return get_cache('templates', TEMPLATE_CACHE_TTL, TEMPLATE_CACHE_MAX_BYTES)
+
+
+#################################################
+## images
+#################################################
+def get_image_description_cache() -> Cache:
+  """Cache of the descriptions generated from the images, keyed by image digest and settings."""
+  return get_cache('image_descriptions', IMAGE_DESCRIPTION_CACHE_TTL, IMAGE_DESCRIPTION_CACHE_MAX_BYTES)
+
+
+#################################################
+## terraform
+#################################################
+def get_terraform_result_cache(subcommand) -> Cache:
+  """Cache of the terraform outputs for a subcommand (validate, plan), keyed by template and provider."""
+  return get_cache(f'terraform_{subcommand}', TERRAFORM_RESULT_CACHE_TTL.get(subcommand, 0),
+                   TERRAFORM_RESULT_CACHE_MAX_BYTES)
@@ -0,0 +1,177 @@
+"""Imports"""
+import re
+import math
+import time
+import threading
+from collections import Counter
+# nl2iac
+import nl2iac_agent
+import nl2iac_cache
+import nl2iac_hcl
+import nl2iac_metrics
+import nl2iac_schema
+
+
+##################
+# examples
+# validated (description, template) pairs, shown to the developer agent for similar descriptions
+EXAMPLES_TTL = 90 * 24 * 3600
+EXAMPLES_MAX_BYTES = 32 * 1024 * 1024
+EXAMPLES_TOP_K = 2
+# cosine similarity (tf-idf) needed to use an example
+EXAMPLES_MIN_SCORE = 0.35
+# longer templates aren't used as examples, they would take most of the prompt
+EXAMPLES_MAX_CHARS = 8000
+# the resource types of the templates weight less than the description terms
+EXAMPLES_RESOURCE_WEIGHT = 0.5
+# seconds before reloading the index, examples added by other processes are seen after that
+EXAMPLES_RELOAD_INTERVAL = 60
+# the request part before it is matched against the examples, the configuration (project, region) isn't
+CONFIGURATION_MARKER = '\nConfiguration:'
+# blocks with the project, region and credentials of the team that validated the template, not stored
+EXAMPLE_EXCLUDED_BLOCKS = ('provider', 'terraform')
+# literal values of these arguments on the resources are replaced by a placeholder, e.g. "<project>"
+EXAMPLE_PLACEHOLDER_ARGUMENTS = re.compile(r'^(\s*)(project|region|zone)(\s*=\s*)"[^"\n]*"', re.MULTILINE)
+PROMPT_EXAMPLES = '\n\nThese templates were validated for similar solutions. ' \
+  'Use them as a reference for the resources and required arguments, ' \
+  'but generate the template for the solution above and with the values on its Configuration section:\n'
+
+# in-process similarity index: example key -> (example, weighted terms), document frequencies of the terms
+_index = {'examples': {}, 'frequencies': Counter(), 'loaded': None}
+_index_lock = threading.Lock()
+
+
+#######################################################
+#######################################################
+# features
+#######################################################
+def solution_text(description: str) -> str:
+  """Description of the solution, without its configuration section."""
+  return description.split(CONFIGURATION_MARKER, 1)[0].strip()
+
+
+def example_template(template: str) -> str:
+  """Template as stored and shown as an example, without the configuration of the team that validated it:
+      no provider and terraform blocks (project, region, backend) and placeholders for the literal
+      project, region and zone arguments. Empty if it can't be parsed, so it isn't used.
+  """
+  try:
+    blocks = nl2iac_hcl.parse(template)
+  except nl2iac_hcl.HCLSyntaxError:
+    return ''
+  template = '\n\n'.join(template[block.start:block.end] for block in blocks
+                         if block.type not in EXAMPLE_EXCLUDED_BLOCKS).strip()
+  return EXAMPLE_PLACEHOLDER_ARGUMENTS.sub(r'\1\2\3"<\2>"', template)
+
+
+def template_resources(template: str) -> list:
+  """Resource types declared on a template, empty if it can't be parsed."""
+  try:
+    blocks = nl2iac_hcl.parse(template)
+  except nl2iac_hcl.HCLSyntaxError:
+    return []
+  return sorted({block.labels[0] for block in blocks if block.type == 'resource' and block.labels})
+
+
+def description_terms(description: str) -> Counter:
+  """Weighted terms of a description: its words plus the provider terms of the common component names."""
+  terms = nl2iac_schema.search_terms(solution_text(description))
+  terms += [t for term in terms if term in nl2iac_schema.SEARCH_SYNONYMS
+            for t in nl2iac_schema.search_terms(nl2iac_schema.SEARCH_SYNONYMS[term])]
+  return Counter(terms)
+
+
+def example_terms(example: dict) -> Counter:
+  """Weighted terms of a stored example: the description ones and the words of its resource types."""
+  terms = description_terms(example['description'])
+  for resource in example.get('resources', []):
+    for term in nl2iac_schema.search_terms(resource.replace('_', ' ')):
+      terms[term] += EXAMPLES_RESOURCE_WEIGHT
+  return terms
+
+
+def _idf(term, documents, frequencies):
+  # smoothed, so a term on every example still counts
+  return math.log((1 + documents) / (1 + frequencies.get(term, 0))) + 1
+
+
+def _vector(terms: Counter, documents, frequencies) -> tuple:
+  vector = {term: weight * _idf(term, documents, frequencies) for term, weight in terms.items()}
+  return vector, math.sqrt(sum(v * v for v in vector.values()))
+
+
+#################################################
+## store
+#################################################
+def get_examples_store() -> nl2iac_cache.Cache:
+  """Store of the validated examples, keyed by solution description."""
+  return nl2iac_cache.get_cache('examples', EXAMPLES_TTL, EXAMPLES_MAX_BYTES)
+
+
+def _load_index(force=False):
+  now = time.monotonic()
+  with _index_lock:
+    if not force and _index['loaded'] is not None and now - _index['loaded'] < EXAMPLES_RELOAD_INTERVAL:
+      return
+    examples = {key: (example, example_terms(example)) for key, example in get_examples_store().items()}
+    _index['frequencies'] = Counter(term for _, terms in examples.values() for term in terms)
+    _index['examples'] = examples
+    _index['loaded'] = now
+
+
+def redact_configuration(text: str, configuration: dict) -> str:
+  """Replacing the configuration values (e.g. the project id) on text by their placeholders, e.g. "<project>"."""
+  for name, value in (configuration or {}).items():
+    if value:
+      text = re.sub(r'(?<!\w)' + re.escape(str(value)) + r'(?!\w)', f'<{name}>', text)
+  return text
+
+
+def add_example(solution: str, template: str, configuration: dict = None):
+  """Saving a validated template as an example for similar descriptions.
+      solution is the description without its configuration (appended by the caller), the configuration
+      values (e.g. {'project': ..., 'region': ...}) found on the solution or the template are replaced by placeholders.
+  """
+  description = redact_configuration(solution.strip(), configuration)
+  template = redact_configuration(example_template(nl2iac_agent.clean_str(template or '')), configuration)
+  if not description or not template or len(template) > EXAMPLES_MAX_CHARS:
+    return
+  get_examples_store().set(nl2iac_cache.content_key(nl2iac_cache.normalize_text(description)), {
+    'description': description, 'template': template, 'resources': template_resources(template)})
+  _load_index(force=True)
+
+
+def find_examples(description: str, top_k: int = EXAMPLES_TOP_K, min_score: float = EXAMPLES_MIN_SCORE) -> list:
+  """Up to top_k examples most similar to description (cosine similarity over tf-idf), best first.
+      Every example is a dict with description, template, resources and score.
+  """
+  _load_index()
+  with _index_lock:
+    examples = list(_index['examples'].values())
+    frequencies = _index['frequencies']
+  if not examples:
+    return []
+  query, query_norm = _vector(description_terms(description), len(examples), frequencies)
+  if not query_norm:
+    return []
+  scored = []
+  for example, terms in examples:
+    vector, norm = _vector(terms, len(examples), frequencies)
+    score = sum(weight * vector.get(term, 0.0) for term, weight in query.items()) / (query_norm * norm) if norm else 0.0
+    if score >= min_score:
+      scored.append({**example, 'score': round(score, 4)})
+  scored.sort(key=lambda e: -e['score'])
+  return scored[:top_k]
+
+
+def examples_prompt(description: str) -> str:
+  """Examples section added to the developer request, empty if there are no similar examples."""
+  # the examples saved before their configuration was removed are stripped too
+  examples = [{**example, 'template': example_template(example['template'])} for example in find_examples(description)]
+  examples = [example for example in examples if example['template']]
+  nl2iac_metrics.increment('nl2iac_examples_total', len(examples))
+  if not examples:
+    return ''
+  return PROMPT_EXAMPLES + ''.join(f"\nExample {number}. Solution: {example['description']}\nTemplate:\n"
+                                   f"{example['template']}\n"
+                                   for number, example in enumerate(examples, start=1))
@@ -0,0 +1,145 @@
+"""Imports"""
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+##################
+# scripted models
+# seconds every scripted answer takes, simulating the provider latency (0 measures just the orchestration)
+SCRIPTED_MODEL_LATENCY = 0.0
+# characters per token used to estimate the token usage of the scripted answers
+CHARS_PER_TOKEN = 4
+# characters of every streamed chunk
+STREAM_CHUNK_SIZE = 16
+
+# script replayed by the scripted models called in the current context
+_script = contextvars.ContextVar('nl2iac_script', default=None)
+
+
+#######################################################
+#######################################################
+# scripts
+#######################################################
+class ScriptExhausted(RuntimeError):
+  """The model of a role was called more times than the answers scripted for it."""
+
+
+class Script:
+  """Answers replayed in order for every role (developer, validator, deployer, repair, planner).
+      Every answer is a string (the message content) or a dict with content and/or
+      tool_calls ([{name, args}]). $name on strings is replaced by templates[name].
+  """
+
+  def __init__(self, answers: dict, templates: dict = None):
+    self.answers = answers
+    self.templates = templates or {}
+    self._positions = dict.fromkeys(answers, 0)
+    self._lock = threading.Lock()
+
+  def _expand(self, value):
+    if isinstance(value, str):
+      # longest names first so $vpc_v2 isn't replaced as $vpc
+      for name in sorted(self.templates, key=len, reverse=True):
+        value = value.replace(f'${name}', self.templates[name])
+      return value
+    if isinstance(value, dict):
+      return {k: self._expand(v) for k, v in value.items()}
+    if isinstance(value, list):
+      return [self._expand(v) for v in value]
+    return value
+
+  def next_answer(self, role) -> AIMessage:
+    """Next scripted answer of role as a message."""
+    with self._lock:
+      position = self._positions.get(role, 0)
+      if position >= len(self.answers.get(role, [])):
+        raise ScriptExhausted(f'No more scripted answers for the {role} model ({position} used).')
+      self._positions[role] = position + 1
+      answer = self._expand(self.answers[role][position])
+    if isinstance(answer, str):
+      return AIMessage(content=answer)
+    return AIMessage(content=answer.get('content', ''),
+                     tool_calls=[{'name': c['name'], 'args': c.get('args', {}), 'id': f'call_{uuid.uuid4().hex[:12]}'}
+                                 for c in answer.get('tool_calls', [])])
+
+
+@contextmanager
+def use_script(script: Script):
+  """Replaying script on the scripted models called within the block."""
+  token = _script.set(script)
+  try:
+    yield script
+  finally:
+    _script.reset(token)
+
+
+def _roles():
+  # imported here, the agents module creates the scripted models
+  import nl2iac_agent  # pylint: disable=import-outside-toplevel
+  return {
+    nl2iac_agent.PROMPT_TERRAFORM_DEVELOPER: 'developer',
+    nl2iac_agent.PROMPT_TERRAFORM_VALIDATOR: 'validator',
+    nl2iac_agent.PROMPT_TERRAFORM_DEPLOYER: 'deployer',
+    nl2iac_agent.PROMPT_TERRAFORM_REPAIR: 'repair',
+    nl2iac_agent.PROMPT_TERRAFORM_SHARDS: 'planner',
+  }
+
+
+#################################################
+## models
+#################################################
+class ScriptedChatModel(BaseChatModel):
+  """Chat model replaying the script of the current context, for the offline benchmark.
+      The role answering is identified by the system prompt of the messages.
+  """
+  model_name: str = 'scripted'
+
+  @property
+  def _llm_type(self) -> str:
+    return 'scripted'
+
+  def bind_tools(self, tools, **kwargs):
+    # tool calls are part of the script
+    return self
+
+  def _answer(self, messages) -> AIMessage:
+    script = _script.get()
+    if script is None:
+      raise RuntimeError('Scripted models need a script, use nl2iac_fakes.use_script().')
+    system = next((m.content for m in messages if isinstance(m, SystemMessage)), '')
+    role = _roles().get(system, 'developer')
+    if SCRIPTED_MODEL_LATENCY:
+      time.sleep(SCRIPTED_MODEL_LATENCY)
+    message = script.next_answer(role)
+    input_tokens = sum(len(str(m.content)) for m in messages) // CHARS_PER_TOKEN
+    output_tokens = (len(str(message.content)) + len(str(message.tool_calls))) // CHARS_PER_TOKEN
+    message.usage_metadata = {'input_tokens': input_tokens, 'output_tokens': output_tokens,
+                              'total_tokens': input_tokens + output_tokens}
+    return message
+
+  def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+    return ChatResult(generations=[ChatGeneration(message=self._answer(messages))])
+
+  def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+    message = self._answer(messages)
+    content = message.content
+    for start in range(0, len(content), STREAM_CHUNK_SIZE):
+      chunk = ChatGenerationChunk(message=AIMessageChunk(content=content[start:start + STREAM_CHUNK_SIZE]))
+      if run_manager:
+        run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+      yield chunk
+    # tool calls and usage on the last chunk
+    chunk = ChatGenerationChunk(message=AIMessageChunk(
+      content='', usage_metadata=message.usage_metadata,
+      tool_call_chunks=[{'name': c['name'], 'args': json.dumps(c['args']), 'id': c['id'], 'index': index}
+                        for index, c in enumerate(message.tool_calls)]))
+    if run_manager:
+      run_manager.on_llm_new_token('', chunk=chunk)
+    yield chunk
@@ -0,0 +1,362 @@
+"""Imports"""
+import re
+from dataclasses import dataclass, field
+
+
+##################
+# hcl
+IDENTIFIER = re.compile(r'[A-Za-z_][\w-]*')
+HEREDOC = re.compile(r'<<-?([A-Za-z_]\w*)[ \t]*\n')
+# references checked against the declarations on the template
+REFERENCE = re.compile(r'(?<![\w.\-])(var|local|module|data|google_[\w-]+)((?:\.[A-Za-z_][\w-]*)+)')
+# arguments and blocks accepted by terraform on any resource
+META_ARGUMENTS = ('count', 'for_each', 'depends_on', 'provider')
+META_BLOCKS = ('lifecycle', 'provisioner', 'connection', 'dynamic')
+CLOSING = {'(': ')', '[': ']', '{': '}'}
+
+
+#######################################################
+#######################################################
+# parsed template
+#######################################################
+class HCLSyntaxError(ValueError):
+  """The template isn't structurally valid HCL."""
+
+  def __init__(self, message, line):
+    super().__init__(f'{message} (line {line})')
+    self.line = line
+
+
+@dataclass
+class Attribute:
+  """An argument assignment: its raw expression and the expression without string literals."""
+  name: str
+  expression: str
+  references: str
+  line: int
+
+
+@dataclass
+class Block:
+  """A block with its labels, arguments and nested blocks.
+      start and end are the offsets of the block on the parsed text.
+  """
+  type: str
+  labels: list
+  attributes: dict = field(default_factory=dict)
+  blocks: list = field(default_factory=list)
+  line: int = 1
+  start: int = 0
+  end: int = 0
+
+  @property
+  def address(self):
+    """Terraform address of a top level block, e.g. google_compute_network.vpc"""
+    if self.type == 'resource':
+      return '.'.join(self.labels)
+    return '.'.join([self.type] + self.labels)
+
+
+#################################################
+## parser
+#################################################
+class _Parser:
+  """Minimal recursive parser of the HCL native syntax structure (blocks and arguments).
+      Expressions aren't parsed, just delimited, keeping their text for later checks.
+  """
+
+  def __init__(self, text):
+    self.text = text
+    self.pos = 0
+
+  def line(self, pos=None):
+    return self.text.count('\n', 0, self.pos if pos is None else pos) + 1
+
+  def skip(self, newlines=True):
+    """Skipping whitespaces and comments."""
+    while self.pos < len(self.text):
+      char = self.text[self.pos]
+      if char in ' \t\r' or (newlines and char == '\n'):
+        self.pos += 1
+      elif char == '#' or self.text.startswith('//', self.pos):
+        end = self.text.find('\n', self.pos)
+        self.pos = len(self.text) if end < 0 else end
+      elif self.text.startswith('/*', self.pos):
+        end = self.text.find('*/', self.pos + 2)
+        if end < 0:
+          raise HCLSyntaxError('Unterminated comment', self.line())
+        self.pos = end + 2
+      else:
+        break
+
+  def string(self):
+    """Reading a quoted template, returning just its interpolations."""
+    start = self.pos
+    self.pos += 1
+    interpolations = []
+    while self.pos < len(self.text):
+      char = self.text[self.pos]
+      if char == '\\':
+        self.pos += 2
+      elif char == '"':
+        self.pos += 1
+        return ' '.join(interpolations)
+      elif char == '\n':
+        break
+      elif self.text.startswith(('${', '%{'), self.pos):
+        self.pos += 2
+        interpolations.append(self.expression(until='}'))
+        self.pos += 1
+      else:
+        self.pos += 1
+    raise HCLSyntaxError('Unterminated string', self.line(start))
+
+  def heredoc(self, match):
+    """Reading a heredoc template, returning just its interpolations."""
+    start = self.pos
+    end = re.compile(r'^[ \t]*' + re.escape(match.group(1)) + r'[ \t]*$', re.M).search(self.text, match.end())
+    if end is None:
+      raise HCLSyntaxError('Unterminated heredoc', self.line(start))
+    self.pos = end.end()
+    return ' '.join(re.findall(r'[$%]{([^}]*)}', self.text[match.end():end.start()]))
+
+  def expression(self, until=None):
+    """Delimiting an expression: it ends on a newline (or until) outside brackets.
+        Returns the expression without string literals, used to look for references.
+    """
+    references = []
+    stack = []
+    while self.pos < len(self.text):
+      char = self.text[self.pos]
+      if not stack and (char == '\n' or char == until or (char == '}' and until is None)):
+        break
+      if char == '"':
+        references.append(' ' + self.string() + ' ')
+        continue
+      heredoc = HEREDOC.match(self.text, self.pos)
+      if heredoc:
+        references.append(' ' + self.heredoc(heredoc) + ' ')
+        continue
+      if char == '#' or self.text.startswith(('//', '/*'), self.pos):
+        self.skip(newlines=bool(stack))
+        continue
+      if char in CLOSING:
+        stack.append(CLOSING[char])
+      elif char in ')]}':
+        if not stack or stack.pop() != char:
+          raise HCLSyntaxError(f"Unexpected '{char}'", self.line())
+      references.append(char)
+      self.pos += 1
+    if stack:
+      raise HCLSyntaxError(f"Missing '{stack[-1]}'", self.line())
+    return ''.join(references)
+
+  def body(self, closing=None):
+    """Parsing arguments and blocks until the closing brace (or the end of the text)."""
+    attributes, blocks = {}, []
+    while True:
+      self.skip()
+      if self.pos >= len(self.text):
+        if closing:
+          raise HCLSyntaxError("Missing '}'", self.line())
+        return attributes, blocks
+      if closing and self.text[self.pos] == '}':
+        self.pos += 1
+        return attributes, blocks
+
+      start = self.pos
+      name = IDENTIFIER.match(self.text, self.pos)
+      if name is None:
+        raise HCLSyntaxError(f"Unexpected '{self.text[self.pos]}'", self.line())
+      self.pos = name.end()
+      self.skip(newlines=False)
+      if self.text.startswith('=', self.pos) and not self.text.startswith('==', self.pos):
+        self.pos += 1
+        self.skip(newlines=False)
+        expression_start = self.pos
+        references = self.expression()
+        attributes[name.group()] = Attribute(name.group(), self.text[expression_start:self.pos].strip(),
+                                             references, self.line(start))
+        continue
+
+      labels = []
+      while self.pos < len(self.text) and self.text[self.pos] != '{':
+        if self.text[self.pos] == '"':
+          label_start = self.pos
+          self.string()
+          labels.append(self.text[label_start + 1:self.pos - 1])
+        else:
+          label = IDENTIFIER.match(self.text, self.pos)
+          if label is None:
+            raise HCLSyntaxError(f"Invalid block definition for '{name.group()}'", self.line(start))
+          labels.append(label.group())
+          self.pos = label.end()
+        self.skip(newlines=False)
+      if self.pos >= len(self.text):
+        raise HCLSyntaxError(f"Invalid block definition for '{name.group()}'", self.line(start))
+      self.pos += 1
+      block_attributes, block_blocks = self.body(closing='}')
+      blocks.append(Block(name.group(), labels, block_attributes, block_blocks,
+                          line=self.line(start), start=start, end=self.pos))
+
+
+def parse(text: str) -> list:
+  """Parsing a template, returning its top level blocks. Raises HCLSyntaxError."""
+  _, blocks = _Parser(text).body()
+  return blocks
+
+
+#################################################
+## checks
+#################################################
+def _missing_required(address, block, schema_block, path=''):
+  """Checking required and unsupported arguments and blocks, at any nesting depth."""
+  errors = []
+  where = f'{address} block {path}' if path else address
+  present_blocks = {}
+  for nested in block.blocks:
+    name = nested.labels[0] if nested.type == 'dynamic' and nested.labels else nested.type
+    present_blocks.setdefault(name, []).append(nested)
+
+  for name, attribute in schema_block['attributes'].items():
+    if attribute.get('required') and name not in block.attributes:
+      errors.append(f'{where} is missing the required argument "{name}".')
+  for name in block.attributes:
+    if name not in schema_block['attributes'] and name not in META_ARGUMENTS:
+      errors.append(f'{where} has the unsupported argument "{name}".')
+  for name, block_type in schema_block['block_types'].items():
+    if block_type.get('min_items', 0) > 0 and name not in present_blocks:
+      errors.append(f'{where} is missing the required block "{name}".')
+  for name, nested_blocks in present_blocks.items():
+    if name not in schema_block['block_types']:
+      if name not in META_BLOCKS:
+        errors.append(f'{where} has the unsupported block "{name}".')
+      continue
+    for nested in nested_blocks:
+      if nested.type == 'dynamic':
+        # the content of a dynamic block is generated, it isn't checked
+        continue
+      errors += _missing_required(address, nested, schema_block['block_types'][name]['block'],
+                                  f'{path}.{name}' if path else name)
+  return errors
+
+
+def _attribute_value(block, name):
+  attribute = block.attributes.get(name)
+  return attribute.expression.strip().lower() if attribute else None
+
+
+def _references(block):
+  """All the references on the expressions of a block and its nested blocks."""
+  for attribute in block.attributes.values():
+    for match in REFERENCE.finditer(attribute.references):
+      yield attribute, match.group(1), match.group(2).lstrip('.').split('.')
+  for nested in block.blocks:
+    yield from _references(nested)
+
+
+def prevalidate(text: str, schema, resource_filter=('google_',)) -> list:
+  """Checking a template against the provider schema without running terraform.
+      Returns a list of errors: syntax errors, unknown resource types, missing
+      required arguments and blocks, undeclared references and auto_create_subnetworks rules.
+  """
+  try:
+    blocks = parse(text)
+  except HCLSyntaxError as e:
+    return [f'Template is not valid HCL: {e}']
+
+  errors = []
+  declared = {'var': set(), 'local': set(), 'module': set(), 'data': set(), 'resource': set()}
+  for block in blocks:
+    if block.type == 'variable' and block.labels:
+      declared['var'].add(block.labels[0])
+    elif block.type == 'locals':
+      declared['local'].update(block.attributes)
+    elif block.type == 'module' and block.labels:
+      declared['module'].add(block.labels[0])
+    elif block.type == 'data' and len(block.labels) == 2:
+      declared['data'].add('.'.join(block.labels))
+    elif block.type == 'resource' and len(block.labels) == 2:
+      declared['resource'].add('.'.join(block.labels))
+
+  networks_with_subnetworks = set()
+  for block in blocks:
+    if block.type != 'resource':
+      continue
+    if len(block.labels) != 2:
+      errors.append(f'resource block on line {block.line} must have a type and a name labels.')
+      continue
+    resource_type = block.labels[0]
+    if resource_type in schema:
+      errors += _missing_required(block.address, block, schema[resource_type]['block'])
+    elif any(f in resource_type for f in resource_filter):
+      errors.append(f'resource type "{resource_type}" ({block.address}) is not available for the provider.')
+    if resource_type == 'google_compute_subnetwork' and 'network' in block.attributes:
+      networks_with_subnetworks.update(
+        '.'.join([kind] + parts[:1]) for _, kind, parts in _references(block) if kind == 'google_compute_network')
+
+  for block in blocks:
+    for attribute, kind, parts in _references(block):
+      if kind in ('var', 'local', 'module'):
+        reference, known = parts[0], declared[kind]
+      elif kind == 'data':
+        reference, known = '.'.join(parts[:2]), declared['data']
+      else:
+        reference, known = '.'.join([kind] + parts[:1]), declared['resource']
+      if reference not in known:
+        errors.append(f'{block.address} argument "{attribute.name}" (line {attribute.line}) '
+                      f'references the undeclared {kind if kind in declared else "resource"} "{reference}".')
+
+    if block.type == 'resource' and block.labels[:1] == ['google_compute_network']:
+      auto_create = _attribute_value(block, 'auto_create_subnetworks')
+      if auto_create is None:
+        errors.append(f'{block.address} must explicitly set auto_create_subnetworks = false.')
+      elif auto_create == 'true' and block.address in networks_with_subnetworks:
+        errors.append(f'{block.address} has auto_create_subnetworks = true but custom subnetworks '
+                      'are created on it, set it to false.')
+
+  # keeping the order but removing duplicates
+  return list(dict.fromkeys(errors))
+
+
+#################################################
+## repair
+#################################################
+def block_lines(text: str, block: Block) -> tuple:
+  """First and last lines of a parsed block."""
+  return block.line, text.count('\n', 0, block.end) + 1
+
+
+def affected_blocks(text: str, errors=(), diagnostics=()) -> list:
+  """Top level blocks named by the errors (by address) or containing the lines of
+      terraform validate -json diagnostics. Raises HCLSyntaxError.
+  """
+  blocks = parse(text)
+  affected = []
+  for block in blocks:
+    first, last = block_lines(text, block)
+    named = re.compile(r'(?<![\w.-])' + re.escape(block.address) + r'(?![\w-])')
+    if any(named.search(error) for error in errors) or any(
+        first <= diagnostic.get('range', {}).get('start', {}).get('line', 0) <= last
+        for diagnostic in diagnostics):
+      affected.append(block)
+  return affected
+
+
+def splice_blocks(text: str, patches: str) -> str:
+  """Replacing the blocks of text by the blocks with the same address on patches.
+      Blocks on patches not present on text are appended. Raises HCLSyntaxError.
+  """
+  blocks = {block.address: block for block in parse(text)}
+  replacements, new_blocks = [], []
+  for patch in parse(patches):
+    if patch.address in blocks:
+      replacements.append((blocks[patch.address], patches[patch.start:patch.end]))
+    else:
+      new_blocks.append(patches[patch.start:patch.end])
+  # replacing from the end so the offsets of the previous blocks are still valid
+  for block, patch_text in sorted(replacements, key=lambda r: r[0].start, reverse=True):
+    text = text[:block.start] + patch_text + text[block.end:]
+  if new_blocks:
+    text = text.rstrip('\n') + '\n\n' + '\n\n'.join(new_blocks) + '\n'
+  return text
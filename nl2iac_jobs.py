@@ -0,0 +1,204 @@
+"""Imports"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import traceback
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+# nl2iac
+import nl2iac_agent
+import nl2iac_cache
+import nl2iac_metrics
+import nl2iac_pipeline
+import nl2iac_runner
+import nl2iac_workspace
+
+
+##################
+# jobs
+JOBS_DB = os.path.join(nl2iac_cache.CACHE_DIR, 'jobs.sqlite3')
+# jobs (deploys, plans) running at the same time, every workspace runs one job at a time
+JOB_WORKERS = int(os.environ.get('NL2IAC_JOB_WORKERS', '2'))
+# last terraform output lines saved as the job progress, at most every JOB_PROGRESS_INTERVAL seconds
+JOB_OUTPUT_LINES = 200
+JOB_PROGRESS_INTERVAL = 1.0
+# seconds between status checks of the UI
+JOB_POLL_INTERVAL = 2.0
+# finished jobs are removed after this time
+JOBS_TTL = 7 * 24 * 3600
+JOB_PENDING_STATUSES = ('queued', 'running')
+
+
+#######################################################
+#######################################################
+# jobs
+#######################################################
+def deploy_job(settings, template) -> dict:
+  """Deploying template (the validated one) on the current workspace, returning the deployer verdict.
+      It's written again under the workspace lock, so the apply uses it and the plan saved for it
+      even if other candidates were written on the workspace after the job was queued.
+  """
+  if not template:
+    raise ValueError('No template to deploy.')
+  nl2iac_agent.write_terraform_template(template)
+  try:
+    return nl2iac_pipeline.parse_result(nl2iac_pipeline.deploy_template(nl2iac_agent.get_agent('deployer', **settings)))
+  except (ValueError, nl2iac_agent.AgentBudgetExceeded) as e:
+    return {'valid': False, 'errors': [str(e)], 'suggestions': []}
+
+
+def plan_job(template) -> dict:
+  """Planning template on the current workspace, the plan is saved to be applied by the deploy."""
+  return nl2iac_agent.terraform_template_plan.invoke({'terraform_template': template})
+
+
+JOB_KINDS = {
+  'deploy': deploy_job,
+  'plan': plan_job,
+}
+
+
+#################################################
+## queue
+#################################################
+def _pid_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+class JobQueue:
+  """Background jobs (deploys and long plans) run by a pool of worker threads, so the app
+      script runs don't wait for them. Jobs and their results are stored on SQLite and can be
+      polled by id from any session or process. Jobs of the same workspace run one at a time.
+  """
+
+  def __init__(self, workers=JOB_WORKERS, path=JOBS_DB, ttl=JOBS_TTL):
+    self.ttl = ttl
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+      job_id TEXT PRIMARY KEY, kind TEXT, owner TEXT, workspace TEXT, status TEXT, pid INTEGER,
+      submitted REAL, started REAL, finished REAL, output TEXT, result TEXT, error TEXT)''')
+    self._recover()
+    self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='nl2iac-job')
+
+  def _recover(self):
+    """Failing the pending jobs of processes that are gone, and removing the old ones."""
+    with self._lock:
+      rows = self._db.execute(f"SELECT job_id, pid FROM jobs WHERE status IN {JOB_PENDING_STATUSES}").fetchall()
+      for job_id, pid in rows:
+        if not _pid_alive(pid):
+          self._db.execute("UPDATE jobs SET status = 'failed', finished = ?, error = ? WHERE job_id = ?",
+                           (time.time(), 'Interrupted: the process running the job stopped.', job_id))
+      self._db.execute(f"DELETE FROM jobs WHERE status NOT IN {JOB_PENDING_STATUSES} AND finished < ?",
+                       (time.time() - self.ttl,))
+
+  def _update(self, job_id, **fields):
+    with self._lock:
+      self._db.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE job_id = ?",
+                       (*fields.values(), job_id))
+
+  def submit(self, kind, workspace, owner=None, trace_id=None, **params) -> str:
+    """Queuing a job of kind (deploy, plan) on workspace, returning its id. If a job of the same
+        kind is already pending on the workspace its id is returned instead (e.g. a double click).
+    """
+    if kind not in JOB_KINDS:
+      raise ValueError(f'Unknown job kind {kind}, available: {", ".join(JOB_KINDS)}.')
+    with self._lock:
+      row = self._db.execute(f"SELECT job_id FROM jobs WHERE kind = ? AND workspace = ? AND pid = ? "
+                             f"AND status IN {JOB_PENDING_STATUSES}", (kind, workspace, os.getpid())).fetchone()
+      if row:
+        return row[0]
+      job_id = uuid.uuid4().hex[:12]
+      self._db.execute('INSERT INTO jobs (job_id, kind, owner, workspace, status, pid, submitted) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?)', (job_id, kind, owner, workspace, 'queued', os.getpid(), time.time()))
+    # the job runs on the context of the caller, so its measures are traced as the caller ones
+    self._executor.submit(contextvars.copy_context().run, self._run, job_id, kind, workspace, owner, trace_id, params)
+    return job_id
+
+  def _run(self, job_id, kind, workspace, owner, trace_id, params):
+    output = deque(maxlen=JOB_OUTPUT_LINES)
+    saved = [time.monotonic()]
+
+    def progress(stream, line):
+      output.append(line if stream == 'stdout' else f'[{stream}] {line}')
+      if time.monotonic() - saved[0] >= JOB_PROGRESS_INTERVAL:
+        saved[0] = time.monotonic()
+        self._update(job_id, output='\n'.join(output))
+
+    status, result, error = 'failed', None, None
+    started = time.monotonic()
+    try:
+      # failing to lock the workspace (e.g. retired after an idle session release) fails the job too
+      with nl2iac_workspace.workspace_lock(workspace):
+        started = time.monotonic()
+        self._update(job_id, status='running', started=time.time())
+        if owner:
+          # renewing the lease, so the workspace isn't reclaimed while the job runs
+          nl2iac_workspace.get_pool().renew(owner)
+        with nl2iac_workspace.use_workspace(workspace), nl2iac_metrics.trace(trace_id or job_id), \
+             nl2iac_runner.stream_output(progress):
+          result = JOB_KINDS[kind](**params)
+      status = 'done'
+    except Exception as e:  # pylint: disable=broad-except
+      error = f'{type(e).__name__}: {e}\n{traceback.format_exc()}'
+    finally:
+      nl2iac_metrics.observe('nl2iac_job_seconds', time.monotonic() - started, 'job', {'job_id': job_id},
+                             kind=kind, status=status)
+      self._update(job_id, status=status, finished=time.time(), output='\n'.join(output),
+                   result=json.dumps(result, default=str), error=error)
+
+  def status(self, job_id) -> dict:
+    """Job as a dict (job_id, kind, owner, workspace, status, times, output, result, error), None if unknown.
+        status is queued, running, done (result has the job result) or failed (error has the reason).
+    """
+    with self._lock:
+      cursor = self._db.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,))
+      row = cursor.fetchone()
+    if row is None:
+      return None
+    job = dict(zip([c[0] for c in cursor.description], row))
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+  def jobs(self, owner, limit=20) -> list:
+    """Latest jobs of an owner (session or batch), newest first, without their output."""
+    with self._lock:
+      rows = self._db.execute('SELECT job_id, kind, status, submitted, finished FROM jobs WHERE owner = ? '
+                              'ORDER BY submitted DESC LIMIT ?', (owner, limit)).fetchall()
+    return [dict(zip(('job_id', 'kind', 'status', 'submitted', 'finished'), row)) for row in rows]
+
+  def wait(self, job_id, timeout=None, interval=JOB_POLL_INTERVAL) -> dict:
+    """Polling a job until it finishes, returning it. Raises TimeoutError after timeout seconds."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+      job = self.status(job_id)
+      if job is None or job['status'] not in JOB_PENDING_STATUSES:
+        return job
+      if deadline is not None and time.monotonic() >= deadline:
+        raise TimeoutError(f'Job {job_id} not finished after {timeout} seconds.')
+      time.sleep(interval)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> JobQueue:
+  """Returning the process wide job queue, created on first use."""
+  global _queue
+  with _queue_lock:
+    if _queue is None:
+      _queue = JobQueue()
+    return _queue
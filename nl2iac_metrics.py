@@ -0,0 +1,226 @@
+"""Imports"""
+import os
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+##################
+# metrics
+METRICS_ENABLED = os.environ.get('NL2IAC_METRICS', '1') != '0'
+METRICS_DIR = os.environ.get('NL2IAC_METRICS_DIR', '.nl2iac_metrics')
+# every measure is appended to the trace and the prometheus file is rewritten after every stage
+TRACE_FILE = os.path.join(METRICS_DIR, 'trace.jsonl')
+PROMETHEUS_FILE = os.path.join(METRICS_DIR, 'nl2iac.prom')
+METRICS_HELP = {
+  'nl2iac_stage_seconds': 'Wall clock time of the pipeline stages.',
+  'nl2iac_llm_calls_total': 'Model calls by agent.',
+  'nl2iac_llm_seconds': 'Model calls latency by agent.',
+  'nl2iac_llm_first_token_seconds': 'Time to the first streamed token of the model calls by agent.',
+  'nl2iac_llm_tokens_total': 'Model tokens by agent and type (input, output).',
+  'nl2iac_tool_seconds': 'Agent tool calls duration by tool.',
+  'nl2iac_terraform_seconds': 'Terraform subprocesses duration by subcommand and status.',
+  'nl2iac_terraform_memo_hits_total': 'Terraform commands answered by the memoized result, without a subprocess.',
+  'nl2iac_agent_budget_exceeded_total': 'Agent runs stopped by their iterations, time or tokens ceiling.',
+  'nl2iac_job_seconds': 'Background jobs duration by kind and status.',
+  'nl2iac_examples_total': 'Validated templates used as examples on the generations.',
+  'nl2iac_cascade_escalations_total': 'Stages run with their own model after the fast cascade model failed.',
+}
+
+# trace id (session or batch request) of the measures taken in the current context
+_trace_id = contextvars.ContextVar('nl2iac_trace_id', default=None)
+# (name, labels) -> [count, sum] for summaries, [value] for counters
+_summaries = {}
+_counters = {}
+_metrics_lock = threading.Lock()
+_trace_lock = threading.Lock()
+
+
+#######################################################
+#######################################################
+# recording
+#######################################################
+@contextmanager
+def trace(trace_id):
+  """Tagging the measures taken within the block with trace_id."""
+  token = _trace_id.set(trace_id)
+  try:
+    yield trace_id
+  finally:
+    _trace_id.reset(token)
+
+
+def _record_trace(event):
+  os.makedirs(METRICS_DIR, exist_ok=True)
+  with _trace_lock, open(TRACE_FILE, 'a', encoding='utf-8') as trace_file:
+    trace_file.write(json.dumps(event) + '\n')
+
+
+def observe(name, value, event_type, details=None, **labels):
+  """Adding a measure (duration in seconds) to a summary and to the trace.
+      details are only written on the trace (not used as prometheus labels).
+  """
+  if not METRICS_ENABLED:
+    return
+  key = (name, tuple(sorted(labels.items())))
+  with _metrics_lock:
+    summary = _summaries.setdefault(key, [0, 0.0])
+    summary[0] += 1
+    summary[1] += value
+  _record_trace({'ts': time.time(), 'trace_id': _trace_id.get(), 'type': event_type, 'metric': name,
+                 'value': value, **labels, **(details or {})})
+
+
+def increment(name, value=1, event_type=None, **labels):
+  """Increasing a counter, also added to the trace if event_type."""
+  if not METRICS_ENABLED:
+    return
+  key = (name, tuple(sorted(labels.items())))
+  with _metrics_lock:
+    _counters[key] = _counters.get(key, 0) + value
+  if event_type:
+    _record_trace({'ts': time.time(), 'trace_id': _trace_id.get(), 'type': event_type, 'metric': name,
+                   'value': value, **labels})
+
+
+@contextmanager
+def stage(name, **labels):
+  """Measuring the wall clock time of a pipeline stage (image description, generation, validation, deploy)."""
+  start = time.monotonic()
+  status = 'ok'
+  try:
+    yield
+  except BaseException:
+    status = 'error'
+    raise
+  finally:
+    observe('nl2iac_stage_seconds', time.monotonic() - start, 'stage', stage=name, status=status, **labels)
+    export_prometheus()
+
+
+def response_tokens(response) -> tuple:
+  """(input, output) tokens of a model response, from the messages usage or the provider token usage."""
+  input_tokens = output_tokens = 0
+  for generations in response.generations:
+    for generation in generations:
+      usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None) or {}
+      input_tokens += usage.get('input_tokens', 0)
+      output_tokens += usage.get('output_tokens', 0)
+  if not (input_tokens or output_tokens):
+    usage = (response.llm_output or {}).get('token_usage') or {}
+    input_tokens, output_tokens = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+  return input_tokens, output_tokens
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+  """Measuring the model calls, tokens and tool calls of an agent."""
+
+  def __init__(self, agent):
+    self.agent = agent
+    self._starts = {}
+    self._first_tokens = set()
+
+  def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+    self._starts[run_id] = time.monotonic()
+
+  def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+    self._starts[run_id] = time.monotonic()
+
+  def on_llm_new_token(self, token, *, run_id, **kwargs):
+    if run_id in self._starts and run_id not in self._first_tokens:
+      self._first_tokens.add(run_id)
+      observe('nl2iac_llm_first_token_seconds', time.monotonic() - self._starts[run_id], 'llm_first_token',
+              agent=self.agent)
+
+  def on_llm_end(self, response, *, run_id, **kwargs):
+    self._first_tokens.discard(run_id)
+    increment('nl2iac_llm_calls_total', agent=self.agent)
+    input_tokens, output_tokens = response_tokens(response)
+    increment('nl2iac_llm_tokens_total', input_tokens, agent=self.agent, type='input')
+    increment('nl2iac_llm_tokens_total', output_tokens, agent=self.agent, type='output')
+    if run_id in self._starts:
+      observe('nl2iac_llm_seconds', time.monotonic() - self._starts.pop(run_id), 'llm',
+              {'input_tokens': input_tokens, 'output_tokens': output_tokens}, agent=self.agent)
+
+  def on_llm_error(self, error, *, run_id, **kwargs):
+    self._first_tokens.discard(run_id)
+    if run_id in self._starts:
+      observe('nl2iac_llm_seconds', time.monotonic() - self._starts.pop(run_id), 'llm',
+              {'error': type(error).__name__}, agent=self.agent)
+
+  def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+    self._starts[run_id] = (time.monotonic(), serialized.get('name', 'tool'))
+
+  def on_tool_end(self, output, *, run_id, **kwargs):
+    if run_id in self._starts:
+      start, tool_name = self._starts.pop(run_id)
+      observe('nl2iac_tool_seconds', time.monotonic() - start, 'tool', tool=tool_name, agent=self.agent)
+
+  def on_tool_error(self, error, *, run_id, **kwargs):
+    if run_id in self._starts:
+      start, tool_name = self._starts.pop(run_id)
+      observe('nl2iac_tool_seconds', time.monotonic() - start, 'tool', {'error': type(error).__name__},
+              tool=tool_name, agent=self.agent)
+
+
+#################################################
+## export
+#################################################
+def _labels_text(labels):
+  return '{' + ','.join(f'{k}="{str(v)}"' for k, v in labels) + '}' if labels else ''
+
+
+def render_prometheus() -> str:
+  """Metrics in the prometheus text exposition format."""
+  lines = []
+  with _metrics_lock:
+    summaries = dict(_summaries)
+    counters = dict(_counters)
+  for name in sorted({n for n, _ in summaries}):
+    lines += [f'# HELP {name} {METRICS_HELP.get(name, name)}', f'# TYPE {name} summary']
+    for (metric, labels), (count, total) in sorted(summaries.items()):
+      if metric == name:
+        lines.append(f'{name}_count{_labels_text(labels)} {count}')
+        lines.append(f'{name}_sum{_labels_text(labels)} {total}')
+  for name in sorted({n for n, _ in counters}):
+    lines += [f'# HELP {name} {METRICS_HELP.get(name, name)}', f'# TYPE {name} counter']
+    for (metric, labels), value in sorted(counters.items()):
+      if metric == name:
+        lines.append(f'{name}{_labels_text(labels)} {value}')
+  return '\n'.join(lines) + '\n'
+
+
+def export_prometheus(path=PROMETHEUS_FILE):
+  """Writing the metrics file (e.g. for the node exporter textfile collector)."""
+  if not METRICS_ENABLED:
+    return
+  os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+  tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+  with open(tmp_path, 'w', encoding='utf-8') as prometheus_file:
+    prometheus_file.write(render_prometheus())
+  os.replace(tmp_path, path)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    body = render_prometheus().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+    pass
+
+
+def start_http_server(port, address='127.0.0.1'):
+  """Serving the metrics on http://address:port/metrics from a background thread."""
+  server = ThreadingHTTPServer((address, port), _MetricsRequestHandler)
+  threading.Thread(target=server.serve_forever, name='nl2iac-metrics', daemon=True).start()
+  return server
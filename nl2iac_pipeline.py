@@ -0,0 +1,510 @@
+"""Imports"""
+import re
+import ast
+import json
+import time
+import uuid
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig
+# nl2iac
+import nl2iac_agent
+import nl2iac_cache
+import nl2iac_examples
+import nl2iac_hcl
+import nl2iac_metrics
+import nl2iac_schema
+import nl2iac_workspace
+
+
+##################
+# generals
+MAX_RETRIES = 3
+# failed templates are repaired patching just the failing blocks instead of generating them again
+REPAIR_MODE = True
+# speculative generation: candidates generated and validated concurrently on every round (1 disables it)
+SPECULATIVE_CANDIDATES = 1
+# every extra candidate raises the temperature by this step and adds a hint to the description
+SPECULATIVE_TEMPERATURE_STEP = 0.3
+SPECULATIVE_MAX_TEMPERATURE = 1.0
+SPECULATIVE_HINTS = (
+  '',
+  '\nDeclare every resource before referencing it and double check the required arguments of every block.',
+  '\nKeep the template as simple as possible, using only the components described.',
+)
+# templates validated for similar descriptions are added as examples to the generation request
+EXAMPLES_MODE = True
+# sharded generation: the description is split into component groups generated concurrently and merged
+SHARDED_MODE = False
+SHARD_MIN_GROUPS = 2
+SHARD_MAX_GROUPS = 6
+# seconds between renders of the tokens being streamed
+STREAM_RENDER_INTERVAL = 0.1
+# prompts
+PROMPT_VALIDATE_TEMPLATE = 'Validate this terraform template calling the available functions:\n'
+PROMPT_DEPLOY_TEMPLATE = 'Deploy the already created Terraform template.'
+PROMPT_RETRY_ERRORS = '\nKeep the names and components on the description, ' \
+  'but solve the following error made while creating the previous template: '
+
+
+#######################################################
+#######################################################
+# stages
+#######################################################
+def parse_result(output) -> dict:
+  """Result returned by the validator and deployer agents (or the planner): the report_verdict dict as is,
+      or the dict on the model text when the tool wasn't called, parsed in a single tolerant pass
+      (code fences, text around the braces and python literals like True are accepted).
+      valid is normalized to bool and errors and suggestions to lists of strings.
+      Raises ValueError when there's no dict on the output.
+  """
+  if isinstance(output, dict):
+    result = dict(output)
+  else:
+    text = nl2iac_agent.clean_str(str(output))
+    start, end = text.find('{'), text.rfind('}')
+    if start == -1 or end < start:
+      raise ValueError(f'No result found on the agent output: {text[:200]!r}')
+    text = text[start:end + 1]
+    try:
+      result = json.loads(text)
+    except json.JSONDecodeError:
+      try:
+        result = ast.literal_eval(text)
+      except (ValueError, SyntaxError) as e:
+        raise ValueError(f'Unparseable result on the agent output: {text[:200]!r}') from e
+    if not isinstance(result, dict):
+      raise ValueError(f'No result found on the agent output: {text[:200]!r}')
+  if 'valid' in result:
+    valid = result['valid']
+    result['valid'] = valid.strip().lower() == 'true' if isinstance(valid, str) else bool(valid)
+  for key in ('errors', 'suggestions'):
+    if key in result or 'valid' in result:
+      items = result.get(key) or []
+      result[key] = [str(item) for item in items] if isinstance(items, list) else [str(items)]
+  return result
+
+
+def stage_callbacks(agent_name, callbacks=None) -> list:
+  """Callbacks of a stage plus the metrics handler of its agent."""
+  return [*(callbacks or []), nl2iac_metrics.MetricsCallbackHandler(agent_name)]
+
+
+def parse_partial_result(output: str) -> dict:
+  """Fields of a validator or deployer result still being generated:
+      valid once known and the errors and suggestions items already completed.
+  """
+  text = nl2iac_agent.clean_str(output)
+  partial = {}
+  valid = re.search(r'"valid"\s*:\s*(true|false)', text, re.IGNORECASE)
+  if valid:
+    partial['valid'] = valid.group(1).lower() == 'true'
+  for key in ('errors', 'suggestions'):
+    items = re.search(rf'"{key}"\s*:\s*\[(.*?)(?:\]|$)', text, re.DOTALL)
+    if items:
+      partial[key] = [json.loads(item) for item in re.findall(r'"(?:[^"\\]|\\.)*"', items.group(1))]
+  return partial
+
+
+class TokenStreamHandler(BaseCallbackHandler):
+  """Passing the text generated so far by the current model call to render,
+      at most every interval seconds and once more when the call ends.
+  """
+
+  def __init__(self, render, interval=STREAM_RENDER_INTERVAL):
+    self.render = render
+    self.interval = interval
+    self.text = ''
+    self._rendered = 0.0
+
+  def on_llm_start(self, *args, **kwargs):
+    self.text = ''
+
+  on_chat_model_start = on_llm_start
+
+  def on_llm_new_token(self, token, chunk=None, **kwargs):
+    self.text += token
+    # the arguments of the tool calls being streamed (the report_verdict result)
+    for tool_call_chunk in getattr(getattr(chunk, 'message', None), 'tool_call_chunks', None) or []:
+      self.text += tool_call_chunk.get('args') or ''
+    now = time.monotonic()
+    if now - self._rendered >= self.interval:
+      self._rendered = now
+      self.render(self.text)
+
+  def on_llm_end(self, response, **kwargs):
+    if self.text:
+      self.render(self.text)
+
+
+def generate_template(agent, description, previous_error='', callbacks=None, examples=EXAMPLES_MODE) -> str:
+  """Generating a candidate template for the description, asking to solve the previous errors if any.
+      If examples, the templates validated for the most similar descriptions are added to the request.
+  """
+  with nl2iac_metrics.stage('generate'):
+    request = description + (nl2iac_examples.examples_prompt(description) if examples else '') + previous_error
+    output = agent.invoke({'user_message': [HumanMessage(content=request)]},
+                          config=RunnableConfig(callbacks=stage_callbacks('developer', callbacks)))
+  return output['output']
+
+
+def validate_template(agent, template, callbacks=None) -> dict:
+  """Validating a candidate template: first the local pre-validation, then the validator agent.
+      Returns a dict with valid, errors and suggestions (and prevalidated if the agent wasn't called).
+  """
+  # checking the obvious defects locally, without calling the validator agent nor terraform
+  with nl2iac_metrics.stage('prevalidate'):
+    prevalidation_errors = nl2iac_agent.prevalidate_template(template)
+  if prevalidation_errors:
+    return {'valid': False, 'errors': prevalidation_errors, 'suggestions': [], 'prevalidated': True}
+
+  try:
+    with nl2iac_metrics.stage('validate'):
+      output = agent.invoke(
+        {'user_message': [HumanMessage(content=PROMPT_VALIDATE_TEMPLATE + nl2iac_agent.clean_str(template))]},
+        config=RunnableConfig(callbacks=stage_callbacks('validator', callbacks)))
+  except nl2iac_agent.AgentBudgetExceeded as e:
+    # the validator couldn't decide within its budget, the template isn't considered valid
+    return {'valid': False, 'errors': [str(e)], 'suggestions': [], 'failed': True}
+  try:
+    return parse_result(output['output'])
+  except ValueError as e:
+    # a verdict that can't be read isn't a valid template
+    return {'valid': False, 'errors': [str(e)], 'suggestions': [], 'failed': True}
+
+
+def validate_cascade(settings, template, callbacks=None) -> dict:
+  """Validating a candidate template with the fast validator when the cascade is enabled, escalating
+      to the validator of the stage model if the fast one fails (budget exceeded or unreadable verdict).
+  """
+  if nl2iac_agent.cascade_enabled('validator', settings['provider_id']):
+    validation = validate_template(nl2iac_agent.get_agent('validator', **settings, fast=True), template, callbacks)
+    if not validation.get('failed'):
+      return validation
+    nl2iac_metrics.increment('nl2iac_cascade_escalations_total', stage='validator')
+  return validate_template(nl2iac_agent.get_agent('validator', **settings), template, callbacks)
+
+
+def developer_agent(settings, previous_error=''):
+  """Developer agent of a generation round: with the cascade the fast one, until a generation fails."""
+  if previous_error and nl2iac_agent.cascade_enabled('developer', settings['provider_id']):
+    nl2iac_metrics.increment('nl2iac_cascade_escalations_total', stage='developer')
+  return nl2iac_agent.get_agent('developer', **settings, fast=not previous_error)
+
+
+def deploy_template(agent, callbacks=None):
+  """Deploying the template already written on the current workspace, returning the agent output
+      (the report_verdict dict, or the model text when the tool wasn't called).
+  """
+  with nl2iac_metrics.stage('deploy'):
+    output = agent.invoke({'user_message': [HumanMessage(content=PROMPT_DEPLOY_TEMPLATE)]},
+                          config=RunnableConfig(callbacks=stage_callbacks('deployer', callbacks)))
+  return output['output']
+
+
+def speculative_outcome(winner, failed):
+  """Template and validation of a speculative round: the valid candidate, or the first failed
+      template with the errors of all the candidates.
+  """
+  if winner:
+    return winner['template'], winner['validation']
+  errors = list(dict.fromkeys(e for c in failed for e in (c['validation'].get('errors') or [])))
+  template = next((c['template'] for c in failed if c['template']), '')
+  return template, {'valid': False, 'errors': errors, 'suggestions': []}
+
+
+def repair_template(settings, template, errors, callbacks=None):
+  """Repairing a template that failed the validation: the failing blocks (named by the errors
+      or by the terraform validate -json diagnostics) are sent to the model to be fixed and
+      then spliced into the template. Returns None if the failing blocks can't be identified.
+  """
+  with nl2iac_metrics.stage('repair'):
+    return _repair_template(settings, template, errors, callbacks)
+
+
+def _repair_template(settings, template, errors, callbacks):
+  template = nl2iac_agent.clean_str(template)
+  try:
+    blocks = nl2iac_hcl.affected_blocks(template, errors, nl2iac_agent.terraform_validate_diagnostics(template))
+  except nl2iac_hcl.HCLSyntaxError:
+    return None
+  if not blocks:
+    return None
+
+  required_index = nl2iac_schema.get_required_arguments_index(
+    nl2iac_agent.get_available_terraform_resources("dict"))
+  rules = [rule for block in blocks if block.type == 'resource'
+           for rule in required_index.get(block.labels[0], [])]
+  message = 'Errors:\n' + '\n'.join(f'- {error}' for error in errors) \
+    + '\n\nBlocks declared on the template: ' + ', '.join(b.address for b in nl2iac_hcl.parse(template)) \
+    + ('\n\nRequired arguments rules:\n' + '\n'.join(rules) if rules else '') \
+    + '\n\nBlocks to fix:\n' + '\n\n'.join(template[b.start:b.end] for b in blocks)
+  llm = nl2iac_agent.get_model(**nl2iac_agent.stage_settings('repair', **settings))
+  output = llm.invoke([SystemMessage(content=nl2iac_agent.PROMPT_TERRAFORM_REPAIR), HumanMessage(content=message)],
+                      config=RunnableConfig(callbacks=stage_callbacks('repair', callbacks)))
+  try:
+    return nl2iac_hcl.splice_blocks(template, nl2iac_agent.clean_str(output.text()))
+  except nl2iac_hcl.HCLSyntaxError:
+    return None
+
+
+def retry_error(errors) -> str:
+  """Text added to the description so the next generation solves the validation errors."""
+  if isinstance(errors, str):
+    errors = [errors]
+  return PROMPT_RETRY_ERRORS + ". ".join(errors)
+
+
+#################################################
+## speculative generation
+#################################################
+class CandidateCancelled(Exception):
+  """A speculative candidate was stopped because another one was already valid."""
+
+
+class _CancelCallbackHandler(BaseCallbackHandler):
+  """Stopping an agent on its next model or tool call once the candidate is cancelled."""
+  raise_error = True
+
+  def __init__(self, cancel_event):
+    self.cancel_event = cancel_event
+
+  def _check_cancelled(self, *args, **kwargs):
+    if self.cancel_event.is_set():
+      raise CandidateCancelled()
+
+  on_llm_start = on_chat_model_start = on_tool_start = _check_cancelled
+
+
+def candidate_settings(settings, index) -> dict:
+  """Settings of the index-th speculative candidate: the first one uses the original temperature."""
+  temperature = min(settings['temperature'] + SPECULATIVE_TEMPERATURE_STEP * index, SPECULATIVE_MAX_TEMPERATURE)
+  return {**settings, 'temperature': round(max(temperature, settings['temperature']), 2)}
+
+
+def _run_candidate(index, description, previous_error, settings, cancel_event, owner):
+  """Generating and validating a candidate on its own workspace."""
+  callbacks = [_CancelCallbackHandler(cancel_event)]
+  hint = SPECULATIVE_HINTS[index % len(SPECULATIVE_HINTS)]
+  # workspace of the caller, where the winner is written and deployed
+  workdir = nl2iac_workspace.current_workdir()
+  # a full pool fails the candidate (TimeoutError) instead of blocking the round
+  with nl2iac_workspace.get_pool().lease(owner=f'{owner}-candidate-{index}',
+                                         timeout=nl2iac_workspace.WORKSPACE_ACQUIRE_TIMEOUT) as candidate_workdir:
+    template = generate_template(nl2iac_agent.get_agent('developer', **candidate_settings(settings, index)),
+                                 description + hint, previous_error, callbacks)
+    if cancel_event.is_set():
+      raise CandidateCancelled()
+    validation = validate_cascade(settings, template, callbacks)
+    if validation['valid'] is True:
+      # the plan saved by the validation is removed with the candidate workspace, the deploy applies it
+      nl2iac_agent.copy_saved_plan(template, candidate_workdir, workdir)
+  return {'candidate': index, 'template': template, 'validation': validation}
+
+
+def generate_speculative(description, previous_error, settings, candidates=SPECULATIVE_CANDIDATES, owner=None):
+  """Generating and validating several candidates concurrently, keeping the first valid one.
+      The remaining candidates are cancelled on their next model or tool call.
+      Returns (valid candidate or None, failed candidates), every candidate is a dict
+      with candidate (index), template and validation.
+  """
+  owner = owner or uuid.uuid4().hex
+  cancel_event = threading.Event()
+  failed = []
+  executor = ThreadPoolExecutor(max_workers=candidates, thread_name_prefix='nl2iac-candidate')
+  # candidates measures are tagged with the trace id of the caller
+  futures = [executor.submit(contextvars.copy_context().run, _run_candidate, index, description, previous_error,
+                             settings, cancel_event, owner)
+             for index in range(candidates)]
+  try:
+    with nl2iac_metrics.stage('speculative', candidates=candidates):
+      for future in as_completed(futures):
+        try:
+          candidate = future.result()
+        except CandidateCancelled:
+          continue
+        # a candidate without a free workspace (TimeoutError) or failing otherwise is a failed candidate
+        except Exception as e:  # pylint: disable=broad-except
+          failed.append({'candidate': futures.index(future), 'template': None,
+                         'validation': {'valid': False, 'errors': [f'{type(e).__name__}: {e}'], 'suggestions': []}})
+          continue
+        if candidate['validation']['valid'] is True:
+          return candidate, failed
+        failed.append(candidate)
+      return None, failed
+  finally:
+    # not waiting for the cancelled candidates, they stop on their own
+    cancel_event.set()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+#################################################
+## sharded generation
+#################################################
+def plan_shards(settings, description, callbacks=None) -> list:
+  """Splitting the description into component groups (network, firewall, compute, storage...).
+      Returns a list of dicts with name, description and resources (terraform addresses),
+      empty if the description has less than SHARD_MIN_GROUPS groups or the answer can't be parsed.
+  """
+  with nl2iac_metrics.stage('shard_plan'):
+    llm = nl2iac_agent.get_model(**nl2iac_agent.stage_settings('planner', **settings))
+    output = llm.invoke([SystemMessage(content=nl2iac_agent.PROMPT_TERRAFORM_SHARDS), HumanMessage(content=description)],
+                        config=RunnableConfig(callbacks=stage_callbacks('planner', callbacks)))
+  try:
+    groups = parse_result(output.text())['groups']
+  except (ValueError, KeyError, TypeError):
+    return []
+  groups = [g for g in groups if isinstance(g, dict) and g.get('description')][:SHARD_MAX_GROUPS]
+  return groups if len(groups) >= SHARD_MIN_GROUPS else []
+
+
+def shard_description(description, groups, index) -> str:
+  """Description for the generation of the index-th group: the whole solution as context,
+      the components of the group and the blocks declared by the other groups.
+  """
+  group = groups[index]
+  others = [address for i, g in enumerate(groups) if i != index for address in g.get('resources') or []]
+  text = f"{description}\n\nGenerate ONLY the blocks of the {group.get('name', 'group')} components: " \
+    f"{group['description']}"
+  if others:
+    text += "\nThese blocks are declared on other files of the same template, reference them but don't declare them: " \
+      + ', '.join(others)
+  if index == 0:
+    return text + '\nInclude the provider section.'
+  return text + "\nDon't include the provider section, it's declared on another file."
+
+
+# blocks that may be declared more than once (several locals blocks), deduplicated by their content
+SHARD_CONTENT_BLOCKS = ('locals', 'terraform', 'provider')
+
+
+def merge_shards(templates) -> str:
+  """Merging the templates of the groups into one, keeping the first block of every address
+      (the locals, terraform and provider blocks are kept unless their content is repeated).
+  """
+  merged, addresses = [], set()
+  for template in templates:
+    template = nl2iac_agent.clean_str(template)
+    try:
+      blocks = nl2iac_hcl.parse(template)
+    except nl2iac_hcl.HCLSyntaxError:
+      # kept as is, the validation reports it
+      merged.append(template.strip())
+      continue
+    for block in blocks:
+      text = template[block.start:block.end]
+      key = ' '.join(text.split()) if block.type in SHARD_CONTENT_BLOCKS else block.address
+      if key not in addresses:
+        addresses.add(key)
+        merged.append(text)
+  return '\n\n'.join(merged) + '\n'
+
+
+def generate_sharded(settings, description, previous_error='', callbacks=None):
+  """Generating a template by component groups concurrently and merging them.
+      callbacks are used just for the split (the groups run on other threads).
+      Returns None if the description can't be split, the single generation must be used then.
+  """
+  groups = plan_shards(settings, description + previous_error, callbacks)
+  if not groups:
+    return None
+  agent = nl2iac_agent.get_agent('developer', **settings)
+  with nl2iac_metrics.stage('sharded_generate'), \
+       ThreadPoolExecutor(max_workers=len(groups), thread_name_prefix='nl2iac-shard') as executor:
+    # the groups run on the workspace and trace of the caller
+    futures = [executor.submit(contextvars.copy_context().run, generate_template, agent,
+                               shard_description(description, groups, index), previous_error, None, False)
+               for index in range(len(groups))]
+    templates = [future.result() for future in futures]
+  return merge_shards(templates)
+
+
+#################################################
+## headless pipeline
+#################################################
+def run_request(description, parameters, settings, max_retries=MAX_RETRIES, deploy=False,
+                candidates=SPECULATIVE_CANDIDATES, sharded=SHARDED_MODE):
+  """Generating, validating and optionally deploying a template for a description without UI.
+      settings are the get_agent keyword arguments (provider_id, model_id, temperature, project_id, region_id).
+      Terraform runs on the current workspace. Returns a result dict with per stage timings (seconds).
+      With more than one candidate every round is a speculative generation (timed as generate).
+      If sharded, templates are generated by component groups when the description can be split.
+  """
+  started = time.monotonic()
+  result = {'status': 'invalid', 'template': None, 'errors': [], 'suggestions': [], 'retries': 0,
+            'cached': False, 'repairs': 0, 'timings': {'generate': [], 'validate': [], 'repair': []}}
+  # the examples are saved with the solution alone, without the configuration
+  solution, description = description, description + '\nConfiguration:\n' + parameters
+
+  cache_key = None
+  if settings['temperature'] == 0:
+    cache_key = nl2iac_cache.template_key(description, parameters, settings['provider_id'],
+                                          settings['model_id'], settings['temperature'])
+  cached = nl2iac_cache.get_template_cache().get(cache_key) if cache_key else None
+  if cached is not None:
+    result.update(status='valid', template=cached['template'], cached=True,
+                  suggestions=cached['validation'].get('suggestions', []))
+    nl2iac_agent.write_terraform_template(cached['template'])
+  else:
+    previous_error = ''
+    # a repaired template is validated on the next round instead of generating a new one
+    template = None
+    for retry in range(1, max_retries + 1):
+      result['retries'] = retry
+      stage_start = time.monotonic()
+      if template is None and candidates > 1:
+        winner, failed = generate_speculative(description, previous_error, settings, candidates)
+        result['timings']['generate'].append(time.monotonic() - stage_start)
+        template, validation = speculative_outcome(winner, failed)
+        if winner:
+          nl2iac_agent.write_terraform_template(template)
+      else:
+        if template is None:
+          template = generate_sharded(settings, description, previous_error) if sharded else None
+          if template is None:
+            template = generate_template(developer_agent(settings, previous_error), description, previous_error)
+          result['timings']['generate'].append(time.monotonic() - stage_start)
+
+        stage_start = time.monotonic()
+        validation = validate_cascade(settings, template)
+        result['timings']['validate'].append(time.monotonic() - stage_start)
+      result.update(template=template, errors=validation.get('errors') or [],
+                    suggestions=validation.get('suggestions') or [])
+      if validation['valid'] is True:
+        result['status'] = 'valid'
+        if cache_key:
+          nl2iac_cache.get_template_cache().set(cache_key, {'template': template, 'validation': validation})
+        if EXAMPLES_MODE:
+          nl2iac_examples.add_example(solution, template, configuration={
+            'project': settings.get('project_id'), 'region': settings.get('region_id')})
+        break
+
+      stage_start = time.monotonic()
+      # the last round isn't repaired, there's no validation left for the repaired template
+      repaired = repair_template(settings, template, result['errors']) \
+        if REPAIR_MODE and template and retry < max_retries else None
+      if repaired:
+        result['timings']['repair'].append(time.monotonic() - stage_start)
+        result['repairs'] += 1
+      else:
+        previous_error += retry_error(result['errors'])
+      template = repaired
+      nl2iac_workspace.reset_workspace(nl2iac_workspace.current_workdir())
+
+  if deploy and result['status'] == 'valid':
+    stage_start = time.monotonic()
+    try:
+      deployment = parse_result(deploy_template(nl2iac_agent.get_agent('deployer', **settings)))
+    except (ValueError, nl2iac_agent.AgentBudgetExceeded) as e:
+      deployment = {'valid': False, 'errors': [str(e)], 'suggestions': []}
+    result['timings']['deploy'] = time.monotonic() - stage_start
+    result['status'] = 'deployed' if deployment['valid'] is True else 'deploy_failed'
+    if deployment['valid'] is not True:
+      result['errors'] = deployment.get('errors') or []
+      result['suggestions'] = deployment.get('suggestions') or []
+
+  result['timings']['total'] = time.monotonic() - started
+  return result
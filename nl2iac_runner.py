@@ -0,0 +1,180 @@
+"""Imports"""
+import os
+import time
+import signal
+import queue
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+from dataclasses import dataclass
+# nl2iac
+import nl2iac_metrics
+
+
+##################
+# terraform
+# seconds before a terraform command is killed, by subcommand
+TERRAFORM_TIMEOUTS = {'init': 600, 'validate': 60, 'plan': 600, 'apply': 1800, 'providers': 300}
+TERRAFORM_DEFAULT_TIMEOUT = 300
+# terraform processes running at the same time on the host
+TERRAFORM_MAX_CONCURRENCY = 4
+# seconds a terminated process has to exit before being killed
+TERMINATE_GRACE = 10
+READ_CHUNK_SIZE = 65536
+
+# callback receiving (stream, line) for every output line of the commands run in the current context
+_output_handler = contextvars.ContextVar('nl2iac_output_handler', default=None)
+
+
+#######################################################
+#######################################################
+# results
+#######################################################
+@dataclass
+class CommandResult:
+  """Outcome of a terraform execution."""
+  command: list
+  returncode: int
+  stdout: bytes
+  stderr: bytes
+  duration: float
+  timed_out: bool = False
+
+
+@contextmanager
+def stream_output(handler):
+  """Sending every output line of the commands run within the block to handler(stream, line)."""
+  token = _output_handler.set(handler)
+  try:
+    yield handler
+  finally:
+    _output_handler.reset(token)
+
+
+#################################################
+## helper functions
+#################################################
+async def _pump(reader, chunks, stream, lines):
+  """Reading a process pipe by chunks (the schema is a single huge line), forwarding complete lines."""
+  pending = b''
+  while chunk := await reader.read(READ_CHUNK_SIZE):
+    chunks.append(chunk)
+    if lines is not None:
+      *complete, pending = (pending + chunk).split(b'\n')
+      for line in complete:
+        lines.put((stream, line.decode('utf-8', errors='replace')))
+  if lines is not None and pending:
+    lines.put((stream, pending.decode('utf-8', errors='replace')))
+
+
+async def _terminate(process):
+  """Terminating a process and its children (e.g. provider plugins), killing them if they don't exit in time."""
+  for sig in (signal.SIGTERM, signal.SIGKILL):
+    try:
+      os.killpg(process.pid, sig)
+    except ProcessLookupError:
+      return
+    try:
+      await asyncio.wait_for(process.wait(), TERMINATE_GRACE)
+      return
+    except asyncio.TimeoutError:
+      continue
+
+
+def command_timeout(command) -> float:
+  """Default timeout for a terraform command based on its subcommand."""
+  return TERRAFORM_TIMEOUTS.get(command[1] if len(command) > 1 else '', TERRAFORM_DEFAULT_TIMEOUT)
+
+
+#################################################
+## runner
+#################################################
+class TerraformRunner:
+  """Runs terraform commands as asyncio subprocesses on a background event loop.
+      Every command has a timeout, can be cancelled and streams its output line by line,
+      and at most max_concurrency commands run at the same time.
+  """
+
+  def __init__(self, max_concurrency=TERRAFORM_MAX_CONCURRENCY):
+    self._loop = asyncio.new_event_loop()
+    self._semaphore = asyncio.Semaphore(max_concurrency)
+    self._thread = threading.Thread(target=self._loop.run_forever, name='nl2iac-terraform-runner', daemon=True)
+    self._thread.start()
+
+  async def _run(self, command, cwd, timeout, env, lines):
+    async with self._semaphore:
+      start = time.monotonic()
+      process = await asyncio.create_subprocess_exec(
+        *command, cwd=cwd, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        start_new_session=True)
+      stdout, stderr = [], []
+      tasks = [asyncio.ensure_future(_pump(process.stdout, stdout, 'stdout', lines)),
+               asyncio.ensure_future(_pump(process.stderr, stderr, 'stderr', lines)),
+               asyncio.ensure_future(process.wait())]
+      try:
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        timed_out = bool(pending)
+        if timed_out:
+          await _terminate(process)
+      except asyncio.CancelledError:
+        await _terminate(process)
+        raise
+      finally:
+        for task in tasks:
+          task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+      return CommandResult(command, process.returncode, b''.join(stdout), b''.join(stderr),
+                           time.monotonic() - start, timed_out)
+
+  def submit(self, command, cwd=None, timeout=None, env=None, lines=None):
+    """Starting a command, returning a concurrent.futures.Future (cancel() kills the process)."""
+    return asyncio.run_coroutine_threadsafe(
+      self._run(list(command), cwd, timeout or command_timeout(command), env, lines), self._loop)
+
+  async def run_async(self, command, cwd=None, timeout=None, env=None, lines=None) -> CommandResult:
+    """Running a command from any event loop."""
+    return await asyncio.wrap_future(self.submit(command, cwd, timeout, env, lines))
+
+  def run(self, command, cwd=None, timeout=None, env=None, on_output=None, stream=True) -> CommandResult:
+    """Running a command and waiting for it. Output lines are passed to on_output
+        (by default the handler set with stream_output) on the calling thread.
+        The process is killed if the caller is interrupted.
+    """
+    on_output = on_output or (_output_handler.get() if stream else None)
+    lines = queue.SimpleQueue() if on_output else None
+    future = self.submit(command, cwd, timeout, env, lines)
+    try:
+      while lines is not None and not future.done():
+        try:
+          on_output(*lines.get(timeout=0.1))
+        except queue.Empty:
+          pass
+      result = future.result()
+    except BaseException:
+      future.cancel()
+      raise
+    while lines is not None and not lines.empty():
+      on_output(*lines.get())
+    status = 'timeout' if result.timed_out else 'ok' if result.returncode == 0 else 'error'
+    nl2iac_metrics.observe('nl2iac_terraform_seconds', result.duration, 'terraform', {'cwd': cwd},
+                           command=result.command[1] if len(result.command) > 1 else result.command[0], status=status)
+    return result
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_runner() -> TerraformRunner:
+  """Returning the process wide terraform runner, created on first use."""
+  global _runner
+  with _runner_lock:
+    if _runner is None:
+      _runner = TerraformRunner()
+    return _runner
+
+
+def run(command, cwd=None, timeout=None, env=None, on_output=None, stream=True) -> CommandResult:
+  """Running a terraform command on the process wide runner."""
+  return get_runner().run(command, cwd, timeout, env, on_output, stream)
@@ -0,0 +1,346 @@
+"""Imports"""
+import os
+import re
+import json
+import shutil
+import math
+import hashlib
+import tempfile
+import threading
+from collections.abc import Mapping
+# nl2iac
+import nl2iac_runner
+
+
+##################
+# terraform
+TERRAFORM_RESOURCES_DESCRIPTION = ["terraform", "providers", "schema", "-json"]
+TERRAFORM_PROVIDER = 'registry.terraform.io/hashicorp/google'
+TERRAFORM_LOCK_FILE = '.terraform.lock.hcl'
+# cache
+SCHEMA_CACHE_DIR = os.path.join(os.environ.get('NL2IAC_CACHE_DIR', '.nl2iac_cache'), 'schema')
+SCHEMA_INDEX_FILE = 'index.json'
+SCHEMA_RESOURCES_FILE = 'resources.jsonl'
+SCHEMA_REQUIRED_FILE = 'required.json'
+SCHEMA_SEARCH_FILE = 'search.json'
+# resources retrieval (BM25 over the resource names and descriptions)
+SEARCH_TOP_K = 30
+SEARCH_K1 = 1.2
+SEARCH_B = 0.75
+# the name terms weight more than the description ones
+SEARCH_NAME_WEIGHT = 3
+SEARCH_STOPWORDS = frozenset(
+  'a an and are as at be by can for from google in into is it its of on or that the this to with resource resources '
+  'manages represents used use'.split())
+# common names of the components mapped to the terms on the provider resources
+SEARCH_SYNONYMS = {
+  'vm': 'compute instance', 'vms': 'compute instance', 'server': 'compute instance', 'vpc': 'network',
+  'subnet': 'subnetwork', 'lb': 'load balancer forwarding rule backend service', 'db': 'database',
+  'sql': 'sql database instance', 'gcs': 'storage bucket', 'gke': 'container cluster node pool',
+  'kubernetes': 'container cluster node pool', 'nat': 'router nat', 'ip': 'address', 'dns': 'dns managed zone record',
+  'pubsub': 'pubsub topic subscription', 'iam': 'iam member binding', 'serverless': 'cloud run function',
+}
+# only these keys are kept from the provider schema, descriptions and docs are dropped
+ATTRIBUTE_KEYS = ('type', 'nested_type', 'required', 'optional', 'computed')
+BLOCK_TYPE_KEYS = ('nesting_mode', 'min_items', 'max_items')
+
+# in-process caches: provider schemas and required arguments indexes by key, lock file stats by working directory
+_schemas = {}
+_required_indexes = {}
+_search_indexes = {}
+_lock_stats = {}
+_schemas_lock = threading.Lock()
+
+
+#######################################################
+#######################################################
+# schema objects
+#######################################################
+class ProviderSchema(Mapping):
+  """Read-only mapping of resource name to its compact schema.
+      Resources are read from the on-disk cache the first time they are accessed.
+  """
+
+  def __init__(self, key, version, offsets, path=None, resources=None):
+    self.key = key
+    self.version = version
+    self._offsets = offsets
+    self.path = path
+    self._resources = resources if resources is not None else {}
+    self._lock = threading.Lock()
+
+  def __getitem__(self, name):
+    if name not in self._resources:
+      offset, length = self._offsets[name]
+      with self._lock, open(os.path.join(self.path, SCHEMA_RESOURCES_FILE), 'rb') as resources_file:
+        resources_file.seek(offset)
+        self._resources[name] = json.loads(resources_file.read(length))
+    return self._resources[name]
+
+  def __iter__(self):
+    return iter(self._offsets)
+
+  def __len__(self):
+    return len(self._offsets)
+
+  def __contains__(self, name):
+    return name in self._offsets
+
+  def stream(self):
+    """Yielding (name, resource) for every resource in one sequential read of the on-disk cache,
+        without keeping them loaded (for the indexes built over the whole schema).
+    """
+    if self.path is None:
+      yield from self._resources.items()
+      return
+    with open(os.path.join(self.path, SCHEMA_RESOURCES_FILE), 'rb') as resources_file:
+      for name, (offset, length) in sorted(self._offsets.items(), key=lambda item: item[1][0]):
+        if name in self._resources:
+          yield name, self._resources[name]
+          continue
+        resources_file.seek(offset)
+        yield name, json.loads(resources_file.read(length))
+
+
+#################################################
+## helper functions
+#################################################
+def compact_block(block: dict) -> dict:
+  """Keeping just the parts of a schema block needed to build templates (recursive)."""
+  return {
+    'attributes': {
+      name: {k: v for k, v in attribute.items() if k in ATTRIBUTE_KEYS}
+      for name, attribute in block.get('attributes', {}).items()},
+    'block_types': {
+      name: {**{k: v for k, v in block_type.items() if k in BLOCK_TYPE_KEYS},
+             'block': compact_block(block_type.get('block', {}))}
+      for name, block_type in block.get('block_types', {}).items()},
+  }
+
+
+def compact_resource(resource: dict) -> dict:
+  """Compact form of a resource schema: its version, the block description and the compacted block."""
+  block = compact_block(resource.get('block', {}))
+  block['description'] = resource.get('block', {}).get('description', '')
+  return {'version': resource.get('version'), 'block': block}
+
+
+def lock_file_key(workdir: str, resource_filter: list):
+  """Returning the cache key for the provider installed in workdir and its version.
+      The key is derived from the dependency lock file, so a new terraform init
+      picking another provider version (or hashes) produces a new key.
+      Returns (None, None) when there is no lock file (terraform init not run).
+  """
+  lock_path = os.path.join(workdir, TERRAFORM_LOCK_FILE)
+  try:
+    stat = os.stat(lock_path)
+  except FileNotFoundError:
+    return None, None
+  # hashing the lock file only when it has changed since the last call
+  stat_id = (stat.st_mtime_ns, stat.st_size, tuple(resource_filter))
+  cached = _lock_stats.get(os.path.abspath(workdir))
+  if cached and cached[0] == stat_id:
+    return cached[1], cached[2]
+
+  with open(lock_path, 'rb') as lock_file:
+    lock_content = lock_file.read()
+  version = re.search(
+    r'provider\s+"' + re.escape(TERRAFORM_PROVIDER) + r'"\s*{[^}]*?version\s*=\s*"([^"]+)"',
+    lock_content.decode('utf-8', errors='replace'))
+  version = version.group(1) if version else None
+  key = hashlib.sha256(lock_content + json.dumps(resource_filter).encode()).hexdigest()[:32]
+  _lock_stats[os.path.abspath(workdir)] = (stat_id, key, version)
+  return key, version
+
+
+def read_provider_schema(workdir: str, resource_filter: list) -> dict:
+  """Running terraform providers schema -json and keeping the filtered resources compacted."""
+  execution = nl2iac_runner.run(TERRAFORM_RESOURCES_DESCRIPTION, cwd=workdir, stream=False)
+  resource_schemas = json.loads(execution.stdout)['provider_schemas'][TERRAFORM_PROVIDER]['resource_schemas']
+  return {name: compact_resource(resource) for name, resource in resource_schemas.items()
+          if any(f in name for f in resource_filter)}
+
+
+def load_cached_schema(key):
+  """Loading a provider schema index from the on-disk cache, None if not cached."""
+  path = os.path.join(SCHEMA_CACHE_DIR, key)
+  try:
+    with open(os.path.join(path, SCHEMA_INDEX_FILE), encoding='utf-8') as index_file:
+      index = json.load(index_file)
+  except (FileNotFoundError, json.JSONDecodeError):
+    return None
+  return ProviderSchema(key, index['version'], index['resources'], path=path)
+
+
+def save_cached_schema(key, version, resources: dict):
+  """Saving the compacted resources on disk, one json line per resource plus an offsets index."""
+  os.makedirs(SCHEMA_CACHE_DIR, exist_ok=True)
+  tmp_path = tempfile.mkdtemp(dir=SCHEMA_CACHE_DIR)
+  offsets = {}
+  with open(os.path.join(tmp_path, SCHEMA_RESOURCES_FILE), 'wb') as resources_file:
+    for name, resource in resources.items():
+      line = json.dumps(resource, separators=(',', ':')).encode('utf-8')
+      offsets[name] = (resources_file.tell(), len(line))
+      resources_file.write(line + b'\n')
+  with open(os.path.join(tmp_path, SCHEMA_INDEX_FILE), 'w', encoding='utf-8') as index_file:
+    json.dump({'version': version, 'resources': offsets}, index_file)
+  try:
+    os.replace(tmp_path, os.path.join(SCHEMA_CACHE_DIR, key))
+  except OSError:
+    # another process already cached the same provider version
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    return load_cached_schema(key)
+  return load_cached_schema(key)
+
+
+def required_rules(resource_name: str, block: dict, path: str = '') -> list:
+  """Returning the rules about required arguments and blocks of a schema block and
+      all of its nested blocks at any depth, e.g. boot_disk.initialize_params.
+  """
+  arguments = [name for name, attribute in block['attributes'].items() if attribute.get('required')]
+  blocks = [name for name, block_type in block['block_types'].items() if block_type.get('min_items', 0) > 0]
+  rules = []
+  if arguments or blocks:
+    required = ' and '.join(
+      f"{', '.join(names)} as {kind}" for names, kind in ((arguments, 'arguments'), (blocks, 'blocks')) if names)
+    if path:
+      rules.append(f"If block {path} is being used within {resource_name} it mandatory requires {required}.")
+    else:
+      rules.append(f"resource {resource_name} mandatory requires {required}.")
+  for name, block_type in block['block_types'].items():
+    rules += required_rules(resource_name, block_type['block'], f"{path}.{name}" if path else name)
+  return rules
+
+
+#################################################
+## schema access
+#################################################
+def get_provider_schema(resource_filter: list, workdir: str = '.') -> ProviderSchema:
+  """Returning the filtered resource schemas for the provider installed in workdir.
+      Lookup order: in-process cache, on-disk cache and finally terraform providers schema -json.
+  """
+  key, version = lock_file_key(workdir, resource_filter)
+  if key is None:
+    # without a lock file there's no way to know the provider version, so nothing is cached
+    resources = read_provider_schema(workdir, resource_filter)
+    return ProviderSchema(None, None, dict.fromkeys(resources), resources=resources)
+
+  with _schemas_lock:
+    if key not in _schemas:
+      schema = load_cached_schema(key)
+      if schema is None:
+        schema = save_cached_schema(key, version, read_provider_schema(workdir, resource_filter))
+      _schemas[key] = schema
+    return _schemas[key]
+
+
+def get_required_arguments_index(schema: ProviderSchema) -> dict:
+  """Returning the resource name -> required arguments rules index for a provider schema.
+      The index is built once per provider version and saved next to the cached schema.
+  """
+  with _schemas_lock:
+    if schema.key is not None and schema.key in _required_indexes:
+      return _required_indexes[schema.key]
+
+  index = None
+  required_path = os.path.join(schema.path, SCHEMA_REQUIRED_FILE) if schema.path else None
+  if required_path and os.path.exists(required_path):
+    with open(required_path, encoding='utf-8') as required_file:
+      index = json.load(required_file)
+  if index is None:
+    index = {name: required_rules(name, resource['block']) for name, resource in schema.stream()}
+    if required_path:
+      tmp_path = required_path + f'.{os.getpid()}.tmp'
+      with open(tmp_path, 'w', encoding='utf-8') as required_file:
+        json.dump(index, required_file)
+      os.replace(tmp_path, required_path)
+
+  if schema.key is not None:
+    with _schemas_lock:
+      _required_indexes[schema.key] = index
+  return index
+
+
+#################################################
+## resources retrieval
+#################################################
+def search_terms(text: str) -> list:
+  """Terms of a text for the resources retrieval: lowercase words without stopwords nor plurals."""
+  terms = []
+  for word in re.findall(r'[a-z0-9]+', (text or '').lower()):
+    if word in SEARCH_STOPWORDS:
+      continue
+    terms.append(word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word)
+  return terms
+
+
+def build_search_index(schema: ProviderSchema) -> dict:
+  """BM25 index of the resources by name (weighted) and description: postings and documents length."""
+  postings, lengths = {}, {}
+  for name, resource in schema.stream():
+    terms = search_terms(name.replace('_', ' ')) * SEARCH_NAME_WEIGHT + \
+      search_terms(resource['block'].get('description', ''))
+    lengths[name] = len(terms)
+    for term in terms:
+      postings.setdefault(term, {})
+      postings[term][name] = postings[term].get(name, 0) + 1
+  return {'postings': postings, 'lengths': lengths}
+
+
+def get_search_index(schema: ProviderSchema) -> dict:
+  """Returning the resources retrieval index for a provider schema,
+      built once per provider version and saved next to the cached schema.
+  """
+  with _schemas_lock:
+    if schema.key is not None and schema.key in _search_indexes:
+      return _search_indexes[schema.key]
+
+  index = None
+  search_path = os.path.join(schema.path, SCHEMA_SEARCH_FILE) if schema.path else None
+  if search_path and os.path.exists(search_path):
+    with open(search_path, encoding='utf-8') as search_file:
+      index = json.load(search_file)
+  if index is None:
+    index = build_search_index(schema)
+    if search_path:
+      tmp_path = search_path + f'.{os.getpid()}.tmp'
+      with open(tmp_path, 'w', encoding='utf-8') as search_file:
+        json.dump(index, search_file)
+      os.replace(tmp_path, search_path)
+
+  if schema.key is not None:
+    with _schemas_lock:
+      _search_indexes[schema.key] = index
+  return index
+
+
+def search_resources(schema: ProviderSchema, query: str, top_k: int = SEARCH_TOP_K) -> list:
+  """Names of the top_k resources most relevant to query (BM25), best first."""
+  index = get_search_index(schema)
+  lengths = index['lengths']
+  if not lengths:
+    return []
+  average_length = sum(lengths.values()) / len(lengths)
+  terms = search_terms(query)
+  terms += [t for term in terms if term in SEARCH_SYNONYMS for t in search_terms(SEARCH_SYNONYMS[term])]
+  scores = {}
+  for term in set(terms):
+    documents = index['postings'].get(term, {})
+    if not documents:
+      continue
+    idf = math.log(1 + (len(lengths) - len(documents) + 0.5) / (len(documents) + 0.5))
+    for name, frequency in documents.items():
+      norm = SEARCH_K1 * (1 - SEARCH_B + SEARCH_B * lengths[name] / average_length)
+      scores[name] = scores.get(name, 0.0) + idf * frequency * (SEARCH_K1 + 1) / (frequency + norm)
+  return sorted(scores, key=lambda name: (-scores[name], name))[:top_k]
+
+
+def clear_schema_cache(disk=False):
+  """Dropping the in-process schemas and, optionally, the on-disk cache."""
+  with _schemas_lock:
+    _schemas.clear()
+    _required_indexes.clear()
+    _search_indexes.clear()
+    _lock_stats.clear()
+  if disk:
+    shutil.rmtree(SCHEMA_CACHE_DIR, ignore_errors=True)
@@ -0,0 +1,192 @@
+"""Imports"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+# nl2iac
+import nl2iac_cache
+import nl2iac_workspace
+
+
+##################
+# status log
+SESSIONS_DB = os.path.join(nl2iac_cache.CACHE_DIR, 'sessions.sqlite3')
+STATUS_PAGE_SIZE = 20
+# entries kept by session (the oldest are removed) and days they are kept
+STATUS_LOG_MAX_ENTRIES = 500
+STATUS_LOG_TTL = 7 * 24 * 3600
+# sessions
+# idle sessions lose their heavy values, as their workspace lease expires after the same time
+SESSION_IDLE_TIMEOUT = nl2iac_workspace.WORKSPACE_LEASE_TIMEOUT
+# bytes of heavy values a session can hold, evicted in this order when it's over the cap
+SESSION_MAX_BYTES = 1024 * 1024
+SESSION_HEAVY_KEYS = ('terraform_template_deploy', 'tf_validation', 'terraform_template',
+                      'candidate_terraform_template', 'solution_description', 'image_description')
+
+
+#######################################################
+#######################################################
+# status log
+#######################################################
+class StatusLog:
+  """Runs and status messages of the app sessions stored on SQLite, read by pages
+      so the reruns don't replay (nor keep in memory) the whole history.
+  """
+
+  def __init__(self, path=SESSIONS_DB, max_entries=STATUS_LOG_MAX_ENTRIES, ttl=STATUS_LOG_TTL):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('''CREATE TABLE IF NOT EXISTS status (
+      id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, run_id TEXT, ts REAL, type TEXT, message TEXT)''')
+    self._db.execute('CREATE INDEX IF NOT EXISTS status_session ON status (session_id, id)')
+    self._db.execute('''CREATE TABLE IF NOT EXISTS runs (
+      run_id TEXT PRIMARY KEY, session_id TEXT, started REAL, finished REAL, status TEXT, details TEXT)''')
+    self.purge()
+
+  def start_run(self, session_id, details=None) -> str:
+    """Recording the start of a run (a template request) of a session, returning its id."""
+    run_id = uuid.uuid4().hex
+    with self._lock:
+      self._db.execute('INSERT INTO runs VALUES (?, ?, ?, NULL, ?, ?)',
+                       (run_id, session_id, time.time(), 'running', json.dumps(details or {}, default=str)))
+    return run_id
+
+  def finish_run(self, run_id, status):
+    """Recording the final status of a run (valid, invalid, deployed, deploy_failed)."""
+    with self._lock:
+      self._db.execute('UPDATE runs SET finished = ?, status = ? WHERE run_id = ?', (time.time(), status, run_id))
+
+  def runs(self, session_id, limit=STATUS_PAGE_SIZE) -> list:
+    """Latest runs of a session, newest first: dicts with run_id, started, finished, status and details."""
+    with self._lock:
+      rows = self._db.execute('SELECT run_id, started, finished, status, details FROM runs WHERE session_id = ? '
+                              'ORDER BY started DESC LIMIT ?', (session_id, limit)).fetchall()
+    return [{'run_id': r[0], 'started': r[1], 'finished': r[2], 'status': r[3], 'details': json.loads(r[4])}
+            for r in rows]
+
+  def add(self, session_id, message, message_type, run_id=None) -> float:
+    """Adding a status message to a session log, returning its timestamp."""
+    ts = time.time()
+    with self._lock:
+      cursor = self._db.execute('INSERT INTO status (session_id, run_id, ts, type, message) VALUES (?, ?, ?, ?, ?)',
+                                (session_id, run_id, ts, message_type, message))
+      # keeping just the latest max_entries of the session
+      self._db.execute('DELETE FROM status WHERE session_id = ? AND id <= ?',
+                       (session_id, cursor.lastrowid - self.max_entries))
+    return ts
+
+  def count(self, session_id) -> int:
+    """Messages on the log of a session."""
+    with self._lock:
+      return self._db.execute('SELECT COUNT(*) FROM status WHERE session_id = ?', (session_id,)).fetchone()[0]
+
+  def page(self, session_id, page=0, page_size=STATUS_PAGE_SIZE) -> list:
+    """(ts, message, type) of the page-th page of a session log (0 is the latest one), oldest first."""
+    with self._lock:
+      rows = self._db.execute('SELECT ts, message, type FROM status WHERE session_id = ? ORDER BY id DESC '
+                              'LIMIT ? OFFSET ?', (session_id, page_size, page * page_size)).fetchall()
+    return rows[::-1]
+
+  def purge(self):
+    """Removing the messages and runs older than ttl seconds."""
+    oldest = time.time() - self.ttl
+    with self._lock:
+      self._db.execute('DELETE FROM status WHERE ts < ?', (oldest,))
+      self._db.execute('DELETE FROM runs WHERE started < ?', (oldest,))
+
+
+#################################################
+## sessions
+#################################################
+def value_size(value) -> int:
+  """Approximate bytes of a session value (its json size)."""
+  try:
+    return len(json.dumps(value, default=str))
+  except (TypeError, ValueError):
+    return len(str(value))
+
+
+class SessionRegistry:
+  """Last activity of the app sessions: the heavy values of the sessions idle for more than
+      idle_timeout seconds are evicted (on_evict is called with the session id), and every
+      session is kept under max_bytes evicting its heavy values in order.
+  """
+
+  def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT, max_bytes=SESSION_MAX_BYTES,
+               heavy_keys=SESSION_HEAVY_KEYS, on_evict=None):
+    self.idle_timeout = idle_timeout
+    self.max_bytes = max_bytes
+    self.heavy_keys = heavy_keys
+    self.on_evict = on_evict
+    # session id -> [state, last time used]
+    self._sessions = {}
+    self._lock = threading.Lock()
+
+  def touch(self, session_id, state) -> list:
+    """Recording the activity of a session (state is its mutable mapping), evicting the idle ones
+        and capping its heavy values. Returns the keys evicted from state.
+    """
+    now = time.monotonic()
+    with self._lock:
+      self._sessions[session_id] = [state, now]
+      idle = [(sid, s) for sid, (s, last_used) in self._sessions.items() if now - last_used > self.idle_timeout]
+      for sid, _ in idle:
+        del self._sessions[sid]
+    for sid, idle_state in idle:
+      self.evict(idle_state)
+      if self.on_evict:
+        self.on_evict(sid)
+    return self.cap(state)
+
+  def evict(self, state) -> list:
+    """Removing all the heavy values of a session state."""
+    evicted = [key for key in self.heavy_keys if key in state]
+    for key in evicted:
+      del state[key]
+    return evicted
+
+  def cap(self, state) -> list:
+    """Removing heavy values of a session state, in order, until they fit in max_bytes."""
+    sizes = {key: value_size(state[key]) for key in self.heavy_keys if key in state}
+    total = sum(sizes.values())
+    evicted = []
+    for key in self.heavy_keys:
+      if total <= self.max_bytes:
+        break
+      if key in sizes:
+        del state[key]
+        total -= sizes[key]
+        evicted.append(key)
+    return evicted
+
+  def __len__(self):
+    return len(self._sessions)
+
+
+_status_log = None
+_registry = None
+_sessions_lock = threading.Lock()
+
+
+def get_status_log() -> StatusLog:
+  """Returning the process wide status log, created on first use."""
+  global _status_log
+  with _sessions_lock:
+    if _status_log is None:
+      _status_log = StatusLog()
+    return _status_log
+
+
+def get_registry() -> SessionRegistry:
+  """Returning the process wide sessions registry, idle sessions release their terraform workspace."""
+  global _registry
+  with _sessions_lock:
+    if _registry is None:
+      _registry = SessionRegistry(on_evict=lambda session_id: nl2iac_workspace.get_pool().release(session_id))
+    return _registry
@@ -0,0 +1,354 @@
+"""Imports"""
+import os
+import re
+import sys
+import time
+import fcntl
+import shutil
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+# nl2iac
+import nl2iac_runner
+
+
+##################
+# terraform
+TERRAFORM_TEMPLATE_FILE = 'main.tf'
+TERRAFORM_TEMPLATE_BACKUP_FILE = 'main.tf.bk'
+TERRAFORM_LOCK_FILE = '.terraform.lock.hcl'
+TERRAFORM_DATA_DIR = '.terraform'
+TERRAFORM_STATE_FILE = 'terraform.tfstate'
+# plans saved by the validation, named by the template content hash
+TERRAFORM_PLANS_DIR = '.nl2iac_plans'
+# workspaces
+# directory where terraform init was run, workspaces link to its providers
+WORKSPACE_BASE_DIR = os.environ.get('NL2IAC_WORKSPACE_BASE_DIR', '.')
+WORKSPACES_DIR = os.environ.get('NL2IAC_WORKSPACES_DIR', '.nl2iac_workspaces')
+WORKSPACE_POOL_SIZE = 4
+WORKSPACE_POOL_MAX_SIZE = 32
+# seconds without activity before a lease can be reclaimed by another owner
+WORKSPACE_LEASE_TIMEOUT = 3600
+# seconds the app waits for a free workspace before reporting that all of them are in use
+WORKSPACE_ACQUIRE_TIMEOUT = float(os.environ.get('NL2IAC_WORKSPACE_ACQUIRE_TIMEOUT', '30'))
+# file locked by the jobs (deploys, plans) running on a workspace, one at a time
+WORKSPACE_LOCK_FILE = '.nl2iac.lock'
+# file locked by the pool (process) owning a workspace while it runs, the workspaces left by
+# stopped processes are adopted by the next pool
+WORKSPACE_POOL_FILE = '.nl2iac.pool'
+WORKSPACE_RETIRED_DIR = 'retired'
+# providers bootstrap: terraform init run once per provider version on a base directory,
+# providers downloaded to a shared plugin cache or installed from a local filesystem mirror (air-gapped hosts)
+PROVIDERS_DIR = os.environ.get('NL2IAC_PROVIDERS_DIR', '.nl2iac_providers')
+PROVIDER_SOURCE = 'registry.terraform.io/hashicorp/google'
+# version constraint of the provider, e.g. "5.40.0" or "~> 5.0" (any version if empty)
+PROVIDER_VERSION = os.environ.get('NL2IAC_PROVIDER_VERSION', '')
+# directory created with terraform providers mirror, no registry access is tried when set
+PROVIDER_MIRROR = os.environ.get('NL2IAC_PROVIDER_MIRROR', '')
+TERRAFORM_INIT = ['terraform', 'init', '-input=false', '-backend=false', '-no-color']
+TERRAFORM_VERSIONS_FILE = 'versions.tf'
+
+# working directory used by the terraform tools in the current context
+# outside use_workspace (e.g. the image description) the terraform commands run on base_workdir()
+_current_workdir = contextvars.ContextVar('nl2iac_workdir', default=None)
+
+
+#######################################################
+#######################################################
+# current workspace
+#######################################################
+def current_workdir() -> str:
+  """Returning the working directory the terraform commands must run in."""
+  return _current_workdir.get() or base_workdir()
+
+
+@contextmanager
+def use_workspace(workdir: str):
+  """Running the terraform tools called within the block on workdir."""
+  token = _current_workdir.set(workdir)
+  try:
+    yield workdir
+  finally:
+    _current_workdir.reset(token)
+
+
+class WorkspaceBusy(RuntimeError):
+  """The workspace is locked by another thread or process (e.g. a deploy job)."""
+
+
+@contextmanager
+def workspace_lock(workdir: str, blocking: bool = True):
+  """Holding workdir exclusively (between threads and processes) for the duration of the block.
+      If not blocking, raises WorkspaceBusy instead of waiting when it's already held.
+  """
+  with open(os.path.join(workdir, WORKSPACE_LOCK_FILE), 'w', encoding='utf-8') as lock_file:
+    try:
+      fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError as e:
+      raise WorkspaceBusy(f'The workspace {workdir} is in use by a job.') from e
+    yield workdir
+
+
+#################################################
+## helper functions
+#################################################
+def reset_workspace(workdir: str):
+  """Restoring the default main.tf to be sure all terraform commands work and dropping the saved plans."""
+  shutil.copyfile(os.path.join(WORKSPACE_BASE_DIR, TERRAFORM_TEMPLATE_BACKUP_FILE),
+                  os.path.join(workdir, TERRAFORM_TEMPLATE_FILE))
+  shutil.rmtree(os.path.join(workdir, TERRAFORM_PLANS_DIR), ignore_errors=True)
+
+
+def provision_workspace(workdir: str, base_dir: str = WORKSPACE_BASE_DIR):
+  """Creating an initialized workspace without running terraform init:
+      the lock file is copied and the providers already installed on base_dir are linked.
+  """
+  os.makedirs(os.path.join(workdir, TERRAFORM_DATA_DIR), exist_ok=True)
+  shutil.copyfile(os.path.join(base_dir, TERRAFORM_TEMPLATE_BACKUP_FILE),
+                  os.path.join(workdir, TERRAFORM_TEMPLATE_BACKUP_FILE))
+  reset_workspace(workdir)
+  if os.path.exists(os.path.join(base_dir, TERRAFORM_LOCK_FILE)):
+    shutil.copyfile(os.path.join(base_dir, TERRAFORM_LOCK_FILE), os.path.join(workdir, TERRAFORM_LOCK_FILE))
+  providers = os.path.abspath(os.path.join(base_dir, TERRAFORM_DATA_DIR, 'providers'))
+  link = os.path.join(workdir, TERRAFORM_DATA_DIR, 'providers')
+  if os.path.isdir(providers):
+    # an adopted workspace may link to the providers of another base directory
+    if os.path.islink(link) and os.readlink(link) != providers:
+      os.remove(link)
+    if not os.path.lexists(link):
+      os.symlink(providers, link, target_is_directory=True)
+  return workdir
+
+
+#################################################
+## bootstrap
+#################################################
+def initialized(workdir: str) -> bool:
+  """True if terraform init was already run on workdir (it has a dependency lock file)."""
+  return os.path.exists(os.path.join(workdir, TERRAFORM_LOCK_FILE))
+
+
+def cli_config(plugin_cache_dir: str, mirror: str = PROVIDER_MIRROR) -> str:
+  """Terraform CLI configuration: the shared plugin cache and, if any, the filesystem mirror
+      as the only installation method for the provider.
+  """
+  config = f'plugin_cache_dir = "{os.path.abspath(plugin_cache_dir)}"\n'
+  if mirror:
+    config += f'''provider_installation {{
+  filesystem_mirror {{
+    path    = "{os.path.abspath(mirror)}"
+    include = ["{PROVIDER_SOURCE}"]
+  }}
+  direct {{
+    exclude = ["{PROVIDER_SOURCE}"]
+  }}
+}}
+'''
+  return config
+
+
+def bootstrap(version: str = PROVIDER_VERSION, mirror: str = PROVIDER_MIRROR, upgrade: bool = False,
+              providers_dir: str = PROVIDERS_DIR) -> str:
+  """Returning the base directory initialized for a provider version, running terraform init
+      just the first time (or if upgrade). The init is serialized between processes with a file lock.
+      Raises RuntimeError if terraform init fails.
+  """
+  name = re.sub(r'[^\w.-]+', '_', version).strip('_') or 'any'
+  base_dir = os.path.join(providers_dir, f'base-{name}')
+  if initialized(base_dir) and not upgrade:
+    return base_dir
+
+  plugin_cache_dir = os.path.join(providers_dir, 'plugin-cache')
+  os.makedirs(plugin_cache_dir, exist_ok=True)
+  os.makedirs(base_dir, exist_ok=True)
+  with open(os.path.join(providers_dir, '.lock'), 'w', encoding='utf-8') as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    # another process may have run the init while waiting for the lock
+    if initialized(base_dir) and not upgrade:
+      return base_dir
+    config_path = os.path.join(providers_dir, 'terraform.tfrc')
+    with open(config_path, 'w', encoding='utf-8') as config_file:
+      config_file.write(cli_config(plugin_cache_dir, mirror))
+    constraint = f'\n      version = "{version}"' if version else ''
+    with open(os.path.join(base_dir, TERRAFORM_VERSIONS_FILE), 'w', encoding='utf-8') as versions_file:
+      versions_file.write(f'''terraform {{
+  required_providers {{
+    google = {{
+      source  = "{PROVIDER_SOURCE}"{constraint}
+    }}
+  }}
+}}
+''')
+    shutil.copyfile(os.path.join(WORKSPACE_BASE_DIR, TERRAFORM_TEMPLATE_BACKUP_FILE),
+                    os.path.join(base_dir, TERRAFORM_TEMPLATE_BACKUP_FILE))
+    env = {**os.environ, 'TF_CLI_CONFIG_FILE': os.path.abspath(config_path), 'TF_IN_AUTOMATION': '1',
+           # no version checks against the internet
+           'CHECKPOINT_DISABLE': '1'}
+    execution = nl2iac_runner.run(TERRAFORM_INIT + (['-upgrade'] if upgrade else []), cwd=base_dir, env=env,
+                                  stream=False)
+    if execution.returncode != 0 or execution.timed_out:
+      raise RuntimeError(f"terraform init failed on {base_dir}: {execution.stderr.decode(errors='replace')}")
+  return base_dir
+
+
+def base_workdir() -> str:
+  """Base directory of the workspaces: WORKSPACE_BASE_DIR if terraform init was run on it by hand,
+      otherwise the one bootstrapped for PROVIDER_VERSION.
+  """
+  if initialized(WORKSPACE_BASE_DIR):
+    return WORKSPACE_BASE_DIR
+  return bootstrap()
+
+
+#################################################
+## pool
+#################################################
+class WorkspacePool:
+  """Pool of pre-initialized terraform working directories leased to sessions or jobs."""
+
+  def __init__(self, root=WORKSPACES_DIR, base_dir=None,
+               size=WORKSPACE_POOL_SIZE, max_size=WORKSPACE_POOL_MAX_SIZE,
+               lease_timeout=WORKSPACE_LEASE_TIMEOUT):
+    self.root = root
+    self.base_dir = base_dir or base_workdir()
+    self.max_size = max_size
+    self.lease_timeout = lease_timeout
+    self._free = []
+    # owner -> [workdir, last time used]
+    self._leases = {}
+    self._count = 0
+    # workdir -> pool file locked while the pool owns the workspace
+    self._claims = {}
+    self._condition = threading.Condition()
+    with self._condition:
+      self._adopt(size)
+      while len(self._free) < size:
+        self._free.append(self._new_workspace())
+
+  def _claim(self, workdir) -> bool:
+    """Locking the pool file of a workspace for this pool, False if another process owns it."""
+    claim = open(os.path.join(workdir, WORKSPACE_POOL_FILE), 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+    try:
+      fcntl.flock(claim, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      claim.close()
+      return False
+    self._claims[workdir] = claim
+    return True
+
+  def _adopt(self, size):
+    """Reusing up to size workspaces left by stopped processes on root, the other ones are removed
+        (or retired if they hold a deployed state). Workspaces owned by running processes are skipped.
+    """
+    if not os.path.isdir(self.root):
+      return
+    for name in sorted(os.listdir(self.root)):
+      workdir = os.path.join(self.root, name)
+      if name == WORKSPACE_RETIRED_DIR or not os.path.isdir(workdir) or not self._claim(workdir):
+        continue
+      if os.path.exists(os.path.join(workdir, TERRAFORM_STATE_FILE)):
+        self._retire(workdir)
+      elif len(self._free) < size:
+        self._count += 1
+        self._free.append(provision_workspace(workdir, self.base_dir))
+      else:
+        shutil.rmtree(workdir, ignore_errors=True)
+        self._claims.pop(workdir).close()
+
+  def _new_workspace(self):
+    workdir = os.path.join(self.root, uuid.uuid4().hex[:12])
+    os.makedirs(workdir)
+    self._claim(workdir)
+    self._count += 1
+    return provision_workspace(workdir, self.base_dir)
+
+  def _retire(self, workdir):
+    """Moving a workspace with the state of deployed resources out of the pool, the state must be kept."""
+    retired = os.path.join(self.root, WORKSPACE_RETIRED_DIR)
+    os.makedirs(retired, exist_ok=True)
+    os.replace(workdir, os.path.join(retired, f"{os.path.basename(workdir)}-{int(time.time())}"))
+    self._claims.pop(workdir).close()
+
+  def _recycle(self, workdir):
+    """Putting a workspace back on the pool, unless it holds a deployed state."""
+    if os.path.exists(os.path.join(workdir, TERRAFORM_STATE_FILE)):
+      self._retire(workdir)
+      self._count -= 1
+    else:
+      reset_workspace(workdir)
+      self._free.append(workdir)
+    self._condition.notify()
+
+  def _reclaim_idle(self):
+    now = time.monotonic()
+    for owner, (workdir, last_used) in list(self._leases.items()):
+      if now - last_used > self.lease_timeout:
+        del self._leases[owner]
+        self._recycle(workdir)
+
+  def acquire(self, owner, timeout=None) -> str:
+    """Leasing a workspace to owner (the same one if already leased). Blocks while the pool is full."""
+    with self._condition:
+      while True:
+        if owner in self._leases:
+          self._leases[owner][1] = time.monotonic()
+          return self._leases[owner][0]
+        if not self._free:
+          self._reclaim_idle()
+        if self._free:
+          workdir = self._free.pop()
+        elif self._count < self.max_size:
+          workdir = self._new_workspace()
+        else:
+          if not self._condition.wait(timeout):
+            raise TimeoutError(f'No terraform workspace available after {timeout} seconds.')
+          continue
+        self._leases[owner] = [workdir, time.monotonic()]
+        return workdir
+
+  def renew(self, owner):
+    """Renewing the lease of owner, returning its workspace (None if it doesn't hold one)."""
+    with self._condition:
+      if owner not in self._leases:
+        return None
+      self._leases[owner][1] = time.monotonic()
+      return self._leases[owner][0]
+
+  def release(self, owner):
+    """Returning the workspace leased by owner to the pool."""
+    with self._condition:
+      if owner in self._leases:
+        workdir, _ = self._leases.pop(owner)
+        self._recycle(workdir)
+
+  @contextmanager
+  def lease(self, owner=None, timeout=None):
+    """Leasing a workspace for the duration of the block and running the terraform tools on it."""
+    owner = owner or uuid.uuid4().hex
+    workdir = self.acquire(owner, timeout)
+    try:
+      with use_workspace(workdir):
+        yield workdir
+    finally:
+      self.release(owner)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> WorkspacePool:
+  """Returning the process wide workspace pool, created on first use
+      (bootstrapping the provider if it wasn't initialized).
+  """
+  global _pool
+  with _pool_lock:
+    if _pool is None:
+      _pool = WorkspacePool()
+    return _pool
+
+
+if __name__ == '__main__':
+  # bootstrapping the provider ahead of the app or the batch runs: python nl2iac_workspace.py [--upgrade]
+  print(bootstrap(upgrade='--upgrade' in sys.argv[1:]))
@@ -0,0 +1,10 @@
+"""Test setup: the nl2iac modules are imported from the repository root,
+    with their caches and metrics isolated on a temporary directory."""
+import os
+import sys
+import tempfile
+
+_workdir = tempfile.mkdtemp(prefix='nl2iac-tests-')
+os.environ.setdefault('NL2IAC_CACHE_DIR', os.path.join(_workdir, 'cache'))
+os.environ.setdefault('NL2IAC_METRICS_DIR', os.path.join(_workdir, 'metrics'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
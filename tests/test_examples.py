@@ -0,0 +1,41 @@
+"""Examples saved from the validated templates."""
+import nl2iac_examples
+
+TEMPLATE = '''provider "google" {
+  project = "team-a-prod"
+  region  = "europe-west1"
+}
+
+resource "google_compute_network" "vpc" {
+  name                    = "team-a-prod-vpc"
+  project                 = "team-a-prod"
+  auto_create_subnetworks = false
+}
+
+resource "google_compute_subnetwork" "subnet" {
+  name          = "subnet"
+  network       = google_compute_network.vpc.id
+  region        = "europe-west1"
+  ip_cidr_range = "10.0.0.0/24"
+}
+'''
+CONFIGURATION = {'project': 'team-a-prod', 'region': 'europe-west1'}
+
+
+def test_example_without_configuration():
+  solution = 'A custom VPC network for team-a-prod with a subnetwork for the web servers.'
+  nl2iac_examples.add_example(solution, TEMPLATE, configuration=CONFIGURATION)
+
+  stored = [example for _, example in nl2iac_examples.get_examples_store().items()]
+  assert len(stored) == 1
+  assert 'team-a-prod' not in stored[0]['description'] and 'team-a-prod' not in stored[0]['template']
+  assert 'europe-west1' not in stored[0]['template']
+  assert '<project>' in stored[0]['description']
+  assert 'provider "google"' not in stored[0]['template']
+
+  # a request with its configuration written in another format
+  prompt = nl2iac_examples.examples_prompt(
+    'A custom VPC network with a subnetwork for the web servers.\n\n**Configuration:** project: team-b, '
+    'region: us-central1')
+  assert 'Example 1.' in prompt
+  assert 'team-a-prod' not in prompt and 'europe-west1' not in prompt